@@ -12,20 +12,227 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
-from typing import Any, Dict, Optional, Tuple
+import zlib
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
 import attr
-from synapse.module_api import EventBase, ModuleApi, run_as_background_process
+from synapse.module_api import (
+    EventBase,
+    JsonDict,
+    ModuleApi,
+    UserID,
+    run_as_background_process,
+)
+from synapse.module_api.errors import ConfigError
+
+from synapse_auto_accept_invite.circuit_breaker import (
+    CircuitBreaker,
+    CircuitOpenError,
+    is_server_failure,
+)
+from synapse_auto_accept_invite.direct_messages import DirectMessageMarker
+from synapse_auto_accept_invite.fan_out import FanOutCoordinator
+from synapse_auto_accept_invite.introspection import (
+    SNAPSHOT_MAX_ITEMS,
+    IntrospectionResource,
+    RecentCounts,
+)
+from synapse_auto_accept_invite.load_shedding import (
+    LOAD_SHEDDING_MODE_REJECT_ALL,
+    LOAD_SHEDDING_MODES,
+    LoadShedder,
+)
+from synapse_auto_accept_invite.metrics import (
+    invite_to_join_duration,
+    invites_accepted,
+    invites_filtered,
+    invites_received,
+    join_attempts,
+    join_retries,
+    measure_stage,
+    skipped_joins,
+    stage_failures,
+    swept_invites,
+)
+from synapse_auto_accept_invite.profiling import (
+    DISABLED_INVOCATION,
+    Invocation,
+    Profiler,
+)
+from synapse_auto_accept_invite.ratelimit import RateLimit, TokenBucketLimiter
+from synapse_auto_accept_invite.retry import RetryPolicy
+from synapse_auto_accept_invite.rules import RULE_FIELDS, InviteRules
+from synapse_auto_accept_invite.scheduler import (
+    LANE_DIRECT_MESSAGE,
+    LANE_FEDERATED,
+    LANE_LARGE_ROOM,
+    LANE_LOCAL,
+    JoinJob,
+    JoinScheduler,
+    RetryLaterError,
+)
+from synapse_auto_accept_invite.store import (
+    PendingJoin,
+    PendingJoinStore,
+    get_outstanding_invites,
+)
+from synapse_auto_accept_invite.tracing import Tracer
 
 logger = logging.getLogger(__name__)
-ACCOUNT_DATA_DIRECT_MESSAGE_LIST = "m.direct"
+
+# How many pending joins to load from the database at once when resuming them.
+RESUME_BATCH_SIZE = 500
+
+# The invites received, accepted and filtered out are counted over the last 10
+# minutes, by minute, for introspection.
+RECENT_OUTCOMES_BUCKET_MS = 60 * 1000
+RECENT_OUTCOMES_BUCKET_COUNT = 10
+
+
+def _parse_duration(config: Dict[str, Any], name: str, default: float) -> float:
+    """Reads a non-negative number of seconds from the configuration."""
+    value = config.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ConfigError(f"{name} must be a positive number of seconds")
+    return value
+
+
+def _parse_bool(config: Dict[str, Any], name: str) -> bool:
+    """Reads a boolean, which defaults to false, from the configuration."""
+    value = config.get(name, False)
+    if not isinstance(value, bool):
+        raise ConfigError(f"{name} must be true or false")
+    return value
+
+
+def _parse_int(
+    config: Dict[str, Any], name: str, default: int, minimum: int = 0
+) -> int:
+    """Reads an integer from the configuration, which must be at least `minimum`."""
+    value = config.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+        raise ConfigError(f"{name} must be an integer greater or equal to {minimum}")
+    return value
+
+
+def _parse_rate_limit(config: Dict[str, Any], name: str) -> Optional[RateLimit]:
+    """Reads an optional rate limit from the configuration."""
+    value = config.get(name)
+    if value is None:
+        return None
+
+    if not isinstance(value, dict):
+        raise ConfigError(f"{name} must be a dictionary")
+    per_second = value.get("per_second")
+    if (
+        isinstance(per_second, bool)
+        or not isinstance(per_second, (int, float))
+        or per_second <= 0
+    ):
+        raise ConfigError(f"{name}.per_second must be a positive number")
+
+    burst_count = value.get("burst_count")
+    if (
+        isinstance(burst_count, bool)
+        or not isinstance(burst_count, int)
+        or burst_count < 1
+    ):
+        raise ConfigError(f"{name}.burst_count must be a positive integer")
+
+    return RateLimit(per_second=per_second, burst_count=burst_count)
+
+
+def _parse_retry_policy(config: Dict[str, Any]) -> RetryPolicy:
+    """Reads the policy for retrying failed joins from the configuration."""
+    permanent_error_codes = config.get("join_retry_permanent_error_codes", [403, 404])
+    if not isinstance(permanent_error_codes, list) or not all(
+        isinstance(code, int) and not isinstance(code, bool)
+        for code in permanent_error_codes
+    ):
+        raise ConfigError(
+            "join_retry_permanent_error_codes must be a list of HTTP status codes"
+        )
+
+    return RetryPolicy(
+        initial_delay=_parse_duration(config, "join_retry_initial_delay", 1.0),
+        max_delay=_parse_duration(config, "join_retry_max_delay", 60.0),
+        max_attempts=_parse_int(config, "join_retry_max_attempts", 5, minimum=1),
+        deadline=_parse_duration(config, "join_retry_deadline", 300.0),
+        permanent_error_codes=frozenset(permanent_error_codes),
+        federation_race_window=_parse_duration(
+            config, "join_retry_federation_race_window", 15.0
+        ),
+    )
+
+
+def _parse_invite_rules(config: Dict[str, Any]) -> InviteRules:
+    """Reads the lists of allowed and denied inviters, invitees and room versions from
+    the configuration.
+    """
+    rules = config.get("invite_rules", {})
+    if not isinstance(rules, dict):
+        raise ConfigError("invite_rules must be a dictionary")
+
+    lists: Dict[str, Dict[str, List[str]]] = {}
+    for kind, section in rules.items():
+        if kind not in ("allow", "deny"):
+            raise ConfigError(f"invite_rules.{kind}: expected 'allow' or 'deny'")
+        if not isinstance(section, dict):
+            raise ConfigError(f"invite_rules.{kind} must be a dictionary")
+
+        lists[kind] = {}
+        for field, entries in section.items():
+            if field not in RULE_FIELDS:
+                raise ConfigError(
+                    f"invite_rules.{kind}.{field}: expected one of"
+                    f" {', '.join(RULE_FIELDS)}"
+                )
+            # Allow room versions to be written as numbers.
+            if not isinstance(entries, list) or not all(
+                isinstance(entry, (str, int)) and not isinstance(entry, bool)
+                for entry in entries
+            ):
+                raise ConfigError(f"invite_rules.{kind}.{field} must be a list")
+            lists[kind][field] = [str(entry) for entry in entries]
+
+    return InviteRules(allow=lists.get("allow"), deny=lists.get("deny"))
 
 
 @attr.s(auto_attribs=True, frozen=True)
 class InviteAutoAccepterConfig:
     accept_invites_only_for_direct_messages: bool = False
     accept_invites_only_from_local_users: bool = False
-    worker_to_run_on: Optional[str] = None
+    invite_rules: InviteRules = InviteRules()
+    # The workers to accept invites on, None standing for the main process.
+    workers_to_run_on: Tuple[Optional[str], ...] = (None,)
+    direct_message_batch_interval: float = 0.5
+    direct_message_max_rooms_per_counterparty: int = 0
+    direct_message_remove_left_rooms: bool = False
+    max_concurrent_joins: int = 10
+    max_concurrent_joins_per_server: int = 3
+    reserved_priority_join_slots: int = 0
+    large_room_member_threshold: int = 50
+    fan_out_batch_size: int = 10
+    fan_out_batch_interval: float = 1.0
+    circuit_breaker_failure_threshold: int = 5
+    circuit_breaker_reset_timeout: float = 30
+    invite_rate_limit_per_inviter: Optional[RateLimit] = None
+    invite_rate_limit_per_inviter_server: Optional[RateLimit] = None
+    invite_rate_limit_per_invitee: Optional[RateLimit] = None
+    invite_rate_limit_max_tracked: int = 10000
+    load_shedding_high_water_mark: int = 0
+    load_shedding_low_water_mark: int = 0
+    load_shedding_mode: str = LOAD_SHEDDING_MODE_REJECT_ALL
+    persist_pending_joins: bool = False
+    sweep_missed_invites: bool = False
+    sweep_batch_size: int = 100
+    sweep_batch_interval: float = 1.0
+    join_retry_policy: RetryPolicy = RetryPolicy()
+    enable_tracing: bool = False
+    profiling_slow_threshold: float = 0
+    profiling_sample_rate: float = 0
+    profiling_directory: Optional[str] = None
+    introspection_resource_path: Optional[str] = None
 
 
 class InviteAutoAccepter:
@@ -34,18 +241,88 @@ class InviteAutoAccepter:
         self._api = api
         self._config = config
 
-        should_run_on_this_worker = config.worker_to_run_on == self._api.worker_name
+        self._tracer = Tracer(config.enable_tracing)
+        self._profiler = Profiler(
+            config.profiling_slow_threshold,
+            config.profiling_sample_rate,
+            config.profiling_directory,
+        )
+        self._direct_message_marker = DirectMessageMarker(
+            api,
+            config.direct_message_batch_interval,
+            self._tracer,
+            self._profiler,
+            config.direct_message_max_rooms_per_counterparty,
+            config.direct_message_remove_left_rooms,
+        )
+        self._circuit_breaker = CircuitBreaker(
+            config.circuit_breaker_failure_threshold,
+            int(config.circuit_breaker_reset_timeout * 1000),
+        )
+        self._join_scheduler = JoinScheduler(
+            api,
+            self._accept_invite,
+            config.max_concurrent_joins,
+            config.max_concurrent_joins_per_server,
+            self._circuit_breaker,
+            config.reserved_priority_join_slots,
+            bg_start_span=self._tracer.enabled,
+        )
+        self._fan_out = FanOutCoordinator(
+            api,
+            self._join_scheduler,
+            config.fan_out_batch_size,
+            config.fan_out_batch_interval,
+            bg_start_span=self._tracer.enabled,
+        )
+        self._load_shedder = LoadShedder(
+            config.load_shedding_high_water_mark,
+            config.load_shedding_low_water_mark,
+            config.load_shedding_mode,
+        )
+
+        # The rate limits to apply to invites, with the kind of key they apply to.
+        self._rate_limiters: List[Tuple[str, TokenBucketLimiter]] = [
+            (key_kind, TokenBucketLimiter(limit, config.invite_rate_limit_max_tracked))
+            for key_kind, limit in (
+                ("inviter", config.invite_rate_limit_per_inviter),
+                ("inviter_server", config.invite_rate_limit_per_inviter_server),
+                ("invitee", config.invite_rate_limit_per_invitee),
+            )
+            if limit is not None
+        ]
+
+        # What happened to recent invites, for introspection.
+        self._recent_outcomes = RecentCounts(
+            RECENT_OUTCOMES_BUCKET_MS, RECENT_OUTCOMES_BUCKET_COUNT
+        )
+
+        self._pending_join_store: Optional[PendingJoinStore] = None
+        if config.persist_pending_joins:
+            self._pending_join_store = PendingJoinStore(api)
+
+        self._shard_count = len(config.workers_to_run_on)
+        self._shard_index = 0
+
+        should_run_on_this_worker = self._api.worker_name in config.workers_to_run_on
 
         if not should_run_on_this_worker:
             logger.info(
                 "Not accepting invites on this worker (configured: %r, here: %r)",
-                config.worker_to_run_on,
+                config.workers_to_run_on,
                 self._api.worker_name,
             )
             return
 
+        # If there are several workers to run on, invitees are split between them
+        # based on their user ID, and this worker only handles its share of them.
+        self._shard_index = config.workers_to_run_on.index(self._api.worker_name)
+
         logger.info(
-            "Accepting invites on this worker (here: %r)", self._api.worker_name
+            "Accepting invites on this worker (here: %r, share %d of %d)",
+            self._api.worker_name,
+            self._shard_index + 1,
+            self._shard_count,
         )
 
         # Register the callback.
@@ -53,6 +330,28 @@ class InviteAutoAccepter:
             on_new_event=self.on_new_event,
         )
 
+        if config.introspection_resource_path is not None:
+            self._api.register_web_resource(
+                config.introspection_resource_path,
+                IntrospectionResource(api, self._get_snapshot),
+            )
+
+        if self._pending_join_store is not None:
+            # Pick up where we left off before the last restart.
+            run_as_background_process(
+                "auto_accept_invite_resume_pending_joins",
+                self._resume_pending_joins,
+                self._pending_join_store,
+                bg_start_span=self._tracer.enabled,
+            )
+
+        if config.sweep_missed_invites:
+            run_as_background_process(
+                "auto_accept_invite_sweep_missed_invites",
+                self._sweep_missed_invites,
+                bg_start_span=self._tracer.enabled,
+            )
+
     @staticmethod
     def parse_config(config: Dict[str, Any]) -> InviteAutoAccepterConfig:
         """Checks that the required fields are present and at a correct value, and
@@ -72,11 +371,158 @@ class InviteAutoAccepter:
         )
 
         worker_to_run_on = config.get("worker_to_run_on", None)
+        if isinstance(worker_to_run_on, list):
+            if not worker_to_run_on or not all(
+                isinstance(worker, str) for worker in worker_to_run_on
+            ):
+                raise ConfigError(
+                    "worker_to_run_on must be a worker name or a non-empty list of"
+                    " worker names"
+                )
+            if len(set(worker_to_run_on)) != len(worker_to_run_on):
+                raise ConfigError("worker_to_run_on must not list a worker twice")
+            workers_to_run_on: Tuple[Optional[str], ...] = tuple(worker_to_run_on)
+        elif worker_to_run_on is None or isinstance(worker_to_run_on, str):
+            workers_to_run_on = (worker_to_run_on,)
+        else:
+            raise ConfigError(
+                "worker_to_run_on must be a worker name or a list of worker names"
+            )
+
+        direct_message_batch_interval = _parse_duration(
+            config, "direct_message_batch_interval", 0.5
+        )
+        direct_message_max_rooms_per_counterparty = _parse_int(
+            config, "direct_message_max_rooms_per_counterparty", 0
+        )
+
+        max_concurrent_joins = _parse_int(config, "max_concurrent_joins", 10, minimum=1)
+        max_concurrent_joins_per_server = _parse_int(
+            config, "max_concurrent_joins_per_server", 3, minimum=1
+        )
+
+        circuit_breaker_failure_threshold = _parse_int(
+            config, "circuit_breaker_failure_threshold", 5
+        )
+        circuit_breaker_reset_timeout = _parse_duration(
+            config, "circuit_breaker_reset_timeout", 30
+        )
+
+        invite_rate_limit_max_tracked = _parse_int(
+            config, "invite_rate_limit_max_tracked", 10000, minimum=1
+        )
+
+        reserved_priority_join_slots = _parse_int(
+            config, "reserved_priority_join_slots", 0
+        )
+        if reserved_priority_join_slots >= max_concurrent_joins:
+            raise ConfigError(
+                "reserved_priority_join_slots must be lower than max_concurrent_joins"
+            )
+        large_room_member_threshold = _parse_int(
+            config, "large_room_member_threshold", 50
+        )
+
+        fan_out_batch_size = _parse_int(config, "fan_out_batch_size", 10)
+        fan_out_batch_interval = _parse_duration(config, "fan_out_batch_interval", 1.0)
+
+        load_shedding_high_water_mark = _parse_int(
+            config, "load_shedding_high_water_mark", 0
+        )
+        load_shedding_low_water_mark = _parse_int(
+            config,
+            "load_shedding_low_water_mark",
+            max(load_shedding_high_water_mark // 2, 1),
+        )
+        # Load shedding stops once there are fewer pending joins than the low-water
+        # mark, which would never happen with a low-water mark of 0.
+        if load_shedding_high_water_mark > 0 and not (
+            1 <= load_shedding_low_water_mark <= load_shedding_high_water_mark
+        ):
+            raise ConfigError(
+                "load_shedding_low_water_mark must be at least 1 and not greater than"
+                " load_shedding_high_water_mark"
+            )
+        load_shedding_mode = config.get(
+            "load_shedding_mode", LOAD_SHEDDING_MODE_REJECT_ALL
+        )
+        if load_shedding_mode not in LOAD_SHEDDING_MODES:
+            raise ConfigError(
+                f"load_shedding_mode must be one of {', '.join(LOAD_SHEDDING_MODES)}"
+            )
+
+        profiling_sample_rate = config.get("profiling_sample_rate", 0)
+        if (
+            isinstance(profiling_sample_rate, bool)
+            or not isinstance(profiling_sample_rate, (int, float))
+            or not 0 <= profiling_sample_rate <= 1
+        ):
+            raise ConfigError("profiling_sample_rate must be a number between 0 and 1")
+        profiling_directory = config.get("profiling_directory")
+        if profiling_directory is not None and not isinstance(profiling_directory, str):
+            raise ConfigError("profiling_directory must be a path")
+        if profiling_sample_rate and profiling_directory is None:
+            raise ConfigError(
+                "profiling_directory must be set if profiling_sample_rate is"
+            )
+
+        introspection_resource_path = config.get("introspection_resource_path")
+        if introspection_resource_path is not None and (
+            not isinstance(introspection_resource_path, str)
+            or not introspection_resource_path.startswith("/")
+        ):
+            raise ConfigError(
+                "introspection_resource_path must be a path starting with /"
+            )
+
+        sweep_batch_size = _parse_int(config, "sweep_batch_size", 100, minimum=1)
+        sweep_batch_interval = _parse_duration(config, "sweep_batch_interval", 1.0)
 
         return InviteAutoAccepterConfig(
             accept_invites_only_for_direct_messages=accept_invites_only_for_direct_messages,
             accept_invites_only_from_local_users=accept_invites_only_from_local_users,
-            worker_to_run_on=worker_to_run_on,
+            invite_rules=_parse_invite_rules(config),
+            workers_to_run_on=workers_to_run_on,
+            direct_message_batch_interval=direct_message_batch_interval,
+            direct_message_max_rooms_per_counterparty=(
+                direct_message_max_rooms_per_counterparty
+            ),
+            direct_message_remove_left_rooms=_parse_bool(
+                config, "direct_message_remove_left_rooms"
+            ),
+            max_concurrent_joins=max_concurrent_joins,
+            max_concurrent_joins_per_server=max_concurrent_joins_per_server,
+            reserved_priority_join_slots=reserved_priority_join_slots,
+            large_room_member_threshold=large_room_member_threshold,
+            fan_out_batch_size=fan_out_batch_size,
+            fan_out_batch_interval=fan_out_batch_interval,
+            circuit_breaker_failure_threshold=circuit_breaker_failure_threshold,
+            circuit_breaker_reset_timeout=circuit_breaker_reset_timeout,
+            invite_rate_limit_per_inviter=_parse_rate_limit(
+                config, "invite_rate_limit_per_inviter"
+            ),
+            invite_rate_limit_per_inviter_server=_parse_rate_limit(
+                config, "invite_rate_limit_per_inviter_server"
+            ),
+            invite_rate_limit_per_invitee=_parse_rate_limit(
+                config, "invite_rate_limit_per_invitee"
+            ),
+            invite_rate_limit_max_tracked=invite_rate_limit_max_tracked,
+            load_shedding_high_water_mark=load_shedding_high_water_mark,
+            load_shedding_low_water_mark=load_shedding_low_water_mark,
+            load_shedding_mode=load_shedding_mode,
+            persist_pending_joins=_parse_bool(config, "persist_pending_joins"),
+            sweep_missed_invites=_parse_bool(config, "sweep_missed_invites"),
+            sweep_batch_size=sweep_batch_size,
+            sweep_batch_interval=sweep_batch_interval,
+            join_retry_policy=_parse_retry_policy(config),
+            enable_tracing=_parse_bool(config, "enable_tracing"),
+            profiling_slow_threshold=_parse_duration(
+                config, "profiling_slow_threshold", 0
+            ),
+            profiling_sample_rate=profiling_sample_rate,
+            profiling_directory=profiling_directory,
+            introspection_resource_path=introspection_resource_path,
         )
 
     async def on_new_event(self, event: EventBase, *args: Any) -> None:
@@ -86,125 +532,611 @@ class InviteAutoAccepter:
         Args:
             event: The incoming event.
         """
-        # Check if the event is an invite for a local user.
-        is_invite_for_local_user = (
-            event.type == "m.room.member"
-            and event.is_state()
-            and event.membership == "invite"
-            and self._api.is_mine(event.state_key)
-        )
+        # Cheap checks first: this callback runs for every event persisted on this
+        # server, and the overwhelming majority of them aren't invites. Make sure to
+        # reject them without calling into the homeserver.
+        if (
+            event.type != "m.room.member"
+            or not event.is_state()
+            or event.membership != "invite"
+        ):
+            return
+
+        with self._tracer.span(
+            "classify", event.state_key, event.room_id
+        ), self._profiler.invocation(
+            "on_new_event", event.state_key, event.room_id
+        ) as invocation:
+            self._maybe_accept_invite(
+                event.state_key,
+                event.sender,
+                event.room_id,
+                event.content,
+                event.room_version.identifier,
+                event.unsigned.get("invite_room_state"),
+                invocation,
+            )
+
+    def _maybe_accept_invite(
+        self,
+        invitee: str,
+        inviter: str,
+        room_id: str,
+        content: Mapping[str, Any],
+        room_version: str,
+        invite_room_state: Any,
+        invocation: Invocation = DISABLED_INVOCATION,
+    ) -> bool:
+        """Checks whether an invite should be accepted according to the configuration
+        and, if so, schedules accepting it.
+
+        Args:
+            invitee: the user that was invited
+            inviter: the user that sent the invite
+            room_id: the room the user was invited to
+            content: the content of the invite's membership event
+            room_version: the identifier of the room's version
+            invite_room_state: the stripped state of the room sent along with the
+                invite, if any
+            invocation: the invocation to record the time spent in each check in, if
+                it's being profiled
+
+        Returns:
+            Whether the invite is being accepted.
+        """
+        # Check if the invite is for a local user.
+        if not self._api.is_mine(invitee):
+            return False
+
+        # Check if the invitee is handled by this worker.
+        if not self._is_handled_by_this_worker(invitee):
+            return False
+
+        invites_received.inc()
+        self._record_outcome("received")
 
         # Only accept invites for direct messages if the configuration mandates it.
-        is_direct_message = event.content.get("is_direct", False)
-        is_allowed_by_direct_message_rules = (
-            not self._config.accept_invites_only_for_direct_messages
-            or is_direct_message is True
-        )
+        is_direct_message = content.get("is_direct", False)
+        if (
+            self._config.accept_invites_only_for_direct_messages
+            and is_direct_message is not True
+        ):
+            self._record_filtered("not_direct_message")
+            return False
 
         # Only accept invites from remote users if the configuration mandates it.
-        is_from_local_user = self._api.is_mine(event.sender)
-        is_allowed_by_local_user_rules = (
-            not self._config.accept_invites_only_from_local_users
-            or is_from_local_user is True
-        )
+        is_from_local_user = self._api.is_mine(inviter)
+        if self._config.accept_invites_only_from_local_users and not is_from_local_user:
+            self._record_filtered("not_from_local_user")
+            return False
 
-        if (
-            is_invite_for_local_user
-            and is_allowed_by_direct_message_rules
-            and is_allowed_by_local_user_rules
+        # Check the invite against the configured allow and deny lists.
+        if self._config.invite_rules:
+            reason = self._config.invite_rules.check(inviter, invitee, room_version)
+            if reason is not None:
+                self._record_filtered(reason)
+                return False
+        invocation.lap("filters")
+
+        # Don't pile up more joins than the homeserver can keep up with.
+        if not self._load_shedder.should_accept(
+            self._get_pending_join_count(),
+            is_priority=is_direct_message is True or is_from_local_user,
         ):
-            # Make the user join the room. We run this as a background process to circumvent a race condition
-            # that occurs when responding to invites over federation (see https://github.com/matrix-org/synapse-auto-accept-invite/issues/12)
-            run_as_background_process(
-                "retry_make_join",
-                self._retry_make_join,
-                event.state_key,
-                event.state_key,
-                event.room_id,
-                "join",
-                bg_start_span=False,
+            self._record_filtered("load_shedding")
+            return False
+        invocation.lap("load_shedding")
+
+        destination = self._get_destination(inviter, is_from_local_user)
+
+        # Don't let a flood of invites make us spend joins without limit. Invites over
+        # the limit are left for the user to respond to.
+        if self._rate_limiters:
+            reason = self._check_rate_limits(inviter, invitee, destination)
+            if reason is not None:
+                self._record_filtered(reason)
+                return False
+            invocation.lap("rate_limits")
+
+        invites_accepted.inc()
+        self._record_outcome("accepted")
+
+        # Accept the invite in the background, so that this callback (and with it
+        # Synapse's event notification path) doesn't wait on the join or on account
+        # data I/O. Running the join as a background process is also needed to
+        # circumvent a race condition that occurs when responding to invites over
+        # federation (see https://github.com/matrix-org/synapse-auto-accept-invite/issues/12)
+        job = JoinJob(
+            user_id=invitee,
+            inviter=inviter,
+            room_id=room_id,
+            is_direct_message=is_direct_message is True,
+            destination=destination,
+            lane=self._get_lane(
+                is_direct_message is True, is_from_local_user, invite_room_state
+            ),
+            queued_at=self._api.get_current_time_msec(),
+        )
+        # Persist the job before scheduling it, as it can complete (and be removed
+        # from the database) before `schedule` returns.
+        self._save_pending_join(job)
+        scheduled_job = self._fan_out.schedule(job)
+        if scheduled_job is not job:
+            # The invite was merged into an existing job, which is the one to persist.
+            self._save_pending_join(scheduled_job)
+        invocation.lap("schedule")
+        return True
+
+    def _get_lane(
+        self, is_direct_message: bool, is_from_local_user: bool, invite_room_state: Any
+    ) -> int:
+        """Picks the scheduler lane to queue the join for an invite in."""
+        if is_direct_message:
+            return LANE_DIRECT_MESSAGE
+        if is_from_local_user:
+            return LANE_LOCAL
+        if self._looks_like_large_room(invite_room_state):
+            return LANE_LARGE_ROOM
+        return LANE_FEDERATED
+
+    def _looks_like_large_room(self, invite_room_state: Any) -> bool:
+        """Guesses whether a remote room is large, and so slow to join, from the
+        stripped state sent along with the invite.
+
+        The stripped state doesn't include the number of members in the room, so this
+        is a heuristic: a room is considered large if anyone can join it, or if the
+        stripped state includes at least `large_room_member_threshold` members (which
+        some servers are configured to send).
+        """
+        if not isinstance(invite_room_state, Sequence):
+            return False
+
+        members = 0
+        for event in invite_room_state:
+            if not isinstance(event, Mapping):
+                continue
+            event_type = event.get("type")
+            if event_type == "m.room.member":
+                members += 1
+            elif event_type == "m.room.join_rules":
+                content = event.get("content")
+                if (
+                    isinstance(content, Mapping)
+                    and content.get("join_rule") == "public"
+                ):
+                    return True
+
+        threshold = self._config.large_room_member_threshold
+        return threshold > 0 and members >= threshold
+
+    def _check_rate_limits(
+        self, inviter: str, invitee: str, destination: Optional[str]
+    ) -> Optional[str]:
+        """Checks an invite against the configured rate limits and, if it's within all
+        of them, counts it towards them.
+
+        Returns:
+            None if the invite is within the rate limits, otherwise the reason it isn't.
+        """
+        now = self._api.get_current_time_msec()
+        keys = {"inviter": inviter, "inviter_server": destination, "invitee": invitee}
+
+        limiters = []
+        for key_kind, limiter in self._rate_limiters:
+            key = keys[key_kind]
+            if key is None:
+                # Invites from local users aren't limited per server.
+                continue
+            if not limiter.can_perform(key, now):
+                return f"rate_limited_{key_kind}"
+            limiters.append((limiter, key))
+
+        for limiter, key in limiters:
+            limiter.record_action(key, now)
+        return None
+
+    def _record_outcome(self, outcome: str) -> None:
+        """Counts an invite towards the recent outcomes shown by introspection."""
+        self._recent_outcomes.record(outcome, self._api.get_current_time_msec())
+
+    def _record_filtered(self, reason: str) -> None:
+        """Counts an invite that isn't being accepted, for the given reason."""
+        invites_filtered.labels(reason).inc()
+        self._record_outcome(f"filtered.{reason}")
+
+    def _get_snapshot(self) -> JsonDict:
+        """Returns a snapshot of the module's state, for introspection.
+
+        Only counts are computed over structures that grow with the backlog, and only
+        their first `SNAPSHOT_MAX_ITEMS` items are listed, so that snapshots are cheap
+        enough to be polled.
+        """
+        now = self._api.get_current_time_msec()
+
+        outcomes = self._recent_outcomes.get_counts(now)
+        filtered_prefix = "filtered."
+        return {
+            "now": now,
+            "joins": self._join_scheduler.get_snapshot(SNAPSHOT_MAX_ITEMS),
+            "fan_out": self._fan_out.get_snapshot(),
+            "direct_messages": self._direct_message_marker.get_snapshot(
+                SNAPSHOT_MAX_ITEMS
+            ),
+            "circuit_breaker": self._circuit_breaker.get_snapshot(
+                now, SNAPSHOT_MAX_ITEMS
+            ),
+            "load_shedding": {
+                "shedding": self._load_shedder.shedding,
+                "pending_joins": self._get_pending_join_count(),
+            },
+            "rate_limits": {
+                key_kind: {"tracked_keys": len(limiter)}
+                for key_kind, limiter in self._rate_limiters
+            },
+            "recent_invites": {
+                "window_seconds": self._recent_outcomes.window_ms / 1000,
+                "received": outcomes.get("received", 0),
+                "accepted": outcomes.get("accepted", 0),
+                "filtered": {
+                    outcome[len(filtered_prefix) :]: count
+                    for outcome, count in outcomes.items()
+                    if outcome.startswith(filtered_prefix)
+                },
+            },
+        }
+
+    def _get_pending_join_count(self) -> int:
+        """Returns the number of joins that are waiting or running."""
+        return self._get_waiting_join_count() + self._join_scheduler.in_flight_count
+
+    def _get_waiting_join_count(self) -> int:
+        """Returns the number of joins that are waiting to be started or retried."""
+        return (
+            self._join_scheduler.queued_count
+            + self._join_scheduler.delayed_count
+            + self._fan_out.waiting_count
+        )
+
+    def _is_handled_by_this_worker(self, user_id: str) -> bool:
+        """Checks whether invites for the given local user are accepted by this worker
+        rather than by one of the other workers listed in the configuration.
+        """
+        if self._shard_count == 1:
+            return True
+
+        # This needs to give the same result on every worker, so we can't use Python's
+        # built-in hash(), which is salted differently in each process.
+        shard = zlib.crc32(user_id.encode("utf-8")) % self._shard_count
+        return shard == self._shard_index
+
+    def _get_destination(self, inviter: str, is_from_local_user: bool) -> Optional[str]:
+        """Returns the remote server a join for an invite sent by the given user is
+        expected to go through, or None if the inviter is a local user.
+        """
+        if is_from_local_user:
+            return None
+        return UserID.from_string(inviter).domain
+
+    def _save_pending_join(self, job: JoinJob) -> None:
+        """Saves the current state of the given job to the database, if configured to
+        do so.
+        """
+        if self._pending_join_store is None:
+            return
+
+        self._pending_join_store.save(
+            PendingJoin(
+                user_id=job.user_id,
+                room_id=job.room_id,
+                inviter=job.inviter,
+                is_direct_message=job.is_direct_message,
+                attempts=job.attempts,
+                next_attempt_at=job.next_attempt_at,
+                queued_at=job.queued_at,
             )
+        )
+
+    async def _resume_pending_joins(self, store: PendingJoinStore) -> None:
+        """Reschedules the joins that were still pending when this process last
+        stopped.
+        """
+        resumed = 0
+        after: Optional[Tuple[str, str]] = None
+        while True:
+            pending_joins = await store.get_pending_joins(after, RESUME_BATCH_SIZE)
+
+            for pending_join in pending_joins:
+                if not self._is_handled_by_this_worker(pending_join.user_id):
+                    # Another worker will pick this one up.
+                    continue
 
-            if is_direct_message:
-                # Mark this room as a direct message!
-                await self._mark_room_as_direct_message(
-                    event.state_key, event.sender, event.room_id
+                self._fan_out.schedule(
+                    JoinJob(
+                        user_id=pending_join.user_id,
+                        inviter=pending_join.inviter,
+                        room_id=pending_join.room_id,
+                        is_direct_message=pending_join.is_direct_message,
+                        destination=self._get_destination(
+                            pending_join.inviter,
+                            self._api.is_mine(pending_join.inviter),
+                        ),
+                        attempts=pending_join.attempts,
+                        next_attempt_at=pending_join.next_attempt_at,
+                        queued_at=pending_join.queued_at,
+                        # The room's stripped state isn't saved, so we can't tell
+                        # whether it's large.
+                        lane=self._get_lane(
+                            pending_join.is_direct_message,
+                            self._api.is_mine(pending_join.inviter),
+                            None,
+                        ),
+                    )
                 )
+                resumed += 1
 
-    async def _mark_room_as_direct_message(
-        self, user_id: str, dm_user_id: str, room_id: str
-    ) -> None:
-        """
-        Marks a room (`room_id`) as a direct message with the counterparty `dm_user_id`
-        from the perspective of the user `user_id`.
+            if len(pending_joins) < RESUME_BATCH_SIZE:
+                break
+            after = (pending_joins[-1].user_id, pending_joins[-1].room_id)
+
+        if resumed:
+            logger.info("Resumed %d pending join(s)", resumed)
+
+    async def _sweep_missed_invites(self) -> None:
+        """Goes through the invites local users haven't responded to yet, e.g. because
+        they were received while this module wasn't running, and accepts the ones that
+        the configuration allows.
+
+        Invites are processed in batches, with a pause between batches. The sweep also
+        waits for the join queue to drain before fetching the next batch, so that it
+        doesn't hold up invites coming in live.
         """
+        logger.info("Looking for outstanding invites to accept")
+
+        processed = 0
+        accepted = 0
+        after: Optional[Tuple[str, str]] = None
+        while True:
+            while self._get_waiting_join_count() >= self._config.sweep_batch_size:
+                await self._api.sleep(self._config.sweep_batch_interval)
 
-        # This is a dict of User IDs to tuples of Room IDs
-        # (get_global will return a frozendict of tuples as it freezes the data,
-        # but we should accept either frozen or unfrozen variants.)
-        # Be careful: we convert the outer frozendict into a dict here,
-        # but the contents of the dict are still frozen (tuples in lieu of lists,
-        # etc.)
-        dm_map: Dict[str, Tuple[str, ...]] = dict(
-            await self._api.account_data_manager.get_global(
-                user_id, ACCOUNT_DATA_DIRECT_MESSAGE_LIST
+            invites = await get_outstanding_invites(
+                self._api, after, self._config.sweep_batch_size
             )
-            or {}
+
+            for invite in invites:
+                if self._maybe_accept_invite(
+                    invite.user_id,
+                    invite.inviter,
+                    invite.room_id,
+                    invite.content,
+                    invite.room_version,
+                    invite.invite_room_state,
+                ):
+                    accepted += 1
+                    swept_invites.labels("accepted").inc()
+                else:
+                    swept_invites.labels("filtered").inc()
+            processed += len(invites)
+
+            if len(invites) < self._config.sweep_batch_size:
+                break
+            after = (invites[-1].user_id, invites[-1].room_id)
+
+            logger.info(
+                "Looked at %d outstanding invite(s) so far, accepting %d",
+                processed,
+                accepted,
+            )
+            await self._api.sleep(self._config.sweep_batch_interval)
+
+        logger.info(
+            "Finished looking for outstanding invites: looked at %d, accepting %d",
+            processed,
+            accepted,
         )
 
-        if dm_user_id not in dm_map:
-            dm_map[dm_user_id] = (room_id,)
+    async def _accept_invite(self, job: JoinJob) -> None:
+        """Makes a local user join a room they've been invited to then, if the invite
+        was for a direct message, marks the room as such in their account data.
+
+        Args:
+            job: the invite to accept
+        """
+        parked = False
+        joined = False
+        try:
+            joined = await self._join_and_mark_room(job)
+        except (CircuitOpenError, RetryLaterError):
+            # The scheduler will start the job again later, so it's still pending.
+            parked = True
+            raise
+        finally:
+            if not parked:
+                if self._pending_join_store is not None:
+                    self._pending_join_store.remove(job.user_id, job.room_id)
+
+                # Let the other users invited to the room join it, if they were waiting
+                # for this one.
+                self._fan_out.on_join_completed(job, joined)
+
+            # Stop shedding load as soon as enough joins have completed, rather than
+            # when the next invite comes in. This job still counts as running, but
+            # is about to stop being pending unless it was parked or is to be retried.
+            pending_join_count = self._get_pending_join_count()
+            if not parked:
+                pending_join_count -= 1
+            self._load_shedder.update(pending_join_count)
+
+    async def _join_and_mark_room(self, job: JoinJob) -> bool:
+        """Makes a local user join a room, then marks it as a direct message if needed.
+
+        Returns:
+            Whether the user is in the room.
+        """
+        if await self._is_joined(job.user_id, job.room_id):
+            # The user is already in the room (e.g. because their client joined it
+            # already), so there's no need to spend a join on it.
+            logger.debug(
+                "%s is already in %s, not joining it again", job.user_id, job.room_id
+            )
+            skipped_joins.inc()
         else:
-            dm_rooms_for_user = dm_map[dm_user_id]
-            if not isinstance(dm_rooms_for_user, (tuple, list)):
-                # Don't mangle the data if we don't understand it.
+            with measure_stage(
+                "join",
+                self._api.get_current_time_msec,
+                not_failures=(CircuitOpenError, RetryLaterError),
+            ), self._profiler.invocation(
+                "join", job.user_id, job.room_id, capture=False
+            ) as invocation:
+                join_event = await self._retry_make_join(job, invocation)
+
+            if join_event is None:
+                stage_failures.labels("join").inc()
                 logger.warning(
-                    "Not marking room as DM for auto-accepted invitation; "
-                    "dm_map[%r] is a %s not a list.",
-                    type(dm_rooms_for_user),
-                    dm_user_id,
+                    "Failed to auto-accept invite for %s into %s, giving up",
+                    job.user_id,
+                    job.room_id,
                 )
-                return
+                return False
 
-            dm_map[dm_user_id] = tuple(dm_rooms_for_user) + (room_id,)
+            invite_to_join_duration.observe(
+                (self._api.get_current_time_msec() - job.queued_at) / 1000
+            )
 
-        await self._api.account_data_manager.put_global(
-            user_id, ACCOUNT_DATA_DIRECT_MESSAGE_LIST, dm_map
-        )
+        if job.is_direct_message:
+            # Mark this room as a direct message! This is written to the user's
+            # account data in the background, batched with any other room to mark for
+            # them.
+            self._direct_message_marker.mark_room_as_direct_message(
+                job.user_id, job.inviter, job.room_id
+            )
+
+        return True
+
+    async def _is_joined(self, user_id: str, room_id: str) -> bool:
+        """Checks whether the given local user is currently joined to the given room,
+        according to the room's current state on this homeserver.
+        """
+        try:
+            state = await self._api.get_room_state(
+                room_id, [("m.room.member", user_id)]
+            )
+        except Exception:
+            logger.exception(
+                "Failed to look up the membership of %s in %s", user_id, room_id
+            )
+            return False
+
+        member_event = state.get(("m.room.member", user_id))
+        return member_event is not None and member_event.membership == "join"
 
     async def _retry_make_join(
-        self, sender: str, target: str, room_id: str, new_membership: str
-    ) -> None:
+        self, job: JoinJob, invocation: Invocation = DISABLED_INVOCATION
+    ) -> Optional[EventBase]:
         """
-        A function to retry sending the `make_join` request with an increasing backoff. This is
-        implemented to work around a race condition when receiving invites over federation.
+        A function to attempt sending the `make_join` request, and to schedule retrying
+        it according to the configured retry policy if it fails. This is implemented to
+        work around a race condition when receiving invites over federation.
+
+        Retries aren't waited for here: the job is handed back to the scheduler by
+        raising `RetryLaterError`, so that it doesn't hold a join slot while backing
+        off. The number of failed attempts and the time of the next attempt are tracked
+        on the job (and saved to the database if configured to do so), so that a job
+        resumed after a restart carries on from where it was.
 
         Args:
-            sender: the user performing the membership change
-            target: the for whom the membership is changing
-            room_id: room id of the room to join to
-            new_membership: the type of membership event (in this case will be "join")
+            job: the invite to accept
+            invocation: the invocation to record the time spent attempting to join
+                in, if it's being profiled
+
+        Returns:
+            The membership event, or None if the join failed permanently or the retry
+            policy gave up on it.
+
+        Raises:
+            CircuitOpenError: if the circuit for the server the join goes through is
+                open.
+            RetryLaterError: if the attempt failed and should be retried at the job's
+                `next_attempt_at`.
         """
+        policy = self._config.join_retry_policy
+        is_from_remote_user = job.destination is not None
+
+        with self._tracer.span(
+            "join_attempt", job.user_id, job.room_id, attempt=job.attempts + 1
+        ):
+            # Don't add to the load of a server that looks down, unless this attempt
+            # is the one probing it.
+            if not self._circuit_breaker.start_attempt(
+                job.destination, self._api.get_current_time_msec()
+            ):
+                raise CircuitOpenError(job.destination)
 
-        sleep = 0
-        retries = 0
-        join_event = None
+            if job.attempts:
+                join_retries.labels("remote" if is_from_remote_user else "local").inc()
 
-        while retries < 5:
+            error: Optional[Exception] = None
             try:
-                await self._api.sleep(sleep)
                 join_event = await self._api.update_room_membership(
-                    sender=sender,
-                    target=target,
-                    room_id=room_id,
-                    new_membership=new_membership,
+                    sender=job.user_id,
+                    target=job.user_id,
+                    room_id=job.room_id,
+                    new_membership="join",
                 )
             except Exception as e:
+                join_event = None
+                error = e
+            invocation.lap("join_attempt")
+
+            if join_event is not None:
+                self._circuit_breaker.record_success(job.destination)
+                join_attempts.labels("success").inc()
+                return join_event
+
+            job.attempts += 1
+            now = self._api.get_current_time_msec()
+            elapsed = (now - job.queued_at) / 1000
+
+            if is_server_failure(error):
+                self._circuit_breaker.record_failure(job.destination, now)
+            else:
+                # The server answered, it just won't let the user in (or not yet).
+                self._circuit_breaker.record_success(job.destination)
+
+            if error is not None and policy.is_permanent_failure(
+                error, elapsed, is_from_remote_user
+            ):
+                join_attempts.labels("permanent_failure").inc()
                 logger.info(
-                    f"Update_room_membership raised the following exception: {e}"
+                    "Failed to make %s join %s (attempt %d), not retrying: %s",
+                    job.user_id,
+                    job.room_id,
+                    job.attempts,
+                    error,
                 )
-                sleep = 2**retries
-                retries += 1
+                return None
 
-            if join_event is not None:
-                break
+            join_attempts.labels("failure").inc()
+            logger.info(
+                "Failed to make %s join %s (attempt %d): %s",
+                job.user_id,
+                job.room_id,
+                job.attempts,
+                error if error is not None else "no membership event returned",
+            )
+
+            delay = policy.get_next_delay(
+                job.attempts,
+                elapsed,
+                in_race_window=error is not None
+                and policy.is_federation_race(error, elapsed, is_from_remote_user),
+            )
+            if delay is None:
+                return None
+
+            job.next_attempt_at = now + int(delay * 1000)
+            # The wait until then isn't covered by any span, as the job is handed back
+            # to the scheduler in the meantime, so record it on this attempt's span.
+            self._tracer.set_tag("retry_delay", f"{delay:.3f}")
+            self._save_pending_join(job)
+            raise RetryLaterError()
@@ -0,0 +1,166 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import itertools
+import logging
+from typing import Dict, Optional
+
+import attr
+from synapse.module_api import JsonDict
+
+from synapse_auto_accept_invite.metrics import open_circuits
+
+logger = logging.getLogger(__name__)
+
+
+def is_server_failure(error: Optional[Exception]) -> bool:
+    """Checks whether a failed attempt at joining means the server it went through
+    couldn't be reached or failed to handle it (e.g. a timeout, a connection error or
+    a 5xx error), as opposed to the server answering with a client error, such as the
+    403 or 404 of an invite that went out over federation before its room was ready.
+    """
+    if error is None:
+        return False
+    code = getattr(error, "code", None)
+    return not isinstance(code, int) or code >= 500
+
+
+class CircuitOpenError(Exception):
+    """Raised when a join can't be attempted because the circuit for the server it
+    goes through is open.
+    """
+
+    def __init__(self, server: Optional[str]):
+        super().__init__(f"Circuit for {server} is open")
+        self.server = server
+
+
+@attr.s(auto_attribs=True, slots=True)
+class _ServerState:
+    # How many attempts at joining through the server failed in a row.
+    consecutive_failures: int = 0
+    # When the server can be probed again, in milliseconds, or None if the circuit is
+    # closed.
+    open_until: Optional[int] = None
+    # Whether a probe join is currently being attempted.
+    probing: bool = False
+
+
+class CircuitBreaker:
+    """Keeps track of which remote servers joins are failing through, to stop sending
+    joins to servers that look down.
+
+    Once `failure_threshold` attempts in a row have failed for a server, its circuit
+    opens: no join is attempted through it for `reset_timeout_ms` milliseconds. After
+    that, a single join is let through as a probe. If it succeeds, the circuit closes
+    again, otherwise it stays open for another `reset_timeout_ms` milliseconds.
+
+    Joins for invites from local users (for which the server is None) are never held
+    back. A `failure_threshold` of 0 disables the circuit breaker.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout_ms: int):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout_ms = reset_timeout_ms
+
+        # The servers for which the last attempt at joining failed.
+        self._states: Dict[str, _ServerState] = {}
+
+    def get_snapshot(self, now_ms: int, max_servers: int) -> JsonDict:
+        """Returns a description of the servers joins recently failed through, for
+        introspection. Only the first `max_servers` servers, from the one that has
+        been failing the longest, are listed.
+        """
+        return {
+            "failing_servers": len(self._states),
+            "servers": {
+                server: {
+                    "consecutive_failures": state.consecutive_failures,
+                    "open": self.is_open(server, now_ms),
+                    "open_until": state.open_until,
+                    "probing": state.probing,
+                }
+                for server, state in itertools.islice(self._states.items(), max_servers)
+            },
+        }
+
+    def is_open(self, server: Optional[str], now_ms: int) -> bool:
+        """Checks whether joins through the given server are currently held back,
+        i.e. its circuit is open and either can't be probed yet or is being probed.
+        """
+        return self.get_retry_time(server, now_ms) is not None
+
+    def get_retry_time(self, server: Optional[str], now_ms: int) -> Optional[int]:
+        """Returns when to check again whether joins through the given server can be
+        attempted, in milliseconds, or None if they can be attempted now.
+        """
+        state = self._states.get(server) if server is not None else None
+        if state is None or state.open_until is None:
+            return None
+
+        if state.probing:
+            # We'll know more once the probe completes.
+            return now_ms + self._reset_timeout_ms
+        if now_ms < state.open_until:
+            return state.open_until
+        return None
+
+    def start_attempt(self, server: Optional[str], now_ms: int) -> bool:
+        """Checks whether a join through the given server can be attempted now. If the
+        circuit is open but can be probed, the attempt becomes the probe.
+
+        Every attempt this returns True for must be followed by a call to
+        `record_success` or `record_failure`.
+        """
+        if self.is_open(server, now_ms):
+            return False
+
+        state = self._states.get(server) if server is not None else None
+        if state is not None and state.open_until is not None:
+            logger.info("Probing %s with a join", server)
+            state.probing = True
+        return True
+
+    def record_success(self, server: Optional[str]) -> None:
+        """Records that an attempt at joining through the given server reached it."""
+        if server is None:
+            return
+
+        state = self._states.pop(server, None)
+        if state is not None and state.open_until is not None:
+            logger.info("%s is reachable again, closing its circuit", server)
+            open_circuits.dec()
+
+    def record_failure(self, server: Optional[str], now_ms: int) -> None:
+        """Records that an attempt at joining through the given server failed."""
+        if server is None or self._failure_threshold <= 0:
+            return
+
+        state = self._states.get(server)
+        if state is None:
+            state = self._states[server] = _ServerState()
+
+        state.consecutive_failures += 1
+        if state.open_until is None:
+            if state.consecutive_failures < self._failure_threshold:
+                return
+            logger.warning(
+                "%d join(s) in a row failed through %s, holding back joins for %.1fs",
+                state.consecutive_failures,
+                server,
+                self._reset_timeout_ms / 1000,
+            )
+            open_circuits.inc()
+
+        state.open_until = now_ms + self._reset_timeout_ms
+        state.probing = False
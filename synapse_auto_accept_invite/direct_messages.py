@@ -0,0 +1,238 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import itertools
+import logging
+from typing import Dict, FrozenSet, List, Set, Tuple
+
+from synapse.module_api import JsonDict, ModuleApi, run_as_background_process
+
+from synapse_auto_accept_invite.metrics import measure_stage
+from synapse_auto_accept_invite.profiling import (
+    DISABLED_INVOCATION,
+    Invocation,
+    Profiler,
+)
+from synapse_auto_accept_invite.store import get_left_rooms
+from synapse_auto_accept_invite.tracing import Tracer
+
+logger = logging.getLogger(__name__)
+ACCOUNT_DATA_DIRECT_MESSAGE_LIST = "m.direct"
+
+
+class DirectMessageMarker:
+    """Marks rooms as direct messages in users' `m.direct` account data.
+
+    Rooms to mark are buffered per user for a short while, and then written in a single
+    read-modify-write of the user's `m.direct` account data. At most one write is in
+    progress for a given user at any time, so concurrent invites for the same user
+    can't overwrite each other's changes.
+
+    Every write starts from the user's current `m.direct` content as returned by the
+    homeserver (which caches it), rather than from a copy kept by this module: account
+    data updates made by clients are only reported on the worker that handles them,
+    so a copy kept here could be stale and overwrite them.
+
+    Writes can also compact the account data, by removing the rooms the user has left
+    and only keeping the most recent rooms for each counterparty, so that the account
+    data of users receiving many direct message invites (e.g. bots) stays small.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        batch_interval: float,
+        tracer: Tracer,
+        profiler: Profiler,
+        max_rooms_per_counterparty: int = 0,
+        remove_left_rooms: bool = False,
+    ):
+        self._api = api
+        self._tracer = tracer
+        self._profiler = profiler
+        self._max_rooms_per_counterparty = max_rooms_per_counterparty
+        self._remove_left_rooms = remove_left_rooms
+        self._batch_interval = batch_interval
+
+        # The rooms waiting to be marked as direct messages, as a map of user ID to a
+        # map of the counterparty's user ID to room IDs.
+        self._pending: Dict[str, Dict[str, List[str]]] = {}
+
+        # The users for which a background process is currently writing to `m.direct`.
+        self._writing: Set[str] = set()
+
+    def get_snapshot(self, max_users: int) -> JsonDict:
+        """Returns a description of the pending `m.direct` writes, for introspection.
+        Only the first `max_users` users with rooms waiting to be marked are listed.
+        """
+        return {
+            "pending_users": len(self._pending),
+            "writing_users": len(self._writing),
+            "users": list(itertools.islice(self._pending, max_users)),
+        }
+
+    def mark_room_as_direct_message(
+        self, user_id: str, dm_user_id: str, room_id: str
+    ) -> None:
+        """
+        Schedules marking a room (`room_id`) as a direct message with the counterparty
+        `dm_user_id` from the perspective of the user `user_id`.
+        """
+        self._pending.setdefault(user_id, {}).setdefault(dm_user_id, []).append(room_id)
+
+        if user_id not in self._writing:
+            self._writing.add(user_id)
+            run_as_background_process(
+                "auto_accept_invite_mark_direct_messages",
+                self._write_pending,
+                user_id,
+                bg_start_span=self._tracer.enabled,
+            )
+
+    async def _write_pending(self, user_id: str) -> None:
+        """Waits for more rooms to mark to come in, then writes all of the rooms pending
+        for the given user to their `m.direct` account data. Repeats until there's
+        nothing left to write.
+        """
+        try:
+            while True:
+                await self._api.sleep(self._batch_interval)
+
+                additions = self._pending.pop(user_id, None)
+                if not additions:
+                    return
+
+                try:
+                    with measure_stage(
+                        "mark_direct_message", self._api.get_current_time_msec
+                    ), self._profiler.invocation(
+                        "mark_direct_messages", user_id, capture=False
+                    ) as invocation:
+                        await self._add_direct_message_rooms(
+                            user_id, additions, invocation
+                        )
+                except Exception:
+                    logger.exception(
+                        "Failed to mark rooms as direct messages for %s: %r",
+                        user_id,
+                        additions,
+                    )
+        finally:
+            self._writing.discard(user_id)
+
+    async def _add_direct_message_rooms(
+        self,
+        user_id: str,
+        additions: Dict[str, List[str]],
+        invocation: Invocation = DISABLED_INVOCATION,
+    ) -> None:
+        """Adds rooms to the `m.direct` account data of the given user.
+
+        Args:
+            user_id: the user whose account data to update
+            additions: a map of counterparty user IDs to the rooms to add for them
+            invocation: the invocation to record the time spent in each step in, if
+                it's being profiled
+        """
+        # This is a dict of User IDs to tuples of Room IDs
+        # (get_global will return a frozendict of tuples as it freezes the data,
+        # but we should accept either frozen or unfrozen variants.)
+        # Be careful: we convert the outer frozendict into a dict here,
+        # but the contents of the dict are still frozen (tuples in lieu of lists,
+        # etc.)
+        with self._tracer.span("read_direct_messages", user_id):
+            dm_content = (
+                await self._api.account_data_manager.get_global(
+                    user_id, ACCOUNT_DATA_DIRECT_MESSAGE_LIST
+                )
+                or {}
+            )
+
+        invocation.lap("read")
+
+        dm_map: Dict[str, Tuple[str, ...]] = dict(dm_content)
+
+        changed = False
+        # Only this part is captured with cProfile, as the rest waits on I/O.
+        with self._profiler.capture("mark_direct_messages_merge"):
+            for dm_user_id, room_ids in additions.items():
+                dm_rooms_for_user = dm_map.get(dm_user_id, ())
+                if not isinstance(dm_rooms_for_user, (tuple, list)):
+                    # Don't mangle the data if we don't understand it.
+                    logger.warning(
+                        "Not marking room as DM for auto-accepted invitation; "
+                        "dm_map[%r] is a %s not a list.",
+                        dm_user_id,
+                        type(dm_rooms_for_user),
+                    )
+                    continue
+
+                # Merge through a dict, which keeps the rooms in order while dropping
+                # the ones already in the list (as well as any duplicate already in
+                # it), so marking the same room again doesn't change anything.
+                merged = tuple(
+                    dict.fromkeys(itertools.chain(dm_rooms_for_user, room_ids))
+                )
+                if merged != tuple(dm_rooms_for_user):
+                    dm_map[dm_user_id] = merged
+                    changed = True
+
+        invocation.lap("merge")
+
+        left_rooms: FrozenSet[str] = frozenset()
+        if self._remove_left_rooms:
+            left_rooms = await get_left_rooms(self._api, user_id)
+        if left_rooms or self._max_rooms_per_counterparty:
+            if _compact(dm_map, left_rooms, self._max_rooms_per_counterparty):
+                changed = True
+        invocation.lap("compact")
+
+        if not changed:
+            return
+
+        with self._tracer.span("write_direct_messages", user_id):
+            await self._api.account_data_manager.put_global(
+                user_id, ACCOUNT_DATA_DIRECT_MESSAGE_LIST, dm_map
+            )
+        invocation.lap("write")
+
+
+def _compact(
+    dm_map: Dict[str, Tuple[str, ...]], left_rooms: FrozenSet[str], max_rooms: int
+) -> bool:
+    """Removes the given rooms from a `m.direct` map, then keeps at most `max_rooms`
+    of the most recently added rooms for each counterparty (if `max_rooms` isn't 0).
+    Counterparties left without rooms are removed.
+
+    Returns:
+        Whether the map was changed.
+    """
+    changed = False
+    for dm_user_id, room_ids in list(dm_map.items()):
+        if not isinstance(room_ids, (tuple, list)):
+            continue
+
+        kept = tuple(room_id for room_id in room_ids if room_id not in left_rooms)
+        if max_rooms and len(kept) > max_rooms:
+            kept = kept[-max_rooms:]
+
+        if kept == tuple(room_ids):
+            continue
+
+        changed = True
+        if kept:
+            dm_map[dm_user_id] = kept
+        else:
+            del dm_map[dm_user_id]
+
+    return changed
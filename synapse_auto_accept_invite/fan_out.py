@@ -0,0 +1,172 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+from collections import OrderedDict
+from typing import Dict
+
+import attr
+from synapse.module_api import JsonDict, ModuleApi, run_as_background_process
+
+from synapse_auto_accept_invite.metrics import deduplicated_joins, fan_out_waiting
+from synapse_auto_accept_invite.scheduler import JoinJob, JoinScheduler
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s(auto_attribs=True, slots=True)
+class _RoomFanOut:
+    # The job currently trying to join the room first.
+    leader: JoinJob
+    # The jobs waiting for the leader to join the room, keyed by user ID, in the order
+    # they should be scheduled.
+    followers: "OrderedDict[str, JoinJob]" = attr.Factory(OrderedDict)
+
+
+class FanOutCoordinator:
+    """Coordinates joins for several local users invited to the same remote room.
+
+    Only one of them (the leader) is scheduled at first. The others wait until it has
+    joined the room, after which joining it no longer needs to go over federation, and
+    are then scheduled in batches of `batch_size` every `batch_interval` seconds. If the
+    leader fails to join the room, the next user in line becomes the leader.
+
+    Joins for invites from local users, which don't go over federation, are scheduled
+    straight away, as are all joins if `batch_size` is 0.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        scheduler: JoinScheduler,
+        batch_size: int,
+        batch_interval: float,
+        bg_start_span: bool = False,
+    ):
+        self._api = api
+        self._bg_start_span = bg_start_span
+        self._scheduler = scheduler
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+
+        # The remote rooms with a leader, keyed by room ID.
+        self._rooms: Dict[str, _RoomFanOut] = {}
+        self._waiting_count = 0
+
+    @property
+    def waiting_count(self) -> int:
+        """The number of jobs waiting for another user to join their room."""
+        return self._waiting_count
+
+    def get_snapshot(self) -> JsonDict:
+        """Returns a description of the jobs waiting on another user, for
+        introspection.
+        """
+        return {"waiting": self._waiting_count, "rooms": len(self._rooms)}
+
+    def schedule(self, job: JoinJob) -> JoinJob:
+        """Schedules a job, or has it wait for the leader for its room to join the room.
+
+        Returns:
+            The job that will handle the invite: either the given job, or an existing
+            job for the same user and room it was merged into.
+        """
+        if job.destination is None or self._batch_size <= 0:
+            return self._scheduler.schedule(job)
+
+        room = self._rooms.get(job.room_id)
+        if room is None:
+            # Register the room before scheduling the job, in case it completes
+            # straight away.
+            room = self._rooms[job.room_id] = _RoomFanOut(leader=job)
+            room.leader = self._scheduler.schedule(job)
+            return room.leader
+
+        if job.user_id == room.leader.user_id:
+            return self._scheduler.schedule(job)
+
+        existing_job = room.followers.get(job.user_id)
+        if existing_job is not None:
+            deduplicated_joins.inc()
+            existing_job.merge(job)
+            return existing_job
+
+        room.followers[job.user_id] = job
+        self._waiting_count += 1
+        fan_out_waiting.inc()
+        return job
+
+    def on_join_completed(self, job: JoinJob, joined: bool) -> None:
+        """Lets the jobs waiting for the given job go ahead if it was the leader for its
+        room.
+
+        Args:
+            job: the job that has completed.
+            joined: whether the job's user has joined the room.
+        """
+        room = self._rooms.get(job.room_id)
+        if room is None or room.leader is not job:
+            return
+
+        if joined:
+            if room.followers:
+                logger.info(
+                    "%s joined %s, scheduling the %d other invite(s) to it",
+                    job.user_id,
+                    job.room_id,
+                    len(room.followers),
+                )
+                run_as_background_process(
+                    "auto_accept_invite_fan_out",
+                    self._release_followers,
+                    job.room_id,
+                    room,
+                    bg_start_span=self._bg_start_span,
+                )
+            else:
+                del self._rooms[job.room_id]
+            return
+
+        if not room.followers:
+            del self._rooms[job.room_id]
+            return
+
+        # Let the next user in line have a go.
+        _, room.leader = room.followers.popitem(last=False)
+        self._waiting_count -= 1
+        fan_out_waiting.dec()
+        room.leader = self._scheduler.schedule(room.leader)
+
+    async def _release_followers(self, room_id: str, room: _RoomFanOut) -> None:
+        """Schedules the jobs waiting for the leader of the given room in batches."""
+        try:
+            while True:
+                self._release_batch(room, self._batch_size)
+                if not room.followers:
+                    break
+                await self._api.sleep(self._batch_interval)
+        finally:
+            # Don't leave any job behind if we were interrupted.
+            self._release_batch(room, len(room.followers))
+            del self._rooms[room_id]
+
+    def _release_batch(self, room: _RoomFanOut, count: int) -> None:
+        for _ in range(min(count, len(room.followers))):
+            _, job = room.followers.popitem(last=False)
+            self._waiting_count -= 1
+            fan_out_waiting.dec()
+
+            # This server is in the room now, so the join doesn't need to go over
+            # federation.
+            job.destination = None
+            self._scheduler.schedule(job)
@@ -0,0 +1,91 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+from collections import deque
+from typing import Callable, Counter, Deque, Dict, Tuple
+
+from synapse.module_api import (
+    DirectServeJsonResource,
+    JsonDict,
+    ModuleApi,
+    SynapseRequest,
+)
+from synapse.module_api.errors import Codes, SynapseError
+
+# How many items of each kind (e.g. jobs, servers) to list in a snapshot of the
+# module's state. Only counts are given for the rest, so that serving a snapshot
+# doesn't get slower as the module's backlog grows.
+SNAPSHOT_MAX_ITEMS = 100
+
+
+class RecentCounts:
+    """Counts occurrences of things by kind over the last `bucket_count` periods of
+    `bucket_ms` milliseconds.
+
+    Counts are kept per period, so memory use and the cost of reading the counts only
+    depend on the number of periods and of kinds, not on how many things were counted.
+
+    Times are in milliseconds, and are provided by the caller so that the counts follow
+    the homeserver's clock.
+    """
+
+    def __init__(self, bucket_ms: int, bucket_count: int):
+        self._bucket_ms = bucket_ms
+        self._bucket_count = bucket_count
+
+        # The counts for the most recent periods, from oldest to newest, with the
+        # index of the period they're for.
+        self._buckets: Deque[Tuple[int, Counter[str]]] = deque(maxlen=bucket_count)
+
+    @property
+    def window_ms(self) -> int:
+        """How far back, in milliseconds, the counts go."""
+        return self._bucket_ms * self._bucket_count
+
+    def record(self, kind: str, now_ms: int) -> None:
+        """Counts one occurrence of the given kind of thing."""
+        period = now_ms // self._bucket_ms
+        if not self._buckets or self._buckets[-1][0] != period:
+            self._buckets.append((period, collections.Counter()))
+        self._buckets[-1][1][kind] += 1
+
+    def get_counts(self, now_ms: int) -> Dict[str, int]:
+        """Returns how many times each kind of thing was counted over the window."""
+        oldest_period = now_ms // self._bucket_ms - self._bucket_count + 1
+        totals: Counter[str] = collections.Counter()
+        for period, counts in self._buckets:
+            if period >= oldest_period:
+                totals.update(counts)
+        return dict(totals)
+
+
+class IntrospectionResource(DirectServeJsonResource):
+    """Serves a snapshot of the module's state to server admins, as JSON.
+
+    Args:
+        api: the module API, used to authenticate requests.
+        get_snapshot: returns the snapshot to serve.
+    """
+
+    def __init__(self, api: ModuleApi, get_snapshot: Callable[[], JsonDict]):
+        super().__init__()
+        self._api = api
+        self._get_snapshot = get_snapshot
+
+    async def _async_render_GET(self, request: SynapseRequest) -> Tuple[int, JsonDict]:
+        requester = await self._api.get_user_by_req(request)
+        if not await self._api.is_user_admin(requester.user.to_string()):
+            raise SynapseError(403, "You are not a server admin", Codes.FORBIDDEN)
+
+        return 200, self._get_snapshot()
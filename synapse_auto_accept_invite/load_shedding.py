@@ -0,0 +1,81 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+
+from synapse_auto_accept_invite.metrics import load_shedding
+
+logger = logging.getLogger(__name__)
+
+# While shedding load, don't accept any invite.
+LOAD_SHEDDING_MODE_REJECT_ALL = "reject_all"
+# While shedding load, only accept invites for direct messages and invites from local
+# users.
+LOAD_SHEDDING_MODE_PRIORITY_ONLY = "priority_only"
+
+LOAD_SHEDDING_MODES = (LOAD_SHEDDING_MODE_REJECT_ALL, LOAD_SHEDDING_MODE_PRIORITY_ONLY)
+
+
+class LoadShedder:
+    """Stops accepting invites while too many joins are pending.
+
+    Load shedding starts once the number of pending joins reaches the high-water mark,
+    and stops once it has dropped below the low-water mark, so that the module doesn't
+    flip between the two states with every join. A high-water mark of 0 disables load
+    shedding.
+    """
+
+    def __init__(self, high_water_mark: int, low_water_mark: int, mode: str):
+        self._high_water_mark = high_water_mark
+        self._low_water_mark = low_water_mark
+        self._mode = mode
+        self._shedding = False
+
+    @property
+    def shedding(self) -> bool:
+        """Whether load is currently being shed."""
+        return self._shedding
+
+    def update(self, pending_joins: int) -> None:
+        """Starts or stops shedding load according to the current number of pending
+        joins.
+        """
+        if self._high_water_mark <= 0:
+            return
+
+        if not self._shedding and pending_joins >= self._high_water_mark:
+            logger.warning(
+                "%d joins pending, shedding load (%s) until fewer than %d are",
+                pending_joins,
+                self._mode,
+                self._low_water_mark,
+            )
+            self._shedding = True
+            load_shedding.set(1)
+        elif self._shedding and pending_joins < self._low_water_mark:
+            logger.info("%d joins pending, no longer shedding load", pending_joins)
+            self._shedding = False
+            load_shedding.set(0)
+
+    def should_accept(self, pending_joins: int, is_priority: bool) -> bool:
+        """Checks whether a new invite can be accepted.
+
+        Args:
+            pending_joins: the number of joins currently queued or running.
+            is_priority: whether the invite is for a direct message or from a local
+                user.
+        """
+        self.update(pending_joins)
+        if not self._shedding:
+            return True
+        return is_priority and self._mode == LOAD_SHEDDING_MODE_PRIORITY_ONLY
@@ -0,0 +1,151 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from contextlib import contextmanager
+from typing import Callable, Iterator, Tuple, Type
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Synapse exposes the default Prometheus registry on its metrics endpoint, so metrics
+# registered here are served alongside Synapse's own.
+
+invites_received = Counter(
+    "synapse_auto_accept_invite_invites_received_total",
+    "Number of invites for local users handled by this worker",
+)
+
+invites_filtered = Counter(
+    "synapse_auto_accept_invite_invites_filtered_total",
+    "Number of invites for local users that weren't accepted, by reason",
+    ["reason"],
+)
+
+invites_accepted = Counter(
+    "synapse_auto_accept_invite_invites_accepted_total",
+    "Number of invites scheduled to be accepted",
+)
+
+join_attempts = Counter(
+    "synapse_auto_accept_invite_join_attempts_total",
+    "Number of attempts at joining a room, by outcome",
+    ["outcome"],
+)
+
+join_retries = Counter(
+    "synapse_auto_accept_invite_join_retries_total",
+    "Number of attempts at joining a room following a failed attempt, by whether the "
+    "invite came from a local or a remote user",
+    ["origin"],
+)
+
+invite_to_join_duration = Histogram(
+    "synapse_auto_accept_invite_invite_to_join_seconds",
+    "Time between an invite being scheduled to be accepted and the invitee joining "
+    "the room",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+
+stage_duration = Histogram(
+    "synapse_auto_accept_invite_stage_duration_seconds",
+    "Time spent in each stage of accepting an invite",
+    ["stage"],
+)
+
+stage_failures = Counter(
+    "synapse_auto_accept_invite_stage_failures_total",
+    "Number of times a stage of accepting an invite has failed",
+    ["stage"],
+)
+
+queued_joins = Gauge(
+    "synapse_auto_accept_invite_queued_joins",
+    "Number of joins waiting for a free slot before being started",
+)
+
+joins_in_flight = Gauge(
+    "synapse_auto_accept_invite_joins_in_flight",
+    "Number of joins currently running in the background",
+)
+
+join_queue_wait = Histogram(
+    "synapse_auto_accept_invite_join_queue_wait_seconds",
+    "Time joins spent waiting for a free slot before being started",
+)
+
+deduplicated_joins = Counter(
+    "synapse_auto_accept_invite_deduplicated_joins_total",
+    "Number of invites merged into a join already queued or running for the same "
+    "user and room",
+)
+
+skipped_joins = Counter(
+    "synapse_auto_accept_invite_skipped_joins_total",
+    "Number of joins skipped because the invitee was already in the room",
+)
+
+swept_invites = Counter(
+    "synapse_auto_accept_invite_swept_invites_total",
+    "Number of outstanding invites looked at by the startup sweep, by outcome",
+    ["outcome"],
+)
+
+open_circuits = Gauge(
+    "synapse_auto_accept_invite_open_circuits",
+    "Number of remote servers joins are currently held back for, because too many "
+    "joins through them failed in a row",
+)
+
+parked_joins = Counter(
+    "synapse_auto_accept_invite_parked_joins_total",
+    "Number of times a running join was put back in the queue because the server it "
+    "goes through looks down",
+)
+
+
+fan_out_waiting = Gauge(
+    "synapse_auto_accept_invite_fan_out_waiting_joins",
+    "Number of joins waiting for another local user to join the same remote room "
+    "first",
+)
+
+load_shedding = Gauge(
+    "synapse_auto_accept_invite_load_shedding",
+    "Whether the module is currently shedding load because too many joins are "
+    "pending (1) or not (0)",
+)
+
+
+@contextmanager
+def measure_stage(
+    stage: str,
+    clock: Callable[[], int],
+    not_failures: Tuple[Type[Exception], ...] = (),
+) -> Iterator[None]:
+    """Records how long the wrapped block took in the `stage_duration` histogram, and
+    counts it as a failure of the stage if it raises.
+
+    Args:
+        stage: The name of the stage, used as the metrics label.
+        clock: A function returning the current time in milliseconds.
+        not_failures: The exceptions that don't mean the stage failed.
+    """
+    start = clock()
+    try:
+        yield
+    except not_failures:
+        raise
+    except Exception:
+        stage_failures.labels(stage).inc()
+        raise
+    finally:
+        stage_duration.labels(stage).observe((clock() - start) / 1000)
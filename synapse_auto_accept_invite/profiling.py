@@ -0,0 +1,177 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import cProfile
+import itertools
+import logging
+import os
+import random
+import time
+from typing import ContextManager, Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Invocation:
+    """The time spent in each stage of an invocation being profiled."""
+
+    def __init__(self) -> None:
+        self._last = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    def lap(self, stage: str) -> None:
+        """Records the time since the previous stage ended (or since the invocation
+        started) as spent in the given stage. Time spent in the same stage several
+        times, e.g. once per join attempt, is added up.
+        """
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self._last
+        self._last = now
+
+
+class _DisabledInvocation(Invocation):
+    def __init__(self) -> None:
+        self.stages = {}
+
+    def lap(self, stage: str) -> None:
+        pass
+
+
+# The invocation handed out when profiling is disabled, which doesn't record anything.
+DISABLED_INVOCATION: Invocation = _DisabledInvocation()
+_DISABLED_CONTEXT: ContextManager[Invocation] = contextlib.nullcontext(
+    DISABLED_INVOCATION
+)
+_NO_CAPTURE: ContextManager[None] = contextlib.nullcontext()
+
+
+class Profiler:
+    """Times the stages of the module's invocations, logging the ones that take
+    longer than `slow_threshold` seconds with the time spent in each stage, and
+    capturing a `sample_rate` fraction of them with cProfile into `directory`.
+
+    Only synchronous sections of code are captured, one at a time: cProfile profiles
+    everything that runs on the thread, so capturing code that waits on I/O would
+    also capture whatever else ran on the worker in the meantime.
+
+    If both `slow_threshold` and `sample_rate` are 0, profiling is disabled, and
+    `invocation` returns a context manager that doesn't do anything.
+    """
+
+    def __init__(
+        self, slow_threshold: float, sample_rate: float, directory: Optional[str]
+    ):
+        self._slow_threshold = slow_threshold
+        self._sample_rate = sample_rate
+        self._directory = directory
+        self._enabled = slow_threshold > 0 or sample_rate > 0
+
+        self._capturing = False
+        self._capture_ids = itertools.count()
+
+    def invocation(
+        self,
+        name: str,
+        user_id: str,
+        room_id: Optional[str] = None,
+        capture: bool = True,
+    ) -> ContextManager[Invocation]:
+        """Returns a context manager profiling an invocation for its duration.
+
+        Args:
+            name: the name of the invoked function, used in logs and in the name of
+                the profile files.
+            user_id: the local user the invocation is for.
+            room_id: the room the invocation is about, if any.
+            capture: whether the invocation can be captured with cProfile. Must be
+                False for invocations that wait on I/O, which only get their stages
+                timed.
+        """
+        if not self._enabled:
+            return _DISABLED_CONTEXT
+        return self._profile(name, user_id, room_id, capture)
+
+    def capture(self, name: str) -> ContextManager[None]:
+        """Returns a context manager capturing a synchronous section of code with
+        cProfile, if it's sampled.
+
+        Args:
+            name: the name of the section, used in the name of the profile file.
+        """
+        if not self._sample_rate:
+            return _NO_CAPTURE
+        return self._capture(name)
+
+    @contextlib.contextmanager
+    def _profile(
+        self, name: str, user_id: str, room_id: Optional[str], capture: bool
+    ) -> Iterator[Invocation]:
+        invocation = Invocation()
+        start = time.perf_counter()
+        try:
+            with self.capture(name) if capture else _NO_CAPTURE:
+                yield invocation
+        finally:
+            duration = time.perf_counter() - start
+
+            if self._slow_threshold and duration >= self._slow_threshold:
+                logger.warning(
+                    "Slow %s for %s%s: took %.3fs (%s)",
+                    name,
+                    user_id,
+                    f" in {room_id}" if room_id is not None else "",
+                    duration,
+                    ", ".join(
+                        f"{stage}: {stage_duration:.3f}s"
+                        for stage, stage_duration in invocation.stages.items()
+                    ),
+                )
+
+    @contextlib.contextmanager
+    def _capture(self, name: str) -> Iterator[None]:
+        profile = None
+        if (
+            self._sample_rate
+            and not self._capturing
+            and random.random() < self._sample_rate
+        ):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is running on this thread.
+                profile = None
+            else:
+                self._capturing = True
+
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._capturing = False
+                self._dump(profile, name)
+
+    def _dump(self, profile: cProfile.Profile, name: str) -> None:
+        assert self._directory is not None
+        path = os.path.join(
+            self._directory,
+            f"{name}-{int(time.time() * 1000)}-{os.getpid()}"
+            f"-{next(self._capture_ids)}.prof",
+        )
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            profile.dump_stats(path)
+        except OSError as e:
+            logger.warning("Failed to write profile to %s: %s", path, e)
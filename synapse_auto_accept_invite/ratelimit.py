@@ -0,0 +1,91 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+from typing import Tuple
+
+import attr
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class RateLimit:
+    """A rate, and how many actions can be performed in a burst."""
+
+    per_second: float
+    burst_count: int
+
+
+class TokenBucketLimiter:
+    """Limits how often actions can be performed for each key, using token buckets.
+
+    Each key has a bucket holding up to `burst_count` tokens, refilled at `per_second`
+    tokens per second, and an action takes one token. A bucket that has had time to
+    refill completely behaves the same as no bucket at all, so full buckets are
+    dropped, and at most `max_keys` buckets are kept, the least recently used being
+    dropped first. This means a flood of actions for many different keys can't make
+    the limiter grow without bound, at the cost of the evicted keys starting over with
+    a full bucket.
+
+    Times are in milliseconds, and are provided by the caller so that the limiter
+    follows the homeserver's clock.
+    """
+
+    def __init__(self, limit: RateLimit, max_keys: int):
+        self._limit = limit
+        self._max_keys = max_keys
+
+        # How long it takes for an empty bucket to refill completely.
+        self._refill_ms = limit.burst_count / limit.per_second * 1000
+
+        # Maps keys to a tuple of how many tokens their bucket held and when, from
+        # least to most recently used.
+        self._buckets: "OrderedDict[str, Tuple[float, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def can_perform(self, key: str, now_ms: int) -> bool:
+        """Checks whether an action can be performed for the given key right now,
+        without taking a token.
+        """
+        return self._get_tokens(key, now_ms) >= 1
+
+    def record_action(self, key: str, now_ms: int) -> None:
+        """Takes a token from the given key's bucket."""
+        tokens = self._get_tokens(key, now_ms) - 1
+
+        self._buckets[key] = (tokens, now_ms)
+        self._buckets.move_to_end(key)
+
+        self._prune(now_ms)
+
+    def _get_tokens(self, key: str, now_ms: int) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self._limit.burst_count
+
+        tokens, updated_at = bucket
+        tokens += (now_ms - updated_at) / 1000 * self._limit.per_second
+        return min(tokens, self._limit.burst_count)
+
+    def _prune(self, now_ms: int) -> None:
+        """Drops the least recently used buckets that have refilled completely, and as
+        many others as needed to stay within the limit on the number of buckets.
+        """
+        while self._buckets:
+            key, (tokens, updated_at) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self._max_keys and (
+                now_ms - updated_at < self._refill_ms
+            ):
+                break
+            del self._buckets[key]
@@ -0,0 +1,129 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import random
+from typing import Callable, FrozenSet, Optional
+
+import attr
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class RetryPolicy:
+    """Decides whether and when a failed join should be retried.
+
+    Delays grow exponentially with the number of failed attempts, up to `max_delay`,
+    with full jitter: the actual delay is picked at random between zero and that
+    value, so that joins that failed at the same time (e.g. because a remote server
+    was down) don't all retry at the same time.
+
+    Joins rejected by the inviter's server within the federation race window are
+    retried until the window has passed, however many attempts that takes, with the
+    last attempt made as the window closes.
+
+    All durations are in seconds.
+    """
+
+    # The upper bound of the delay before the first retry.
+    initial_delay: float = 1.0
+    # The upper bound of the delay before any retry.
+    max_delay: float = 60.0
+    # How many attempts can be made in total.
+    max_attempts: int = 5
+    # How long after the invite was received no more attempts can be made, or 0 for
+    # no limit.
+    deadline: float = 300.0
+    # The HTTP status codes of errors that retrying isn't going to fix.
+    permanent_error_codes: FrozenSet[int] = frozenset({403, 404})
+    # For invites from remote users, how long after the invite was received errors
+    # with a permanent error code are still retried. The inviter's server might not
+    # have processed its own invite by the time we try to join through it (see
+    # https://github.com/matrix-org/synapse-auto-accept-invite/issues/12), in which
+    # case it rejects the join.
+    federation_race_window: float = 15.0
+
+    def is_permanent_failure(
+        self, error: Exception, elapsed: float, is_from_remote_user: bool
+    ) -> bool:
+        """Checks whether the given error means the join will never succeed.
+
+        Args:
+            error: the error the attempt at joining failed with.
+            elapsed: how long ago the invite was received.
+            is_from_remote_user: whether the invite was sent by a remote user.
+        """
+        return self._has_permanent_error_code(error) and not self.is_federation_race(
+            error, elapsed, is_from_remote_user
+        )
+
+    def is_federation_race(
+        self, error: Exception, elapsed: float, is_from_remote_user: bool
+    ) -> bool:
+        """Checks whether the given error may only mean that the inviter's server
+        hasn't processed its own invite yet, i.e. whether the join should be retried
+        until the federation race window has passed.
+
+        Args:
+            error: the error the attempt at joining failed with.
+            elapsed: how long ago the invite was received.
+            is_from_remote_user: whether the invite was sent by a remote user.
+        """
+        return (
+            is_from_remote_user
+            and elapsed < self.federation_race_window
+            and self._has_permanent_error_code(error)
+        )
+
+    def _has_permanent_error_code(self, error: Exception) -> bool:
+        # Synapse's errors, including the ones it raises for failed federation
+        # requests, carry the HTTP status code of the failure.
+        code = getattr(error, "code", None)
+        return isinstance(code, int) and code in self.permanent_error_codes
+
+    def get_next_delay(
+        self,
+        failed_attempts: int,
+        elapsed: float,
+        rand: Callable[[], float] = random.random,
+        in_race_window: bool = False,
+    ) -> Optional[float]:
+        """Picks how long to wait before the next attempt at joining.
+
+        Args:
+            failed_attempts: how many attempts have failed so far, at least 1.
+            elapsed: how long ago the invite was received.
+            rand: returns a random number between 0 and 1.
+            in_race_window: whether the last attempt failed because of a federation
+                race (see `is_federation_race`). If so, the join is retried until the
+                window has passed, regardless of the maximum number of attempts.
+
+        Returns:
+            The delay before the next attempt, or None if no more attempts should be
+            made, either because the maximum number of attempts has been reached or
+            because the next attempt would be past the deadline.
+        """
+        if failed_attempts >= self.max_attempts and not in_race_window:
+            return None
+
+        # Cap the exponent so that this doesn't overflow after many attempts.
+        exponent = min(failed_attempts - 1, 64)
+        delay = rand() * min(self.max_delay, self.initial_delay * 2.0**exponent)
+
+        if in_race_window:
+            # Don't wait past the end of the window: the last attempt is made as it
+            # closes, after which the error counts as permanent again.
+            delay = min(delay, self.federation_race_window - elapsed)
+
+        if self.deadline and elapsed + delay > self.deadline:
+            return None
+
+        return delay
@@ -0,0 +1,109 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import re
+from typing import Dict, FrozenSet, Iterable, List, Optional, Pattern, Tuple
+
+import attr
+
+# The properties of an invite rules can apply to, in the order they're checked.
+RULE_FIELDS = ("inviter_servers", "inviters", "invitees", "room_versions")
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class Matcher:
+    """Matches strings against a list of exact values and glob patterns, in which `*`
+    matches any sequence of characters and `?` matches any single character.
+    """
+
+    exact: FrozenSet[str]
+    # All of the glob patterns, combined into a single regular expression.
+    pattern: Optional[Pattern[str]]
+
+    @staticmethod
+    def compile(entries: Iterable[str]) -> "Matcher":
+        exact = set()
+        globs = []
+        for entry in entries:
+            if "*" in entry or "?" in entry:
+                globs.append(re.escape(entry).replace(r"\*", ".*").replace(r"\?", "."))
+            else:
+                exact.add(entry)
+
+        pattern = None
+        if globs:
+            pattern = re.compile("|".join(f"(?:{glob})" for glob in globs), re.DOTALL)
+
+        return Matcher(exact=frozenset(exact), pattern=pattern)
+
+    def matches(self, value: str) -> bool:
+        if value in self.exact:
+            return True
+        return self.pattern is not None and self.pattern.fullmatch(value) is not None
+
+
+class InviteRules:
+    """Decides whether invites can be accepted based on lists of allowed and denied
+    inviter servers, inviters, invitees and room versions.
+
+    An invite is rejected if any of its properties matches the corresponding deny
+    list, or doesn't match the corresponding allow list if there is one.
+
+    The lists are compiled once, so that checking an invite costs at most a set lookup
+    and a regular expression match per list, however long the lists are.
+    """
+
+    def __init__(
+        self,
+        allow: Optional[Dict[str, List[str]]] = None,
+        deny: Optional[Dict[str, List[str]]] = None,
+    ):
+        # The lists to check, as tuples of the index of the invite property in
+        # RULE_FIELDS, whether the list is an allow list, the compiled list, and the
+        # reason to give for rejecting an invite because of it.
+        self._checks: List[Tuple[int, bool, Matcher, str]] = []
+        for index, field in enumerate(RULE_FIELDS):
+            singular = field[:-1]
+            if deny and deny.get(field):
+                self._checks.append(
+                    (index, False, Matcher.compile(deny[field]), f"denied_{singular}")
+                )
+            if allow and allow.get(field):
+                self._checks.append(
+                    (
+                        index,
+                        True,
+                        Matcher.compile(allow[field]),
+                        f"not_allowed_{singular}",
+                    )
+                )
+
+    def __bool__(self) -> bool:
+        return bool(self._checks)
+
+    def check(self, inviter: str, invitee: str, room_version: str) -> Optional[str]:
+        """Checks an invite against the rules.
+
+        Args:
+            inviter: the user that sent the invite.
+            invitee: the user that was invited.
+            room_version: the identifier of the room's version.
+
+        Returns:
+            None if the invite can be accepted, otherwise the reason it can't.
+        """
+        values = (inviter.partition(":")[2], inviter, invitee, room_version)
+        for index, is_allow_list, matcher, reason in self._checks:
+            if matcher.matches(values[index]) != is_allow_list:
+                return reason
+        return None
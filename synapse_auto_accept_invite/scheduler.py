@@ -0,0 +1,424 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import heapq
+import itertools
+import logging
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import attr
+from synapse.module_api import JsonDict, ModuleApi, run_as_background_process
+
+from synapse_auto_accept_invite.circuit_breaker import CircuitBreaker, CircuitOpenError
+from synapse_auto_accept_invite.metrics import (
+    deduplicated_joins,
+    join_queue_wait,
+    joins_in_flight,
+    parked_joins,
+    queued_joins,
+)
+
+logger = logging.getLogger(__name__)
+
+# The lanes jobs are queued in, from the highest to the lowest priority: queued jobs
+# are only started from a lane if there's none waiting in the lanes before it.
+# Invites for direct messages.
+LANE_DIRECT_MESSAGE = 0
+# Invites from local users, which don't involve federation.
+LANE_LOCAL = 1
+# Invites from remote users.
+LANE_FEDERATED = 2
+# Invites from remote users to rooms that look large, which can take a long time to
+# join.
+LANE_LARGE_ROOM = 3
+
+LANE_NAMES = ("direct_message", "local", "federated", "large_room")
+
+
+class RetryLaterError(Exception):
+    """Raised by a job that failed and should be started again once its
+    `next_attempt_at` has passed. The job doesn't hold a join slot in the meantime.
+    """
+
+
+@attr.s(auto_attribs=True, slots=True)
+class JoinJob:
+    """An invite waiting to be accepted."""
+
+    # The local user that was invited.
+    user_id: str
+    # The user that sent the invite.
+    inviter: str
+    # The room the user was invited to.
+    room_id: str
+    # Whether the invite was for a direct message.
+    is_direct_message: bool
+    # The remote server the join is expected to go through, or None if the invite was
+    # sent by a local user.
+    destination: Optional[str]
+    # How many attempts at joining the room have failed.
+    attempts: int = 0
+    # When the next attempt at joining the room should be made, in milliseconds.
+    next_attempt_at: int = 0
+    # When the invite was scheduled to be accepted, in milliseconds. Set when the job
+    # is scheduled if it's still 0 then.
+    queued_at: int = 0
+    # When the job was last put in a queue to wait for a join slot, in milliseconds.
+    ready_at: int = 0
+    # The lane the job is queued in, one of the LANE_* constants.
+    lane: int = LANE_FEDERATED
+    # Whether the job is running, rather than waiting for a join slot.
+    running: bool = False
+
+    def merge(self, other: "JoinJob") -> None:
+        """Merges another job for the same user and room into this one."""
+        if other.is_direct_message and not self.is_direct_message:
+            # This job hasn't marked the room as a direct message (it only does so at
+            # the very end, and only if it's meant to), so have it do that on behalf
+            # of the other invite.
+            self.is_direct_message = True
+            self.inviter = other.inviter
+
+
+class JoinScheduler:
+    """Runs joins in the background, with a limit on how many are running at once in
+    total and for each remote server.
+
+    Joins that can't be started yet are queued, per priority lane then per destination
+    server. When a join slot frees up, queued joins are started from the highest
+    priority lane that has any that can be started, so that quick joins (e.g. for
+    direct messages) aren't stuck behind slow ones. Within a lane, joins are started in
+    a round-robin fashion across servers, so that a server with a large backlog doesn't
+    hold up joins going through other servers. Some slots can be reserved for the
+    direct message and local lanes, so that slow joins can never take all of them.
+
+    There's only ever one job for a given user and room: scheduling a job for a user and
+    room that already have one queued, running or waiting to be retried merges the new
+    job into it.
+
+    Queued jobs aren't started while the circuit breaker holds back joins through
+    their destination server. A running job that finds the circuit for its server open
+    raises `CircuitOpenError`, and is put back at the front of its server's queue.
+
+    A running job that failed and should be retried later raises `RetryLaterError`.
+    It then gives up its slot, and is only put back at the front of its server's queue
+    once its `next_attempt_at` has passed, so that waiting to retry a join doesn't hold
+    up other joins. The same goes for jobs scheduled with a `next_attempt_at` in the
+    future (e.g. resumed after a restart).
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        process: Callable[[JoinJob], Awaitable[None]],
+        max_concurrent_joins: int,
+        max_concurrent_joins_per_server: int,
+        circuit_breaker: CircuitBreaker,
+        reserved_priority_slots: int = 0,
+        bg_start_span: bool = False,
+    ):
+        self._api = api
+        self._bg_start_span = bg_start_span
+        self._process = process
+        self._max_concurrent_joins = max_concurrent_joins
+        self._max_concurrent_joins_per_server = max_concurrent_joins_per_server
+        self._circuit_breaker = circuit_breaker
+        # How many slots jobs in the federated and large room lanes can use.
+        self._max_concurrent_low_priority_joins = (
+            max_concurrent_joins - reserved_priority_slots
+        )
+
+        # The queued and running jobs, keyed by user ID and room ID.
+        self._jobs: Dict[Tuple[str, str], JoinJob] = {}
+
+        # The queued jobs, per lane then per destination server, in the order the
+        # servers should be considered when starting the next job.
+        self._queues: List["OrderedDict[Optional[str], Deque[JoinJob]]"] = [
+            OrderedDict() for _ in LANE_NAMES
+        ]
+        self._queued_count = 0
+
+        # The jobs waiting to be retried, as a heap of when they should be queued again,
+        # in milliseconds, and a sequence number to keep the order of jobs due at the
+        # same time.
+        self._delayed: List[Tuple[int, int, JoinJob]] = []
+        self._delayed_sequence = itertools.count()
+
+        # The number of running jobs, in total, per destination server, and in the
+        # federated and large room lanes.
+        self._in_flight_count = 0
+        self._in_flight_per_server: Dict[str, int] = {}
+        self._low_priority_in_flight_count = 0
+
+        # Whether we're already in the process of starting jobs, and whether we should
+        # look at the queues again once we're done (see `_start_jobs`).
+        self._starting_jobs = False
+        self._start_jobs_again = False
+
+        # When we've planned to look at the queues again, in milliseconds, because the
+        # circuit for a server with queued jobs was open.
+        self._wake_up_at: Optional[int] = None
+
+    @property
+    def queued_count(self) -> int:
+        """The number of jobs waiting for a join slot."""
+        return self._queued_count
+
+    @property
+    def in_flight_count(self) -> int:
+        """The number of jobs currently running."""
+        return self._in_flight_count
+
+    @property
+    def delayed_count(self) -> int:
+        """The number of jobs waiting to be retried."""
+        return len(self._delayed)
+
+    def get_snapshot(self, max_jobs: int) -> JsonDict:
+        """Returns a description of the queued and running jobs, for introspection.
+        Only the first `max_jobs` jobs, in the order they were scheduled, are listed.
+        """
+        return {
+            "queued": self._queued_count,
+            "in_flight": self._in_flight_count,
+            "delayed": len(self._delayed),
+            "in_flight_per_server": dict(
+                itertools.islice(self._in_flight_per_server.items(), max_jobs)
+            ),
+            "jobs": [
+                {
+                    "user_id": job.user_id,
+                    "room_id": job.room_id,
+                    "inviter": job.inviter,
+                    "destination": job.destination,
+                    "lane": LANE_NAMES[job.lane],
+                    "running": job.running,
+                    "attempts": job.attempts,
+                    "queued_at": job.queued_at,
+                    # Only meaningful once an attempt has failed.
+                    "next_attempt_at": job.next_attempt_at if job.attempts else None,
+                }
+                for job in itertools.islice(self._jobs.values(), max_jobs)
+            ],
+        }
+
+    def schedule(self, job: JoinJob) -> JoinJob:
+        """Queues a job, and starts it straight away if there's a free slot for it.
+
+        If a job for the same user and room is already queued or running, the new job
+        is merged into the existing one instead.
+
+        Returns:
+            The job that will handle the invite: either the given job, or the existing
+            one it was merged into.
+        """
+        key = (job.user_id, job.room_id)
+        existing_job = self._jobs.get(key)
+        if existing_job is not None:
+            deduplicated_joins.inc()
+            existing_job.merge(job)
+            return existing_job
+
+        self._jobs[key] = job
+        now = self._api.get_current_time_msec()
+        if not job.queued_at:
+            job.queued_at = now
+        if job.next_attempt_at > now:
+            self._delay(job)
+        else:
+            self._enqueue(job)
+
+        self._start_jobs()
+        return job
+
+    def _enqueue(self, job: JoinJob, first: bool = False) -> None:
+        """Adds a job to its destination server's queue, at the end or, if `first` is
+        True, at the front.
+        """
+        queues = self._queues[job.lane]
+        queue = queues.get(job.destination)
+        if queue is None:
+            queue = queues[job.destination] = deque()
+        if first:
+            queue.appendleft(job)
+        else:
+            queue.append(job)
+        job.ready_at = self._api.get_current_time_msec()
+
+        self._queued_count += 1
+        queued_joins.inc()
+
+    def _delay(self, job: JoinJob) -> None:
+        """Sets a job aside until its next attempt is due. It's queued again by
+        `_start_jobs` once it is.
+        """
+        heapq.heappush(
+            self._delayed, (job.next_attempt_at, next(self._delayed_sequence), job)
+        )
+
+    def _enqueue_due_jobs(self) -> None:
+        """Queues the jobs set aside whose next attempt is due, and plans to look at
+        the others again once the next one is.
+        """
+        now = self._api.get_current_time_msec()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, job = heapq.heappop(self._delayed)
+            self._enqueue(job, first=True)
+
+        if self._delayed:
+            self._schedule_wake_up(self._delayed[0][0])
+
+    def _start_jobs(self) -> None:
+        """Starts as many queued jobs as the limits allow."""
+        # Jobs can complete synchronously, and completing a job calls this function
+        # again. Rather than recursing, ask the outermost call to have another look.
+        if self._starting_jobs:
+            self._start_jobs_again = True
+            return
+
+        self._starting_jobs = True
+        try:
+            self._start_jobs_again = True
+            while self._start_jobs_again:
+                self._start_jobs_again = False
+                self._enqueue_due_jobs()
+                while self._in_flight_count < self._max_concurrent_joins:
+                    job = self._pop_next_job()
+                    if job is None:
+                        break
+                    self._start_job(job)
+        finally:
+            self._starting_jobs = False
+
+    def _pop_next_job(self) -> Optional[JoinJob]:
+        """Removes and returns the next job that can be started, if any.
+
+        If there's none because the circuit is open for the servers with queued jobs,
+        plans to look at the queues again once one of them can be probed.
+        """
+        now = self._api.get_current_time_msec()
+        retry_at: Optional[int] = None
+        for lane, queues in enumerate(self._queues):
+            if (
+                lane >= LANE_FEDERATED
+                and self._low_priority_in_flight_count
+                >= self._max_concurrent_low_priority_joins
+            ):
+                # The remaining slots are reserved for higher priority lanes.
+                break
+
+            for destination, queue in queues.items():
+                if (
+                    destination is not None
+                    and self._in_flight_per_server.get(destination, 0)
+                    >= self._max_concurrent_joins_per_server
+                ):
+                    continue
+
+                server_retry_at = self._circuit_breaker.get_retry_time(destination, now)
+                if server_retry_at is not None:
+                    if retry_at is None or server_retry_at < retry_at:
+                        retry_at = server_retry_at
+                    continue
+
+                job = queue.popleft()
+                if queue:
+                    # Give other servers a chance before picking from this one again.
+                    queues.move_to_end(destination)
+                else:
+                    del queues[destination]
+
+                self._queued_count -= 1
+                return job
+
+        if retry_at is not None:
+            self._schedule_wake_up(retry_at)
+        return None
+
+    def _schedule_wake_up(self, at: int) -> None:
+        """Plans to look at the queues and the jobs waiting to be retried again at
+        the given time, in milliseconds.
+        """
+        if self._wake_up_at is not None and self._wake_up_at <= at:
+            return
+
+        self._wake_up_at = at
+        run_as_background_process(
+            "auto_accept_invite_wake_up",
+            self._wake_up,
+            at,
+            bg_start_span=False,
+        )
+
+    async def _wake_up(self, at: int) -> None:
+        await self._api.sleep(max(at - self._api.get_current_time_msec(), 0) / 1000)
+        if self._wake_up_at == at:
+            self._wake_up_at = None
+        self._start_jobs()
+
+    def _start_job(self, job: JoinJob) -> None:
+        queued_joins.dec()
+        join_queue_wait.observe(
+            (self._api.get_current_time_msec() - job.ready_at) / 1000
+        )
+
+        job.running = True
+        self._in_flight_count += 1
+        joins_in_flight.inc()
+        if job.lane >= LANE_FEDERATED:
+            self._low_priority_in_flight_count += 1
+        if job.destination is not None:
+            self._in_flight_per_server[job.destination] = (
+                self._in_flight_per_server.get(job.destination, 0) + 1
+            )
+
+        run_as_background_process(
+            "auto_accept_invite",
+            self._run_job,
+            job,
+            bg_start_span=self._bg_start_span,
+        )
+
+    async def _run_job(self, job: JoinJob) -> None:
+        parked = False
+        retrying = False
+        try:
+            await self._process(job)
+        except CircuitOpenError:
+            # The job will be started again once the server it goes through looks
+            # reachable again.
+            parked = True
+            parked_joins.inc()
+        except RetryLaterError:
+            retrying = True
+        finally:
+            job.running = False
+            if parked:
+                self._enqueue(job, first=True)
+            elif retrying:
+                self._delay(job)
+            else:
+                del self._jobs[(job.user_id, job.room_id)]
+            self._in_flight_count -= 1
+            joins_in_flight.dec()
+            if job.lane >= LANE_FEDERATED:
+                self._low_priority_in_flight_count -= 1
+            if job.destination is not None:
+                remaining = self._in_flight_per_server[job.destination] - 1
+                if remaining:
+                    self._in_flight_per_server[job.destination] = remaining
+                else:
+                    del self._in_flight_per_server[job.destination]
+
+            self._start_jobs()
@@ -0,0 +1,346 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import logging
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+import attr
+from synapse.module_api import (
+    JsonDict,
+    LoggingTransaction,
+    ModuleApi,
+    run_as_background_process,
+)
+
+logger = logging.getLogger(__name__)
+
+TABLE_NAME = "synapse_auto_accept_invite_pending_joins"
+
+# How long to wait, in seconds, before writing changes to the pending joins to the
+# database, so that changes made in quick succession are written in one transaction.
+FLUSH_INTERVAL = 1.0
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class PendingJoin:
+    """A join that hasn't completed yet, as stored in the database."""
+
+    user_id: str
+    room_id: str
+    inviter: str
+    is_direct_message: bool
+    # How many attempts at joining the room have failed.
+    attempts: int
+    # When the next attempt should be made, in milliseconds.
+    next_attempt_at: int
+    # When the invite was scheduled to be accepted, in milliseconds.
+    queued_at: int
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class OutstandingInvite:
+    """An invite for a local user, which the user hasn't responded to yet."""
+
+    user_id: str
+    room_id: str
+    inviter: str
+    # The content of the invite's membership event.
+    content: JsonDict
+    # The identifier of the room's version.
+    room_version: str
+    # The stripped state of the room sent along with the invite, if any.
+    invite_room_state: Any
+
+
+async def get_outstanding_invites(
+    api: ModuleApi, after: Optional[Tuple[str, str]], limit: int
+) -> List[OutstandingInvite]:
+    """Retrieves a batch of the invites local users haven't responded to yet, ordered by
+    user ID and room ID.
+
+    This reads from Synapse's own tables, as the module API doesn't provide a way to
+    list invites.
+
+    Args:
+        api: the module API to access the database with.
+        after: the user ID and room ID of the last invite in the previous batch, or
+            None to retrieve the first batch.
+        limit: the maximum number of invites to retrieve.
+    """
+    return await api.run_db_interaction(
+        "auto_accept_invite_get_outstanding_invites",
+        _get_outstanding_invites_txn,
+        after,
+        limit,
+    )
+
+
+async def get_left_rooms(api: ModuleApi, user_id: str) -> FrozenSet[str]:
+    """Retrieves the rooms a local user has left or been banned from.
+
+    This reads from Synapse's own tables, as the module API doesn't provide a way to
+    list a user's rooms.
+
+    Args:
+        api: the module API to access the database with.
+        user_id: the local user to retrieve the rooms of.
+    """
+    return await api.run_db_interaction(
+        "auto_accept_invite_get_left_rooms", _get_left_rooms_txn, user_id
+    )
+
+
+class PendingJoinStore:
+    """Keeps track of the joins that haven't completed yet in a table owned by this
+    module, so that they can be resumed if the process restarts.
+
+    Changes are buffered in memory for a short while then written in bulk, so a crash
+    can lose the changes made in the last `FLUSH_INTERVAL` seconds.
+    """
+
+    def __init__(self, api: ModuleApi):
+        self._api = api
+        self._table_created = False
+
+        # The changes waiting to be written, keyed by user ID and room ID. A value of
+        # None means the join needs to be removed from the database.
+        self._pending_changes: Dict[Tuple[str, str], Optional[PendingJoin]] = {}
+        self._flushing = False
+
+    def save(self, pending_join: PendingJoin) -> None:
+        """Schedules saving the given pending join, replacing any previous version of
+        it.
+        """
+        key = (pending_join.user_id, pending_join.room_id)
+        self._pending_changes[key] = pending_join
+        self._schedule_flush()
+
+    def remove(self, user_id: str, room_id: str) -> None:
+        """Schedules removing the pending join for the given user and room."""
+        self._pending_changes[(user_id, room_id)] = None
+        self._schedule_flush()
+
+    async def get_pending_joins(
+        self, after: Optional[Tuple[str, str]], limit: int
+    ) -> List[PendingJoin]:
+        """Retrieves a batch of the pending joins stored in the database, ordered by user
+        ID and room ID.
+
+        Args:
+            after: the user ID and room ID of the last pending join in the previous
+                batch, or None to retrieve the first batch.
+            limit: the maximum number of pending joins to retrieve.
+        """
+        await self._create_table()
+
+        return await self._api.run_db_interaction(
+            "auto_accept_invite_get_pending_joins",
+            _get_pending_joins_txn,
+            after,
+            limit,
+        )
+
+    def _schedule_flush(self) -> None:
+        if self._flushing:
+            return
+
+        self._flushing = True
+        run_as_background_process(
+            "auto_accept_invite_persist_pending_joins",
+            self._flush,
+            bg_start_span=False,
+        )
+
+    async def _flush(self) -> None:
+        """Waits for more changes to come in, then writes all of the pending changes to
+        the database. Repeats until there's nothing left to write.
+        """
+        try:
+            while self._pending_changes:
+                await self._api.sleep(FLUSH_INTERVAL)
+
+                changes = self._pending_changes
+                self._pending_changes = {}
+
+                try:
+                    await self._create_table()
+                    await self._api.run_db_interaction(
+                        "auto_accept_invite_persist_pending_joins",
+                        _persist_changes_txn,
+                        changes,
+                    )
+                except Exception:
+                    logger.exception(
+                        "Failed to persist %d change(s) to pending joins", len(changes)
+                    )
+        finally:
+            self._flushing = False
+
+    async def _create_table(self) -> None:
+        if self._table_created:
+            return
+
+        await self._api.run_db_interaction(
+            "auto_accept_invite_create_table", _create_table_txn
+        )
+        self._table_created = True
+
+
+def _create_table_txn(txn: LoggingTransaction) -> None:
+    # This schema needs to work on both SQLite and PostgreSQL.
+    txn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+            user_id TEXT NOT NULL,
+            room_id TEXT NOT NULL,
+            inviter TEXT NOT NULL,
+            is_direct_message BOOLEAN NOT NULL,
+            attempts INTEGER NOT NULL,
+            next_attempt_at BIGINT NOT NULL,
+            queued_at BIGINT NOT NULL,
+            PRIMARY KEY (user_id, room_id)
+        )
+        """
+    )
+
+
+def _persist_changes_txn(
+    txn: LoggingTransaction, changes: Dict[Tuple[str, str], Optional[PendingJoin]]
+) -> None:
+    to_delete = [key for key, pending_join in changes.items() if pending_join is None]
+    to_upsert = [
+        (
+            pending_join.user_id,
+            pending_join.room_id,
+            pending_join.inviter,
+            pending_join.is_direct_message,
+            pending_join.attempts,
+            pending_join.next_attempt_at,
+            pending_join.queued_at,
+        )
+        for pending_join in changes.values()
+        if pending_join is not None
+    ]
+
+    if to_delete:
+        txn.execute_batch(
+            f"DELETE FROM {TABLE_NAME} WHERE user_id = ? AND room_id = ?",
+            to_delete,
+        )
+
+    if to_upsert:
+        txn.execute_batch(
+            f"""
+            INSERT INTO {TABLE_NAME} (
+                user_id, room_id, inviter, is_direct_message, attempts, next_attempt_at,
+                queued_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, room_id) DO UPDATE SET
+                inviter = EXCLUDED.inviter,
+                is_direct_message = EXCLUDED.is_direct_message,
+                attempts = EXCLUDED.attempts,
+                next_attempt_at = EXCLUDED.next_attempt_at,
+                queued_at = EXCLUDED.queued_at
+            """,
+            to_upsert,
+        )
+
+
+def _get_pending_joins_txn(
+    txn: LoggingTransaction, after: Optional[Tuple[str, str]], limit: int
+) -> List[PendingJoin]:
+    sql = f"""
+        SELECT
+            user_id, room_id, inviter, is_direct_message, attempts, next_attempt_at,
+            queued_at
+        FROM {TABLE_NAME}
+    """
+    args: Tuple[Any, ...] = ()
+    if after is not None:
+        sql += " WHERE user_id > ? OR (user_id = ? AND room_id > ?)"
+        args = (after[0], after[0], after[1])
+    sql += " ORDER BY user_id, room_id LIMIT ?"
+
+    txn.execute(sql, args + (limit,))
+    rows = txn.fetchall()
+
+    return [
+        PendingJoin(
+            user_id=user_id,
+            room_id=room_id,
+            inviter=inviter,
+            is_direct_message=bool(is_direct_message),
+            attempts=attempts,
+            next_attempt_at=next_attempt_at,
+            queued_at=queued_at,
+        )
+        for (
+            user_id,
+            room_id,
+            inviter,
+            is_direct_message,
+            attempts,
+            next_attempt_at,
+            queued_at,
+        ) in rows
+    ]
+
+
+def _get_outstanding_invites_txn(
+    txn: LoggingTransaction, after: Optional[Tuple[str, str]], limit: int
+) -> List[OutstandingInvite]:
+    sql = """
+        SELECT lcm.user_id, lcm.room_id, e.sender, ej.json, r.room_version
+        FROM local_current_membership AS lcm
+        INNER JOIN events AS e USING (event_id)
+        INNER JOIN event_json AS ej USING (event_id)
+        LEFT JOIN rooms AS r ON r.room_id = lcm.room_id
+        WHERE lcm.membership = 'invite'
+    """
+    args: Tuple[Any, ...] = ()
+    if after is not None:
+        sql += " AND (lcm.user_id > ? OR (lcm.user_id = ? AND lcm.room_id > ?))"
+        args = (after[0], after[0], after[1])
+    sql += " ORDER BY lcm.user_id, lcm.room_id LIMIT ?"
+
+    txn.execute(sql, args + (limit,))
+    rows = txn.fetchall()
+
+    invites = []
+    for user_id, room_id, inviter, event_json, room_version in rows:
+        event = json.loads(event_json)
+        invites.append(
+            OutstandingInvite(
+                user_id=user_id,
+                room_id=room_id,
+                inviter=inviter,
+                content=event.get("content", {}),
+                # Rooms created before room versions were recorded are version 1
+                # rooms.
+                room_version=room_version or "1",
+                invite_room_state=event.get("unsigned", {}).get("invite_room_state"),
+            )
+        )
+    return invites
+
+
+def _get_left_rooms_txn(txn: LoggingTransaction, user_id: str) -> FrozenSet[str]:
+    txn.execute(
+        """
+        SELECT room_id FROM local_current_membership
+        WHERE user_id = ? AND membership IN ('leave', 'ban')
+        """,
+        (user_id,),
+    )
+    return frozenset(room_id for (room_id,) in txn.fetchall())
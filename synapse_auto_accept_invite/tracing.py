@@ -0,0 +1,85 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import logging
+from typing import Any, ContextManager, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Synapse's tracing helpers aren't part of the module API, so don't fail to load if
+# they move. They do nothing if tracing isn't enabled in Synapse's configuration.
+try:
+    from synapse.logging.opentracing import set_tag, start_active_span
+except ImportError:  # pragma: no cover
+    set_tag = None  # type: ignore[assignment]
+    start_active_span = None  # type: ignore[assignment]
+
+
+class Tracer:
+    """Starts tracing spans for the stages of accepting an invite, if tracing is
+    enabled in this module's configuration.
+
+    Spans are tagged with the room and the server of the invitee they're about, and,
+    for join attempts, the attempt number and, if the attempt failed and is to be
+    retried, the delay before the next one.
+    """
+
+    def __init__(self, enabled: bool):
+        if enabled and start_active_span is None:
+            logger.warning(
+                "Tracing is enabled but isn't supported by this version of Synapse"
+            )
+            enabled = False
+        self._enabled = enabled
+
+    @property
+    def enabled(self) -> bool:
+        """Whether spans are being started. Also used as the `bg_start_span` argument
+        of the module's background processes, so they each get their own span.
+        """
+        return self._enabled
+
+    def span(
+        self,
+        name: str,
+        user_id: str,
+        room_id: Optional[str] = None,
+        attempt: Optional[int] = None,
+    ) -> ContextManager[Any]:
+        """Returns a context manager covering a span with the given name.
+
+        Args:
+            name: the name of the operation, after the module's prefix.
+            user_id: the local user the operation is for.
+            room_id: the room the operation is about, if any.
+            attempt: the number of the join attempt the operation is, if any.
+        """
+        if not self._enabled:
+            return contextlib.nullcontext()
+
+        tags: Dict[str, str] = {"invitee_server": user_id.partition(":")[2]}
+        if room_id is not None:
+            tags["room_id"] = room_id
+        if attempt is not None:
+            tags["attempt"] = str(attempt)
+
+        scope: ContextManager[Any] = start_active_span(
+            f"auto_accept_invite.{name}", tags=tags
+        )
+        return scope
+
+    def set_tag(self, key: str, value: str) -> None:
+        """Tags the currently active span, if tracing is enabled."""
+        if self._enabled:
+            set_tag(key, value)
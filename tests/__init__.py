@@ -12,11 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import asyncio
+import time
 from asyncio import Future
 from typing import Any, Awaitable, Dict, Optional, TypeVar
-from unittest.mock import Mock
+from unittest.mock import DEFAULT, Mock
 
 import attr
+from synapse.api.room_versions import RoomVersion, RoomVersions
 from synapse.module_api import ModuleApi
 
 from synapse_auto_accept_invite import InviteAutoAccepter
@@ -31,6 +33,8 @@ class MockEvent:
     content: Dict[str, Any]
     room_id: str = "!someroom"
     state_key: Optional[str] = None
+    room_version: RoomVersion = RoomVersions.V10
+    unsigned: Dict[str, Any] = attr.Factory(dict)
 
     def is_state(self) -> bool:
         """Checks if the event is a state event by checking if it has a state key."""
@@ -72,7 +76,18 @@ def create_module(
     module_api = Mock(spec=ModuleApi)
     module_api.is_mine.side_effect = lambda a: a.split(":")[1] == "test"
     module_api.worker_name = worker_name
+    # Sleeping returns straight away, but moves the clock forward, so that the module
+    # sees the time it waited for as having passed.
+    now = [int(time.time() * 1000)]
+
+    def sleep(seconds: float) -> Any:
+        now[0] += int(seconds * 1000)
+        return DEFAULT
+
+    module_api.sleep.side_effect = sleep
     module_api.sleep.return_value = make_multiple_awaitable(None)
+    module_api.get_current_time_msec.side_effect = lambda: now[0]
+    module_api.get_room_state.return_value = {}
 
     config = InviteAutoAccepter.parse_config(config_override)
 
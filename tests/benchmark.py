@@ -0,0 +1,204 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures the throughput and memory use of the module on a synthetic stream of
+events.
+
+Run with `python -m tests.benchmark`, see `--help` for the options. The results are
+printed as a JSON object, so they can be compared between releases.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from twisted.internet import defer, task
+
+from tests import MockEvent
+from tests.simulation import SimulatedHomeserver, percentile
+
+
+def generate_events(
+    count: int,
+    invite_ratio: float,
+    direct_message_ratio: float,
+    local_inviter_ratio: float,
+    seed: int,
+) -> Iterator[MockEvent]:
+    """Generates a stream of events, of which about `invite_ratio` are invites for local
+    users. The others are messages, which the module should ignore.
+    """
+    rand = random.Random(seed)
+    for i in range(count):
+        if rand.random() >= invite_ratio:
+            yield MockEvent(
+                sender=f"@sender{i % 100}:remote{i % 10}",
+                type="m.room.message",
+                room_id=f"!room{i % 1000}:remote{i % 10}",
+                content={"msgtype": "m.text", "body": "hello"},
+            )
+            continue
+
+        if rand.random() < local_inviter_ratio:
+            inviter = f"@inviter{i % 50}:test"
+        else:
+            inviter = f"@inviter{i % 50}:remote{i % 10}"
+        yield MockEvent(
+            sender=inviter,
+            state_key=f"@user{i % 5000}:test",
+            type="m.room.member",
+            room_id=f"!room{i}:{inviter.split(':')[1]}",
+            content={
+                "membership": "invite",
+                "is_direct": rand.random() < direct_message_ratio,
+            },
+        )
+
+
+def run_benchmark(
+    events: int = 10000,
+    invite_ratio: float = 0.1,
+    direct_message_ratio: float = 0.5,
+    local_inviter_ratio: float = 0.2,
+    join_latency: float = 0.5,
+    account_data_latency: float = 0.05,
+    event_interval: float = 0.001,
+    config: Optional[Dict[str, Any]] = None,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """Feeds a synthetic stream of events to the module on virtual time, and returns
+    the results.
+
+    The stream is fed twice: once to measure throughput and latencies, and once with
+    memory allocations traced, as tracing them slows everything down. Both runs are
+    identical, as the events are generated from the same seed and time is virtual.
+
+    Args:
+        events: how many events to generate.
+        invite_ratio: the proportion of the events that are invites.
+        direct_message_ratio: the proportion of the invites that are for direct
+            messages.
+        local_inviter_ratio: the proportion of the invites sent by local users.
+        join_latency: how long, in seconds, joining a room takes.
+        account_data_latency: how long, in seconds, reading or writing account data
+            takes.
+        event_interval: how long, in virtual seconds, to wait between two events.
+        config: the module's configuration.
+        seed: the seed of the random generator the events are generated with.
+    """
+
+    def run(trace_memory: bool) -> Tuple[SimulatedHomeserver, float, int, int]:
+        clock = task.Clock()
+        homeserver = SimulatedHomeserver(
+            config or {}, clock, join_latency, account_data_latency
+        )
+        if trace_memory:
+            tracemalloc.start()
+
+        # Only time spent in the module's callback counts towards the throughput, not
+        # the generation of the events nor the background work started by them.
+        handling_time = 0.0
+        peak_pending_joins = 0
+        for event in generate_events(
+            events, invite_ratio, direct_message_ratio, local_inviter_ratio, seed
+        ):
+            start = time.perf_counter()
+            defer.ensureDeferred(homeserver.send_event(event))
+            handling_time += time.perf_counter() - start
+
+            peak_pending_joins = max(
+                peak_pending_joins, homeserver.module._get_pending_join_count()
+            )
+            clock.advance(event_interval)
+
+        homeserver.run_until_idle()
+
+        peak_memory = 0
+        if trace_memory:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        return homeserver, handling_time, peak_pending_joins, peak_memory
+
+    homeserver, handling_time, peak_pending_joins, _ = run(trace_memory=False)
+    _, _, _, peak_memory = run(trace_memory=True)
+
+    latencies = homeserver.join_latencies
+    return {
+        "events": events,
+        "invites": len(homeserver.invited_at),
+        "joins": len(latencies),
+        "events_per_second": events / handling_time if handling_time else None,
+        "time_to_join_p50": percentile(latencies, 0.5),
+        "time_to_join_p99": percentile(latencies, 0.99),
+        "peak_pending_joins": peak_pending_joins,
+        "peak_memory_bytes": peak_memory,
+        "account_data_reads": homeserver.account_data_reads,
+        "account_data_writes": homeserver.account_data_writes,
+    }
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m tests.benchmark", description=__doc__
+    )
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--invite-ratio", type=float, default=0.1)
+    parser.add_argument("--direct-message-ratio", type=float, default=0.5)
+    parser.add_argument("--local-inviter-ratio", type=float, default=0.2)
+    parser.add_argument(
+        "--join-latency",
+        type=float,
+        default=0.5,
+        help="how long, in seconds, joining a room takes",
+    )
+    parser.add_argument(
+        "--account-data-latency",
+        type=float,
+        default=0.05,
+        help="how long, in seconds, reading or writing account data takes",
+    )
+    parser.add_argument(
+        "--event-interval",
+        type=float,
+        default=0.001,
+        help="how long, in virtual seconds, to wait between two events",
+    )
+    parser.add_argument(
+        "--config",
+        type=json.loads,
+        default={},
+        help="the module's configuration, as a JSON object",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(
+        events=args.events,
+        invite_ratio=args.invite_ratio,
+        direct_message_ratio=args.direct_message_ratio,
+        local_inviter_ratio=args.local_inviter_ratio,
+        join_latency=args.join_latency,
+        account_data_latency=args.account_data_latency,
+        event_interval=args.event_interval,
+        config=args.config,
+        seed=args.seed,
+    )
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,282 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Simulates joins failing in the ways they do over federation, to compare how
+policies for retrying them perform.
+
+Run with `python -m tests.fault_injection`, see `--help` for the options. Each policy
+is a set of `join_retry_*` options, and is run against the same invites and the same
+failures, on virtual time. The time it took to join the rooms, the number of attempts
+wasted on failures and the proportion of invites given up on are printed for each
+policy as a JSON object.
+"""
+import argparse
+import json
+import random
+import sys
+from typing import Any, Dict, List, Optional
+
+import attr
+from synapse.module_api.errors import SynapseError
+from twisted.internet import defer, task
+
+from tests import MockEvent
+from tests.simulation import SimulatedHomeserver, percentile
+
+# The policies compared by default.
+DEFAULT_POLICIES: Dict[str, Dict[str, Any]] = {
+    "default": {},
+    "no_race_window": {"join_retry_federation_race_window": 0},
+    "patient": {
+        "join_retry_initial_delay": 2,
+        "join_retry_max_attempts": 10,
+        "join_retry_deadline": 600,
+    },
+}
+
+# The options of the module that aren't about retrying joins. The circuit breaker and
+# the concurrency limits are disabled, so that only the retry policy is measured.
+DEFAULT_CONFIG: Dict[str, Any] = {
+    "circuit_breaker_failure_threshold": 0,
+    "max_concurrent_joins": 100000,
+    "max_concurrent_joins_per_server": 100000,
+}
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class Faults:
+    """The ways joins fail in a simulation.
+
+    Attributes:
+        not_found_for: how long, in seconds, after an invite is received joins fail
+            with a 404, as the inviter's server hasn't processed its own invite yet.
+        timeout_rate: the probability that an attempt times out.
+        timeout: how long, in seconds, an attempt that times out takes.
+        forbidden_rate: the probability that joining a room fails with a 403 on every
+            attempt.
+    """
+
+    not_found_for: float = 5.0
+    timeout_rate: float = 0.1
+    timeout: float = 60.0
+    forbidden_rate: float = 0.05
+
+
+class FaultyHomeserver(SimulatedHomeserver):
+    """A simulated homeserver on which joins fail according to the given faults.
+
+    Whether a given attempt fails only depends on the room, the attempt number and the
+    seed, so that different policies see the same failures.
+    """
+
+    def __init__(
+        self,
+        config: Dict[str, Any],
+        clock: task.Clock,
+        join_latency: float,
+        faults: Faults,
+        seed: int,
+    ):
+        super().__init__(config, clock, join_latency)
+        self.faults = faults
+        self.seed = seed
+
+    def is_forbidden(self, room_id: str) -> bool:
+        """Returns whether joining the given room always fails with a 403."""
+        return random.Random(f"{self.seed}:{room_id}").random() < (
+            self.faults.forbidden_rate
+        )
+
+    async def attempt_join(self, user_id: str, room_id: str, attempt: int) -> None:
+        if self.is_forbidden(room_id):
+            await self.sleep(self.join_latency)
+            raise SynapseError(403, "You are not invited to this room.")
+
+        if random.Random(f"{self.seed}:{room_id}:{attempt}").random() < (
+            self.faults.timeout_rate
+        ):
+            await self.sleep(self.faults.timeout)
+            raise TimeoutError("Timed out waiting for the remote server")
+
+        await self.sleep(self.join_latency)
+        if (self.now_msec() - self.invited_at[(user_id, room_id)]) / 1000 < (
+            self.faults.not_found_for
+        ):
+            raise SynapseError(404, "Unknown room")
+
+
+def simulate(
+    policy: Dict[str, Any],
+    faults: Faults,
+    invites: int = 1000,
+    invite_interval: float = 0.1,
+    join_latency: float = 0.5,
+    config: Optional[Dict[str, Any]] = None,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """Runs invites from remote users through the module with the given retry policy
+    and faults, on virtual time, and returns the results.
+
+    Args:
+        policy: the `join_retry_*` options of the policy.
+        faults: the ways joins fail.
+        invites: how many invites to send.
+        invite_interval: how long, in seconds, to wait between two invites.
+        join_latency: how long, in seconds, an attempt at joining a room takes when it
+            doesn't time out.
+        config: the other options of the module.
+        seed: the seed failures and the delays between retries are picked with.
+    """
+    # The delays between retries are picked at random.
+    random.seed(seed)
+
+    clock = task.Clock()
+    homeserver = FaultyHomeserver(
+        {**DEFAULT_CONFIG, **(config or {}), **policy},
+        clock,
+        join_latency,
+        faults,
+        seed,
+    )
+
+    for i in range(invites):
+        defer.ensureDeferred(
+            homeserver.send_event(
+                MockEvent(
+                    sender=f"@inviter:remote{i % 20}",
+                    state_key=f"@user{i}:test",
+                    type="m.room.member",
+                    room_id=f"!room{i}:remote{i % 20}",
+                    content={"membership": "invite"},
+                )
+            )
+        )
+        clock.advance(invite_interval)
+
+    homeserver.run_until_idle()
+
+    forbidden = sum(
+        homeserver.is_forbidden(room_id) for _, room_id in homeserver.invited_at
+    )
+    latencies = homeserver.join_latencies
+    attempts = sum(homeserver.join_attempts.values())
+    gave_up = invites - len(latencies)
+    return {
+        "invites": invites,
+        "joined": len(latencies),
+        "time_to_join_p50": percentile(latencies, 0.5),
+        "time_to_join_p90": percentile(latencies, 0.9),
+        "time_to_join_p99": percentile(latencies, 0.99),
+        "attempts": attempts,
+        # Every attempt but the successful ones is wasted.
+        "wasted_attempts": attempts - len(latencies),
+        "give_up_rate": gave_up / invites if invites else None,
+        # Giving up on joining a room that can't be joined is the right call, giving
+        # up on one that could have been is what policies should avoid.
+        "joinable_give_up_rate": (
+            (gave_up - forbidden) / (invites - forbidden)
+            if invites > forbidden
+            else None
+        ),
+    }
+
+
+def main(argv: List[str]) -> None:
+    default_faults = Faults()
+    parser = argparse.ArgumentParser(
+        prog="python -m tests.fault_injection", description=__doc__
+    )
+    parser.add_argument(
+        "--policy",
+        nargs=2,
+        action="append",
+        metavar=("NAME", "OPTIONS"),
+        help="a policy to compare, with its join_retry_* options as a JSON object;"
+        " can be given several times. Defaults to comparing"
+        f" {', '.join(DEFAULT_POLICIES)}",
+    )
+    parser.add_argument("--invites", type=int, default=1000)
+    parser.add_argument(
+        "--invite-interval",
+        type=float,
+        default=0.1,
+        help="how long, in seconds, to wait between two invites",
+    )
+    parser.add_argument(
+        "--join-latency",
+        type=float,
+        default=0.5,
+        help="how long, in seconds, an attempt at joining a room takes",
+    )
+    parser.add_argument(
+        "--not-found-for",
+        type=float,
+        default=default_faults.not_found_for,
+        help="how long, in seconds, after an invite joins fail with a 404",
+    )
+    parser.add_argument(
+        "--timeout-rate",
+        type=float,
+        default=default_faults.timeout_rate,
+        help="the probability that an attempt times out",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=default_faults.timeout,
+        help="how long, in seconds, an attempt that times out takes",
+    )
+    parser.add_argument(
+        "--forbidden-rate",
+        type=float,
+        default=default_faults.forbidden_rate,
+        help="the probability that joining a room always fails with a 403",
+    )
+    parser.add_argument(
+        "--config",
+        type=json.loads,
+        default={},
+        help="the module's other options, as a JSON object",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.policy:
+        policies = {name: json.loads(options) for name, options in args.policy}
+    else:
+        policies = DEFAULT_POLICIES
+
+    faults = Faults(
+        not_found_for=args.not_found_for,
+        timeout_rate=args.timeout_rate,
+        timeout=args.timeout,
+        forbidden_rate=args.forbidden_rate,
+    )
+    results = {
+        name: simulate(
+            policy,
+            faults,
+            invites=args.invites,
+            invite_interval=args.invite_interval,
+            join_latency=args.join_latency,
+            config=args.config,
+            seed=args.seed,
+        )
+        for name, policy in policies.items()
+    }
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,217 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Replays a log of events through the module, to see how a configuration would have
+handled them.
+
+Run with `python -m tests.replay EVENTS_FILE`, see `--help` for the options. The log
+is a JSON Lines file with one event per line, each having the `type`, `sender`,
+`state_key` (for state events), `room_id`, `content` and `timestamp` (in
+milliseconds) of the event. A report of the decisions the module made, the latency
+of the joins and the number of account data accesses is printed as a JSON object.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple
+
+from prometheus_client import Counter
+from twisted.internet import defer, task
+
+from synapse_auto_accept_invite.metrics import (
+    invites_accepted,
+    invites_filtered,
+    invites_received,
+)
+from tests import MockEvent
+from tests.simulation import SimulatedHomeserver, percentile
+
+
+def read_events(lines: IO[str]) -> Iterator[Tuple[int, MockEvent]]:
+    """Parses a log of events, yielding the timestamp of each event with the event."""
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            event = MockEvent(
+                type=entry["type"],
+                sender=entry["sender"],
+                state_key=entry.get("state_key"),
+                room_id=entry["room_id"],
+                content=entry.get("content", {}),
+                unsigned=entry.get("unsigned", {}),
+            )
+            timestamp = int(entry["timestamp"])
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"Invalid event on line {line_number}: {e!r}") from e
+        yield timestamp, event
+
+
+def _get_counts(counter: Counter, label: Optional[str] = None) -> Dict[str, float]:
+    """Returns the current values of a counter, keyed by the value of the given
+    label.
+    """
+    return {
+        sample.labels[label] if label else "": sample.value
+        for metric in counter.collect()
+        for sample in metric.samples
+        if sample.name.endswith("_total")
+    }
+
+
+def _snapshot_decisions() -> Dict[str, float]:
+    """Returns the number of invites received, accepted and filtered (by reason) so
+    far.
+    """
+    snapshot = {
+        "received": _get_counts(invites_received).get("", 0.0),
+        "accepted": _get_counts(invites_accepted).get("", 0.0),
+    }
+    for reason, value in _get_counts(invites_filtered, "reason").items():
+        snapshot[f"filtered.{reason}"] = value
+    return snapshot
+
+
+def replay(
+    events: Iterator[Tuple[int, MockEvent]],
+    config: Dict[str, Any],
+    join_latency: float = 0.5,
+    account_data_latency: float = 0.05,
+    real_time: bool = False,
+) -> Dict[str, Any]:
+    """Replays events through the module, at the pace given by their timestamps, and
+    returns a report of what the module did.
+
+    Args:
+        events: the events to replay, with their timestamps in milliseconds, in
+            chronological order.
+        config: the module's configuration.
+        join_latency: how long, in seconds, joining a room takes.
+        account_data_latency: how long, in seconds, reading or writing account data
+            takes.
+        real_time: whether to wait for the time between events (and for the time
+            joins and account data accesses take) to actually pass, rather than
+            running on virtual time.
+    """
+    clock = task.Clock()
+    homeserver = SimulatedHomeserver(config, clock, join_latency, account_data_latency)
+
+    def advance_to(target: float) -> None:
+        # Run the calls due until then one at a time, so that, on real time, each of
+        # them happens when it's due.
+        while clock.calls and clock.calls[0].getTime() <= target:
+            advance_by(clock.calls[0].getTime() - clock.seconds())
+        advance_by(target - clock.seconds())
+
+    def advance_by(seconds: float) -> None:
+        if real_time and seconds > 0:
+            time.sleep(seconds)
+        clock.advance(max(seconds, 0))
+
+    # Metrics are global, so only count the decisions made during this replay.
+    decisions_before = _snapshot_decisions()
+
+    first_timestamp: Optional[int] = None
+    event_count = 0
+    for timestamp, event in events:
+        if first_timestamp is None:
+            first_timestamp = timestamp
+        advance_to((timestamp - first_timestamp) / 1000)
+
+        defer.ensureDeferred(homeserver.send_event(event))
+        event_count += 1
+
+    # Let the joins and account data writes still pending complete.
+    while clock.calls:
+        advance_to(clock.calls[0].getTime())
+
+    decisions = {
+        key: value - decisions_before.get(key, 0.0)
+        for key, value in _snapshot_decisions().items()
+    }
+    latencies = homeserver.join_latencies
+    return {
+        "events": event_count,
+        "duration": clock.seconds(),
+        "decisions": {key: int(value) for key, value in decisions.items() if value},
+        "joins": len(latencies),
+        "join_attempts": sum(homeserver.join_attempts.values()),
+        "join_latency": _summarise(latencies),
+        "account_data_reads": homeserver.account_data_reads,
+        "account_data_writes": homeserver.account_data_writes,
+    }
+
+
+def _summarise(values: List[float]) -> Optional[Dict[str, Optional[float]]]:
+    """Returns the distribution of some durations, or None if there aren't any."""
+    if not values:
+        return None
+    return {
+        "min": min(values),
+        "mean": statistics.mean(values),
+        "p50": percentile(values, 0.5),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "max": max(values),
+    }
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="python -m tests.replay", description=__doc__)
+    parser.add_argument(
+        "events_file",
+        type=argparse.FileType("r"),
+        help="the JSON Lines file to read events from, or - for the standard input",
+    )
+    parser.add_argument(
+        "--config",
+        type=json.loads,
+        default={},
+        help="the module's configuration, as a JSON object",
+    )
+    parser.add_argument(
+        "--join-latency",
+        type=float,
+        default=0.5,
+        help="how long, in seconds, joining a room takes",
+    )
+    parser.add_argument(
+        "--account-data-latency",
+        type=float,
+        default=0.05,
+        help="how long, in seconds, reading or writing account data takes",
+    )
+    parser.add_argument(
+        "--real-time",
+        action="store_true",
+        help="replay the events at the pace they were recorded at, rather than on"
+        " virtual time",
+    )
+    args = parser.parse_args(argv)
+
+    report = replay(
+        read_events(args.events_file),
+        args.config,
+        join_latency=args.join_latency,
+        account_data_latency=args.account_data_latency,
+        real_time=args.real_time,
+    )
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
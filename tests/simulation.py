@@ -0,0 +1,148 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import math
+from typing import Any, Counter, Dict, List, Optional, Sequence, Tuple, cast
+from unittest.mock import Mock
+
+from synapse.logging.context import make_deferred_yieldable
+from twisted.internet import defer, task
+
+from synapse_auto_accept_invite import InviteAutoAccepter
+from tests import MockEvent, create_module
+
+
+class SimulatedHomeserver:
+    """Runs the module against a stand-in for the homeserver, for benchmarks and
+    simulations.
+
+    Time is virtual, and comes from `clock`. Joins and account data accesses take the
+    configured latency on that clock, and are recorded so that runs can be reported
+    on.
+
+    Args:
+        config: the module's configuration.
+        clock: the clock to run on.
+        join_latency: how long, in seconds, each call to `update_room_membership`
+            takes.
+        account_data_latency: how long, in seconds, each read or write of account
+            data takes.
+    """
+
+    def __init__(
+        self,
+        config: Dict[str, Any],
+        clock: task.Clock,
+        join_latency: float = 0.0,
+        account_data_latency: float = 0.0,
+    ):
+        self.clock = clock
+        self.join_latency = join_latency
+        self.account_data_latency = account_data_latency
+
+        # When each invite was received, in milliseconds, keyed by user and room.
+        self.invited_at: Dict[Tuple[str, str], int] = {}
+        # How long each completed join took from its invite, in seconds.
+        self.join_latencies: List[float] = []
+        # How many times joining each room was attempted, keyed by user and room.
+        self.join_attempts: Counter[Tuple[str, str]] = collections.Counter()
+        self.account_data_reads = 0
+        self.account_data_writes = 0
+
+        self.module: InviteAutoAccepter = create_module(config_override=config)
+        api = cast(Mock, self.module._api)
+        api.get_current_time_msec.side_effect = self.now_msec
+        api.sleep.side_effect = self.sleep
+        api.update_room_membership.side_effect = self._update_room_membership
+        api.account_data_manager.get_global.side_effect = self._get_account_data
+        api.account_data_manager.put_global.side_effect = self._put_account_data
+
+    def now_msec(self) -> int:
+        return int(self.clock.seconds() * 1000)
+
+    async def sleep(self, seconds: float) -> None:
+        d: "defer.Deferred[None]" = defer.Deferred()
+        self.clock.callLater(seconds, d.callback, None)
+        # Follow Synapse's logcontext rules, as its own sleep does.
+        await make_deferred_yieldable(d)
+
+    async def send_event(self, event: MockEvent) -> None:
+        """Hands an event to the module, as Synapse would when persisting it."""
+        if (
+            event.type == "m.room.member"
+            and event.state_key is not None
+            and event.content.get("membership") == "invite"
+        ):
+            self.invited_at.setdefault(
+                (event.state_key, event.room_id), self.now_msec()
+            )
+        # Stop mypy from complaining that we give on_new_event a MockEvent rather than
+        # an EventBase.
+        await self.module.on_new_event(event)  # type: ignore[arg-type]
+
+    def run_until_idle(self) -> None:
+        """Advances a virtual clock until nothing is left to run."""
+        # The clock keeps its pending calls sorted by time.
+        while self.clock.calls:
+            self.clock.advance(
+                max(self.clock.calls[0].getTime() - self.clock.seconds(), 0)
+            )
+
+    async def attempt_join(self, user_id: str, room_id: str, attempt: int) -> None:
+        """Makes an attempt at joining a room, raising if it fails. Takes the join
+        latency and never fails by default.
+
+        Args:
+            user_id: the user joining the room.
+            room_id: the room to join.
+            attempt: the number of this attempt at joining the room, starting from 1.
+        """
+        await self.sleep(self.join_latency)
+
+    async def _update_room_membership(
+        self, sender: str, target: str, room_id: str, new_membership: str, **kwargs: Any
+    ) -> MockEvent:
+        self.join_attempts[(target, room_id)] += 1
+        await self.attempt_join(target, room_id, self.join_attempts[(target, room_id)])
+
+        invited_at = self.invited_at.get((target, room_id))
+        if invited_at is not None:
+            self.join_latencies.append((self.now_msec() - invited_at) / 1000)
+        return MockEvent(
+            sender=sender,
+            state_key=target,
+            room_id=room_id,
+            type="m.room.member",
+            content={"membership": new_membership},
+        )
+
+    def _get_account_data(self, user_id: str, data_type: str) -> "defer.Deferred[None]":
+        self.account_data_reads += 1
+        return defer.ensureDeferred(self.sleep(self.account_data_latency))
+
+    def _put_account_data(
+        self, user_id: str, data_type: str, content: Any
+    ) -> "defer.Deferred[None]":
+        self.account_data_writes += 1
+        return defer.ensureDeferred(self.sleep(self.account_data_latency))
+
+
+def percentile(values: Sequence[float], fraction: float) -> Optional[float]:
+    """Returns the given percentile of some values, using the nearest-rank method, or
+    None if there aren't any.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
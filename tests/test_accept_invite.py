@@ -17,8 +17,15 @@ from unittest.mock import Mock
 
 import aiounittest
 from frozendict import frozendict
+from synapse.module_api.errors import ConfigError
 
 from synapse_auto_accept_invite import InviteAutoAccepter
+from synapse_auto_accept_invite.scheduler import (
+    LANE_DIRECT_MESSAGE,
+    LANE_FEDERATED,
+    LANE_LARGE_ROOM,
+    LANE_LOCAL,
+)
 from tests import MockEvent, create_module, make_awaitable
 
 
@@ -195,6 +202,77 @@ class InviteAutoAccepterTestCase(aiounittest.AsyncTestCase):
             },
         )
 
+    async def test_direct_message_not_marked_if_join_fails(self) -> None:
+        """Tests that the room isn't marked as a direct message if the module didn't
+        manage to make the invitee join it.
+        """
+        invite = MockEvent(
+            sender=self.user_id,
+            state_key=self.invitee,
+            type="m.room.member",
+            content={"membership": "invite", "is_direct": True},
+        )
+        self.mocked_update_membership.side_effect = Exception()
+
+        # Stop mypy from complaining that we give on_new_event a MockEvent rather than an
+        # EventBase.
+        await self.module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+        await self.retry_assertions(
+            self.mocked_update_membership,
+            5,
+            sender=invite.state_key,
+            target=invite.state_key,
+            room_id=invite.room_id,
+            new_membership="join",
+        )
+
+        cast(Mock, self.module._api.account_data_manager.get_global).assert_not_called()
+        cast(Mock, self.module._api.account_data_manager.put_global).assert_not_called()
+
+    async def test_skip_join_if_already_joined(self) -> None:
+        """Tests that the module doesn't try to make the invitee join the room if they're
+        already in it, but still marks the room as a direct message.
+        """
+        invite = MockEvent(
+            sender=self.user_id,
+            state_key=self.invitee,
+            type="m.room.member",
+            content={"membership": "invite", "is_direct": True},
+            room_id="!the:room",
+        )
+
+        member_event = MockEvent(
+            sender=self.invitee,
+            state_key=self.invitee,
+            type="m.room.member",
+            content={"membership": "join"},
+            room_id="!the:room",
+        )
+        get_room_state = cast(Mock, self.module._api.get_room_state)
+        get_room_state.return_value = {("m.room.member", self.invitee): member_event}
+
+        account_data_put: Mock = cast(
+            Mock, self.module._api.account_data_manager.put_global
+        )
+        account_data_put.return_value = make_awaitable(None)
+        account_data_get: Mock = cast(
+            Mock, self.module._api.account_data_manager.get_global
+        )
+        account_data_get.return_value = make_awaitable({})
+
+        # Stop mypy from complaining that we give on_new_event a MockEvent rather than an
+        # EventBase.
+        await self.module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+        get_room_state.assert_called_once_with(
+            "!the:room", [("m.room.member", self.invitee)]
+        )
+        self.mocked_update_membership.assert_not_called()
+        account_data_put.assert_called_once_with(
+            self.invitee, "m.direct", {self.user_id: ("!the:room",)}
+        )
+
     async def test_invite_remote_user(self) -> None:
         """Tests that receiving an invite for a remote user does nothing."""
         invite = MockEvent(
@@ -417,6 +495,26 @@ class InviteAutoAccepterTestCase(aiounittest.AsyncTestCase):
         mocked_update_membership: Mock = module._api.update_room_membership  # type: ignore[assignment]
         mocked_update_membership.assert_not_called()
 
+    def test_lanes(self) -> None:
+        """Tests that invites are queued in the right lane, according to whether they're
+        for direct messages, from local users, or to rooms that look large.
+        """
+        public_room_state = [
+            {"type": "m.room.join_rules", "content": {"join_rule": "public"}}
+        ]
+        crowded_room_state = [
+            {"type": "m.room.member", "state_key": f"@user{i}:remote"}
+            for i in range(50)
+        ]
+
+        get_lane = self.module._get_lane
+        self.assertEqual(get_lane(True, False, public_room_state), LANE_DIRECT_MESSAGE)
+        self.assertEqual(get_lane(False, True, public_room_state), LANE_LOCAL)
+        self.assertEqual(get_lane(False, False, public_room_state), LANE_LARGE_ROOM)
+        self.assertEqual(get_lane(False, False, crowded_room_state), LANE_LARGE_ROOM)
+        self.assertEqual(get_lane(False, False, crowded_room_state[1:]), LANE_FEDERATED)
+        self.assertEqual(get_lane(False, False, None), LANE_FEDERATED)
+
     def test_config_parse(self) -> None:
         """Tests that a correct configuration passes parse_config."""
         config = {
@@ -428,6 +526,22 @@ class InviteAutoAccepterTestCase(aiounittest.AsyncTestCase):
         self.assertTrue(parsed_config.accept_invites_only_for_direct_messages)
         self.assertTrue(parsed_config.accept_invites_only_from_local_users)
 
+    def test_config_parse_booleans(self) -> None:
+        """Tests that boolean options must be given as booleans, so that e.g. the
+        string "false" doesn't turn them on.
+        """
+        for name in (
+            "persist_pending_joins",
+            "sweep_missed_invites",
+            "enable_tracing",
+            "direct_message_remove_left_rooms",
+        ):
+            with self.assertRaises(ConfigError):
+                InviteAutoAccepter.parse_config({name: "false"})
+            self.assertTrue(
+                getattr(InviteAutoAccepter.parse_config({name: True}), name)
+            )
+
     def test_runs_on_only_one_worker(self) -> None:
         """
         Tests that the module only runs on the specified worker.
@@ -453,6 +567,50 @@ class InviteAutoAccepterTestCase(aiounittest.AsyncTestCase):
             Mock, specified_module._api.register_third_party_rules_callbacks
         ).assert_called_once()
 
+    async def test_shards_invitees_across_workers(self) -> None:
+        """
+        Tests that, when several workers are configured, each invite is accepted by
+        exactly one of them.
+        """
+        config = {"worker_to_run_on": ["accepter1", "accepter2"]}
+        modules = [
+            create_module(config_override=config, worker_name=worker_name)
+            for worker_name in ("accepter1", "accepter2")
+        ]
+
+        invitees = [f"@user{i}:test" for i in range(20)]
+        for module in modules:
+            cast(
+                Mock, module._api.register_third_party_rules_callbacks
+            ).assert_called_once()
+
+            for invitee in invitees:
+                invite = MockEvent(
+                    sender=self.user_id,
+                    state_key=invitee,
+                    type="m.room.member",
+                    content={"membership": "invite"},
+                )
+                # Stop mypy from complaining that we give on_new_event a MockEvent
+                # rather than an EventBase.
+                await module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+        joined = [
+            [
+                call[1]["target"]
+                for call in cast(
+                    Mock, module._api.update_room_membership
+                ).call_args_list
+            ]
+            for module in modules
+        ]
+
+        # Both workers got a share of the invites, and between them they accepted each
+        # invite once.
+        self.assertTrue(joined[0])
+        self.assertTrue(joined[1])
+        self.assertCountEqual(joined[0] + joined[1], invitees)
+
     async def retry_assertions(
         self, mock: Mock, call_count: int, **kwargs: Any
     ) -> None:
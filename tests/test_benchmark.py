@@ -0,0 +1,28 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import aiounittest
+
+from tests.benchmark import run_benchmark
+
+
+class BenchmarkTestCase(aiounittest.AsyncTestCase):
+    def test_benchmark(self) -> None:
+        """Tests that the benchmark runs, and that every invite in it gets accepted."""
+        results = run_benchmark(events=200, invite_ratio=0.5, join_latency=1.0)
+
+        self.assertGreater(results["invites"], 0)
+        self.assertEqual(results["joins"], results["invites"])
+        # Every join takes at least as long as the latency of the join itself.
+        self.assertGreaterEqual(results["time_to_join_p50"], 1.0)
+        self.assertGreater(results["peak_memory_bytes"], 0)
@@ -0,0 +1,156 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Any, List, Tuple, cast
+from unittest.mock import Mock
+
+import aiounittest
+from synapse.module_api.errors import SynapseError
+
+from synapse_auto_accept_invite.circuit_breaker import CircuitBreaker
+from tests import MockEvent, create_module
+
+
+class CircuitBreakerTestCase(aiounittest.AsyncTestCase):
+    def test_open_probe_and_close(self) -> None:
+        """Tests that the circuit opens after enough failures in a row, lets a single
+        probe through once the timeout has passed, and closes if the probe succeeds.
+        """
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout_ms=1000)
+
+        self.assertTrue(breaker.start_attempt("dead.example", 0))
+        breaker.record_failure("dead.example", 0)
+        self.assertFalse(breaker.is_open("dead.example", 0))
+
+        breaker.record_failure("dead.example", 0)
+        self.assertTrue(breaker.is_open("dead.example", 0))
+        self.assertFalse(breaker.start_attempt("dead.example", 999))
+        self.assertEqual(breaker.get_retry_time("dead.example", 999), 1000)
+
+        # Other servers and local joins aren't affected.
+        self.assertTrue(breaker.start_attempt("alive.example", 0))
+        self.assertTrue(breaker.start_attempt(None, 0))
+
+        # A failed probe keeps the circuit open for another timeout.
+        self.assertTrue(breaker.start_attempt("dead.example", 1000))
+        self.assertFalse(breaker.start_attempt("dead.example", 1000))
+        breaker.record_failure("dead.example", 1500)
+        self.assertFalse(breaker.start_attempt("dead.example", 2000))
+
+        self.assertTrue(breaker.start_attempt("dead.example", 2500))
+        breaker.record_success("dead.example")
+        self.assertFalse(breaker.is_open("dead.example", 2500))
+        self.assertTrue(breaker.start_attempt("dead.example", 2500))
+
+    async def test_park_joins_while_open(self) -> None:
+        """Tests that the module stops attempting joins through a server once its
+        circuit opens, and resumes them once a probe has succeeded.
+        """
+        module = create_module(
+            config_override={
+                "circuit_breaker_failure_threshold": 2,
+                "circuit_breaker_reset_timeout": 30,
+                "max_concurrent_joins_per_server": 1,
+            }
+        )
+        api = cast(Any, module._api)
+
+        # Run on a virtual clock, which sleeping advances.
+        now = [0]
+        api.get_current_time_msec.side_effect = lambda: now[0]
+
+        async def sleep(seconds: float) -> None:
+            now[0] += int(seconds * 1000)
+
+        api.sleep.side_effect = sleep
+
+        attempts: List[Tuple[str, int]] = []
+
+        async def update_room_membership(target: str, **kwargs: Any) -> MockEvent:
+            attempts.append((target, now[0]))
+            if len(attempts) <= 2:
+                raise Exception("Connection refused")
+            return MockEvent(
+                sender=target,
+                state_key=target,
+                type="m.room.member",
+                content={"membership": "join"},
+            )
+
+        cast(Mock, api.update_room_membership).side_effect = update_room_membership
+
+        for invitee in ("@lesley:test", "@peter:test"):
+            invite = MockEvent(
+                sender="@inviter:dead.example",
+                state_key=invitee,
+                type="m.room.member",
+                content={"membership": "invite"},
+            )
+            # Stop mypy from complaining that we give on_new_event a MockEvent rather
+            # than an EventBase.
+            await module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+        # After the second failure the circuit opened, so the first join was parked
+        # until it could be used as a probe, 30 seconds later. Once the probe
+        # succeeded, the second join went through straight away.
+        self.assertEqual(
+            [target for target, _ in attempts],
+            ["@lesley:test", "@lesley:test", "@lesley:test", "@peter:test"],
+        )
+        self.assertGreaterEqual(attempts[2][1] - attempts[1][1], 30000)
+        self.assertEqual(attempts[3][1], attempts[2][1])
+        self.assertEqual(module._join_scheduler.in_flight_count, 0)
+        self.assertEqual(module._join_scheduler.queued_count, 0)
+
+    async def test_client_errors_dont_open_circuit(self) -> None:
+        """Tests that joins rejected by a remote server that is up, e.g. because it
+        hasn't processed its own invite yet, don't open the circuit for that server.
+        """
+        module = create_module(
+            config_override={
+                "circuit_breaker_failure_threshold": 2,
+                "circuit_breaker_reset_timeout": 300,
+                "join_retry_federation_race_window": 60,
+            }
+        )
+        api = cast(Any, module._api)
+
+        attempts: List[Tuple[str, int]] = []
+
+        async def update_room_membership(target: str, **kwargs: Any) -> MockEvent:
+            attempts.append((target, api.get_current_time_msec()))
+            if len(attempts) <= 3:
+                raise SynapseError(404, "Unknown room")
+            return MockEvent(
+                sender=target,
+                state_key=target,
+                type="m.room.member",
+                content={"membership": "join"},
+            )
+
+        cast(Mock, api.update_room_membership).side_effect = update_room_membership
+
+        invite = MockEvent(
+            sender="@inviter:slow.example",
+            state_key="@lesley:test",
+            type="m.room.member",
+            content={"membership": "invite"},
+        )
+        # Stop mypy from complaining that we give on_new_event a MockEvent rather
+        # than an EventBase.
+        await module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+        # The join was retried until it succeeded, without ever being held back by
+        # the circuit for the inviter's server.
+        self.assertEqual([target for target, _ in attempts], ["@lesley:test"] * 4)
+        self.assertLess(attempts[-1][1] - attempts[0][1], 300000)
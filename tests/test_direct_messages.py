@@ -0,0 +1,193 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Any, List, cast
+from unittest.mock import Mock, patch
+
+import aiounittest
+from frozendict import frozendict
+from twisted.internet import defer
+
+from synapse_auto_accept_invite import direct_messages
+from synapse_auto_accept_invite.direct_messages import DirectMessageMarker
+from synapse_auto_accept_invite.profiling import Profiler
+from synapse_auto_accept_invite.tracing import Tracer
+from tests import create_module, make_awaitable, make_multiple_awaitable
+
+
+class DirectMessageMarkerTestCase(aiounittest.AsyncTestCase):
+    def setUp(self) -> None:
+        self.api = create_module()._api
+        self.marker = DirectMessageMarker(
+            self.api, 0.5, Tracer(False), Profiler(0, 0, None)
+        )
+
+        # We know our module API is a mock, but mypy doesn't.
+        self.sleep = cast(Mock, self.api.sleep)
+        self.account_data_get = cast(Mock, self.api.account_data_manager.get_global)
+        self.account_data_put = cast(Mock, self.api.account_data_manager.put_global)
+        self.account_data_get.return_value = make_awaitable(
+            frozendict({"@someone:random": ("!somewhere:random",)})
+        )
+        self.account_data_put.return_value = make_multiple_awaitable(None)
+
+    def test_coalesces_writes(self) -> None:
+        """Tests that rooms marked as direct messages for the same user within the
+        batching interval are written in a single account data update.
+        """
+        batch_interval_elapsed: "defer.Deferred[None]" = defer.Deferred()
+
+        async def sleep(seconds: float) -> None:
+            await batch_interval_elapsed
+
+        self.sleep.side_effect = sleep
+
+        self.marker.mark_room_as_direct_message(
+            "@lesley:test", "@someone:random", "!other:random"
+        )
+        self.marker.mark_room_as_direct_message(
+            "@lesley:test", "@peter:test", "!the:room"
+        )
+
+        # Nothing should be written before the end of the batching interval.
+        self.account_data_get.assert_not_called()
+        self.account_data_put.assert_not_called()
+
+        batch_interval_elapsed.callback(None)
+
+        self.account_data_get.assert_called_once_with("@lesley:test", "m.direct")
+        self.account_data_put.assert_called_once_with(
+            "@lesley:test",
+            "m.direct",
+            {
+                "@someone:random": ("!somewhere:random", "!other:random"),
+                "@peter:test": ("!the:room",),
+            },
+        )
+
+    def test_does_not_add_rooms_twice(self) -> None:
+        """Tests that a room that's already marked as a direct message isn't added to the
+        list again.
+        """
+        self.marker.mark_room_as_direct_message(
+            "@lesley:test", "@someone:random", "!somewhere:random"
+        )
+
+        self.account_data_get.assert_called_once_with("@lesley:test", "m.direct")
+        self.account_data_put.assert_not_called()
+
+    def test_does_not_mangle_unknown_data(self) -> None:
+        """Tests that the account data isn't rewritten if the entry for the
+        counterparty isn't a list of rooms.
+        """
+        self.account_data_get.return_value = make_awaitable(
+            frozendict({"@someone:random": "!somewhere:random"})
+        )
+
+        self.marker.mark_room_as_direct_message(
+            "@lesley:test", "@someone:random", "!other:random"
+        )
+
+        self.account_data_get.assert_called_once_with("@lesley:test", "m.direct")
+        self.account_data_put.assert_not_called()
+
+    def test_rereads_direct_messages(self) -> None:
+        """Tests that the m.direct content of a user is fetched again for every write,
+        so that changes made in the meantime (e.g. by a client, possibly through
+        another worker) aren't overwritten.
+        """
+        self.account_data_get.return_value = make_multiple_awaitable(
+            frozendict({"@someone:random": ("!somewhere:random",)})
+        )
+        self.marker.mark_room_as_direct_message(
+            "@lesley:test", "@peter:test", "!first:test"
+        )
+
+        # A client rewrites the user's m.direct content.
+        self.account_data_get.return_value = make_awaitable(
+            frozendict({"@peter:test": ("!first:test",)})
+        )
+        self.marker.mark_room_as_direct_message(
+            "@lesley:test", "@peter:test", "!second:test"
+        )
+
+        self.assertEqual(self.account_data_get.call_count, 2)
+        self.account_data_put.assert_called_with(
+            "@lesley:test",
+            "m.direct",
+            {"@peter:test": ("!first:test", "!second:test")},
+        )
+
+    def test_merges_idempotently(self) -> None:
+        """Tests that marking the same room several times only adds it once, and that
+        duplicates already in the list are dropped when it's rewritten.
+        """
+        # Serve whatever was last written, like Synapse would.
+        content: List[Any] = [
+            frozendict({"@someone:random": ("!somewhere:random", "!somewhere:random")})
+        ]
+
+        def put_global(user_id: str, data_type: str, new_content: Any) -> Any:
+            content[0] = new_content
+            return make_awaitable(None)
+
+        self.account_data_get.side_effect = lambda *args: make_awaitable(content[0])
+        self.account_data_put.side_effect = put_global
+
+        with patch.object(direct_messages.logger, "exception") as log_exception:
+            # Sleeping returns straight away, so each room is written separately.
+            for room_id in ("!other:random", "!other:random", "!somewhere:random"):
+                self.marker.mark_room_as_direct_message(
+                    "@lesley:test", "@someone:random", room_id
+                )
+
+        log_exception.assert_not_called()
+        self.assertEqual(self.account_data_get.call_count, 3)
+        self.account_data_put.assert_called_once_with(
+            "@lesley:test",
+            "m.direct",
+            {"@someone:random": ("!somewhere:random", "!other:random")},
+        )
+
+    def test_compacts_rooms(self) -> None:
+        """Tests that rooms the user has left are removed when compaction is enabled,
+        and that only the most recent rooms are kept for each counterparty.
+        """
+        marker = DirectMessageMarker(
+            self.api,
+            0.5,
+            Tracer(False),
+            Profiler(0, 0, None),
+            max_rooms_per_counterparty=2,
+            remove_left_rooms=True,
+        )
+        self.account_data_get.return_value = make_awaitable(
+            frozendict(
+                {
+                    "@someone:random": ("!first:random", "!second:random"),
+                    "@peter:test": ("!left:test",),
+                }
+            )
+        )
+        run_db_interaction = cast(Mock, self.api.run_db_interaction)
+        run_db_interaction.return_value = make_awaitable(frozenset({"!left:test"}))
+
+        marker.mark_room_as_direct_message(
+            "@lesley:test", "@someone:random", "!third:random"
+        )
+
+        self.account_data_put.assert_called_once_with(
+            "@lesley:test",
+            "m.direct",
+            {"@someone:random": ("!second:random", "!third:random")},
+        )
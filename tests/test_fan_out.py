@@ -0,0 +1,119 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Any, Dict, List, Optional, Tuple, cast
+from unittest.mock import Mock
+
+import aiounittest
+from twisted.internet import defer
+
+from synapse_auto_accept_invite import InviteAutoAccepter
+from tests import MockEvent, create_module
+
+
+class FanOutTestCase(aiounittest.AsyncTestCase):
+    def setUp(self) -> None:
+        # The join attempts made, with the time they were made at.
+        self.attempts: List[Tuple[str, int]] = []
+        # Joins to block until the test resolves them, keyed by user ID, and the
+        # users whose joins should fail.
+        self.blocked: Dict[str, "defer.Deferred[None]"] = {}
+        self.failing: List[str] = []
+
+    def create_module(self, config: Dict[str, Any]) -> InviteAutoAccepter:
+        module = create_module(config_override=config)
+        api = cast(Any, module._api)
+
+        # Run on a virtual clock, which sleeping advances.
+        self.now = 0
+        api.get_current_time_msec.side_effect = lambda: self.now
+
+        async def sleep(seconds: float) -> None:
+            self.now += int(seconds * 1000)
+
+        api.sleep.side_effect = sleep
+
+        async def update_room_membership(target: str, **kwargs: Any) -> MockEvent:
+            self.attempts.append((target, self.now))
+            if target in self.blocked:
+                await self.blocked[target]
+            if target in self.failing:
+                raise Exception("Failed to join")
+            return MockEvent(
+                sender=target,
+                state_key=target,
+                type="m.room.member",
+                content={"membership": "join"},
+            )
+
+        cast(Mock, api.update_room_membership).side_effect = update_room_membership
+        return module
+
+    async def invite(
+        self, module: InviteAutoAccepter, invitee: str, inviter: str = "@a:remote"
+    ) -> None:
+        invite = MockEvent(
+            sender=inviter,
+            state_key=invitee,
+            type="m.room.member",
+            content={"membership": "invite"},
+            room_id="!room:remote",
+        )
+        # Stop mypy from complaining that we give on_new_event a MockEvent rather than
+        # an EventBase.
+        await module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+    def attempted_by(self, at: Optional[int] = None) -> List[str]:
+        return [user for user, time in self.attempts if at is None or time == at]
+
+    async def test_join_in_batches_after_leader(self) -> None:
+        """Tests that other invitees wait for the first one to join the room, then join
+        it in paced batches.
+        """
+        module = self.create_module(
+            {"fan_out_batch_size": 2, "fan_out_batch_interval": 1}
+        )
+        self.blocked["@user0:test"] = defer.Deferred()
+
+        for i in range(5):
+            await self.invite(module, f"@user{i}:test")
+        self.assertEqual(self.attempted_by(), ["@user0:test"])
+        self.assertEqual(module._fan_out.waiting_count, 4)
+
+        self.now = 10000
+        self.blocked["@user0:test"].callback(None)
+
+        self.assertEqual(self.attempted_by(10000), ["@user1:test", "@user2:test"])
+        self.assertEqual(self.attempted_by(11000), ["@user3:test", "@user4:test"])
+        self.assertEqual(module._fan_out.waiting_count, 0)
+        self.assertEqual(module._fan_out._rooms, {})
+
+    async def test_promote_next_leader(self) -> None:
+        """Tests that, if the first invitee fails to join the room, the next one in line
+        tries, and that invites from local users don't wait.
+        """
+        module = self.create_module({"join_retry_max_attempts": 1})
+        self.blocked["@user0:test"] = defer.Deferred()
+        self.failing.append("@user0:test")
+
+        await self.invite(module, "@user0:test")
+        await self.invite(module, "@user1:test")
+        await self.invite(module, "@user2:test")
+        await self.invite(module, "@local:test", inviter="@a:test")
+        self.assertEqual(self.attempted_by(), ["@user0:test", "@local:test"])
+
+        self.blocked["@user0:test"].callback(None)
+        self.assertEqual(
+            self.attempted_by(),
+            ["@user0:test", "@local:test", "@user1:test", "@user2:test"],
+        )
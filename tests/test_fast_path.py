@@ -0,0 +1,123 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Any, List, cast
+from unittest.mock import Mock
+
+import aiounittest
+
+from tests import MockEvent, create_module
+
+
+class TrackedContent(dict):  # type: ignore[type-arg]
+    """An event content dict that counts how many times it's been read from."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.reads = 0
+
+    def get(self, *args: Any, **kwargs: Any) -> Any:
+        self.reads += 1
+        return super().get(*args, **kwargs)
+
+
+def make_non_invite_events() -> List[MockEvent]:
+    """Builds a mix of events resembling the traffic of a busy homeserver, where
+    messages largely dominate, and none of which is an invite.
+    """
+    events: List[MockEvent] = []
+
+    for i in range(80):
+        events.append(
+            MockEvent(
+                sender=f"@user{i}:test",
+                type="m.room.message",
+                content=TrackedContent({"msgtype": "m.text", "body": "hello"}),
+            )
+        )
+
+    for i in range(5):
+        events.append(
+            MockEvent(
+                sender=f"@user{i}:remote",
+                type="m.reaction",
+                content=TrackedContent({}),
+            )
+        )
+        events.append(
+            MockEvent(
+                sender=f"@user{i}:test",
+                state_key="",
+                type="m.room.topic",
+                content=TrackedContent({"topic": "things"}),
+            )
+        )
+
+    for membership in ("join", "leave"):
+        for i in range(5):
+            events.append(
+                MockEvent(
+                    sender=f"@user{i}:remote",
+                    state_key=f"@user{i}:remote",
+                    type="m.room.member",
+                    content=TrackedContent({"membership": membership}),
+                )
+            )
+
+    return events
+
+
+class FastPathTestCase(aiounittest.AsyncTestCase):
+    async def test_rejection_path(self) -> None:
+        """Tests that events that aren't invites are rejected based only on their type,
+        state key and membership, without calling into the homeserver.
+
+        How much rejecting them costs is measured by `tests.benchmark`, rather than
+        here, as timings are too noisy to assert on.
+        """
+        module = create_module(
+            config_override={
+                "accept_invites_only_for_direct_messages": True,
+                "accept_invites_only_from_local_users": True,
+            }
+        )
+        events = make_non_invite_events()
+
+        for event in events:
+            # Stop mypy from complaining that we give on_new_event a MockEvent rather
+            # than an EventBase.
+            await module.on_new_event(event)  # type: ignore[arg-type]
+
+        cast(Mock, module._api.is_mine).assert_not_called()
+        cast(Mock, module._api.update_room_membership).assert_not_called()
+        for event in events:
+            self.assertEqual(cast(TrackedContent, event.content).reads, 0)
+
+    async def test_remote_invitee_rejection_path(self) -> None:
+        """Tests that invites for remote users are rejected before looking at the rest
+        of their content.
+        """
+        module = create_module()
+        invite = MockEvent(
+            sender="@peter:test",
+            state_key="@thomas:remote",
+            type="m.room.member",
+            content=TrackedContent({"membership": "invite", "is_direct": True}),
+        )
+
+        # Stop mypy from complaining that we give on_new_event a MockEvent rather than
+        # an EventBase.
+        await module.on_new_event(invite)  # type: ignore[arg-type]
+
+        cast(Mock, module._api.is_mine).assert_called_once_with("@thomas:remote")
+        self.assertEqual(cast(TrackedContent, invite.content).reads, 0)
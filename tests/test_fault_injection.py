@@ -0,0 +1,47 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import aiounittest
+
+from tests.fault_injection import Faults, simulate
+
+
+class FaultInjectionTestCase(aiounittest.AsyncTestCase):
+    def test_federation_race(self) -> None:
+        """Tests that joins failing with a 404 until the inviter's server catches up
+        are retried through, unless the policy gives up on 404s straight away.
+        """
+        faults = Faults(not_found_for=2, timeout_rate=0, forbidden_rate=0)
+
+        results = simulate({"join_retry_max_attempts": 10}, faults, invites=20)
+        self.assertEqual(results["joined"], 20)
+        self.assertEqual(results["give_up_rate"], 0)
+        self.assertGreater(results["wasted_attempts"], 0)
+        self.assertGreaterEqual(results["time_to_join_p50"], 2)
+
+        results = simulate(
+            {"join_retry_max_attempts": 10, "join_retry_federation_race_window": 0},
+            faults,
+            invites=20,
+        )
+        self.assertEqual(results["joined"], 0)
+        self.assertEqual(results["give_up_rate"], 1)
+
+    def test_deterministic(self) -> None:
+        """Tests that running the same simulation twice gives the same results."""
+        faults = Faults(timeout_rate=0.3, forbidden_rate=0.2)
+
+        self.assertEqual(
+            simulate({}, faults, invites=50, seed=3),
+            simulate({}, faults, invites=50, seed=3),
+        )
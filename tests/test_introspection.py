@@ -0,0 +1,111 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+from typing import Any, cast
+from unittest.mock import Mock
+
+import aiounittest
+from synapse.module_api.errors import SynapseError
+from twisted.internet import defer
+
+from synapse_auto_accept_invite.introspection import IntrospectionResource, RecentCounts
+from tests import MockEvent, create_module
+
+
+class IntrospectionTestCase(aiounittest.AsyncTestCase):
+    def test_recent_counts(self) -> None:
+        """Tests that only the occurrences within the window are counted."""
+        counts = RecentCounts(bucket_ms=1000, bucket_count=3)
+        counts.record("accepted", 0)
+        counts.record("accepted", 1500)
+        counts.record("received", 2999)
+        self.assertEqual(counts.get_counts(2999), {"accepted": 2, "received": 1})
+
+        # The first period has dropped out of the window.
+        self.assertEqual(counts.get_counts(3000), {"accepted": 1, "received": 1})
+        self.assertEqual(counts.get_counts(10000), {})
+
+    async def test_snapshot(self) -> None:
+        """Tests that the resource serves a snapshot of the pending joins and recent
+        invites to server admins only.
+        """
+        module = create_module(
+            config_override={
+                "accept_invites_only_from_local_users": True,
+                "introspection_resource_path": "/_synapse/client/auto_accept_invite",
+            }
+        )
+        api = cast(Mock, module._api)
+
+        path, resource = api.register_web_resource.call_args[0]
+        self.assertEqual(path, "/_synapse/client/auto_accept_invite")
+        self.assertIsInstance(resource, IntrospectionResource)
+
+        # Keep the join running, so that it shows up in the snapshot.
+        join_done: "defer.Deferred[Any]" = defer.Deferred()
+
+        async def update_room_membership(**kwargs: Any) -> Any:
+            return await join_done
+
+        api.update_room_membership.side_effect = update_room_membership
+
+        for inviter in ("@peter:test", "@thomas:remote"):
+            # Stop mypy from complaining that we give on_new_event a MockEvent rather
+            # than an EventBase.
+            await module.on_new_event(
+                MockEvent(
+                    sender=inviter,
+                    state_key="@lesley:test",
+                    type="m.room.member",
+                    room_id="!room:test",
+                    content={"membership": "invite"},
+                )  # type: ignore[arg-type]
+            )
+        await asyncio.sleep(0)
+
+        is_admin = False
+
+        async def get_user_by_req(request: Any) -> Any:
+            requester = Mock()
+            requester.user.to_string.return_value = "@admin:test"
+            return requester
+
+        async def is_user_admin(user_id: str) -> bool:
+            return is_admin
+
+        api.get_user_by_req.side_effect = get_user_by_req
+        api.is_user_admin.side_effect = is_user_admin
+
+        with self.assertRaises(SynapseError) as e:
+            await resource._async_render_GET(Mock())
+        self.assertEqual(e.exception.code, 403)
+
+        is_admin = True
+        code, snapshot = await resource._async_render_GET(Mock())
+        self.assertEqual(code, 200)
+
+        self.assertEqual(snapshot["joins"]["in_flight"], 1)
+        self.assertEqual(len(snapshot["joins"]["jobs"]), 1)
+        job = snapshot["joins"]["jobs"][0]
+        self.assertEqual(job["user_id"], "@lesley:test")
+        self.assertEqual(job["lane"], "local")
+        self.assertTrue(job["running"])
+        self.assertIsNone(job["next_attempt_at"])
+
+        recent_invites = snapshot["recent_invites"]
+        self.assertEqual(recent_invites["received"], 2)
+        self.assertEqual(recent_invites["accepted"], 1)
+        self.assertEqual(recent_invites["filtered"], {"not_from_local_user": 1})
+
+        join_done.callback(Mock())
@@ -0,0 +1,136 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Any, List, cast
+from unittest.mock import Mock
+
+import aiounittest
+from synapse.module_api.errors import ConfigError
+from twisted.internet import defer
+
+from synapse_auto_accept_invite import InviteAutoAccepter
+from synapse_auto_accept_invite.load_shedding import (
+    LOAD_SHEDDING_MODE_PRIORITY_ONLY,
+    LOAD_SHEDDING_MODE_REJECT_ALL,
+    LoadShedder,
+)
+from tests import MockEvent, create_module
+
+
+class LoadSheddingTestCase(aiounittest.AsyncTestCase):
+    def test_water_marks(self) -> None:
+        """Tests that load shedding starts at the high-water mark and stops below the
+        low-water mark.
+        """
+        shedder = LoadShedder(10, 5, LOAD_SHEDDING_MODE_REJECT_ALL)
+
+        self.assertTrue(shedder.should_accept(9, is_priority=False))
+        self.assertFalse(shedder.should_accept(10, is_priority=False))
+        self.assertFalse(shedder.should_accept(5, is_priority=True))
+
+        shedder.update(4)
+        self.assertFalse(shedder.shedding)
+        self.assertTrue(shedder.should_accept(9, is_priority=False))
+
+        # Load shedding is disabled with a high-water mark of 0.
+        self.assertTrue(
+            LoadShedder(0, 0, LOAD_SHEDDING_MODE_REJECT_ALL).should_accept(
+                1000, is_priority=False
+            )
+        )
+
+    def test_parse_config(self) -> None:
+        """Tests that water marks load shedding could never stop at are rejected, and
+        that the default low-water mark lets it stop.
+        """
+        for high_water_mark, low_water_mark in ((1, 0), (10, 11), (10, -1)):
+            with self.assertRaises(ConfigError):
+                InviteAutoAccepter.parse_config(
+                    {
+                        "load_shedding_high_water_mark": high_water_mark,
+                        "load_shedding_low_water_mark": low_water_mark,
+                    }
+                )
+
+        config = InviteAutoAccepter.parse_config({"load_shedding_high_water_mark": 1})
+        self.assertEqual(config.load_shedding_low_water_mark, 1)
+
+        shedder = LoadShedder(
+            config.load_shedding_high_water_mark,
+            config.load_shedding_low_water_mark,
+            config.load_shedding_mode,
+        )
+        shedder.update(1)
+        self.assertTrue(shedder.shedding)
+        shedder.update(0)
+        self.assertFalse(shedder.shedding)
+
+    async def test_priority_only(self) -> None:
+        """Tests that, in priority-only mode, the module keeps accepting invites for
+        direct messages and from local users while shedding load, and stops shedding
+        load once the joins have drained.
+        """
+        module = create_module(
+            config_override={
+                "load_shedding_high_water_mark": 2,
+                "load_shedding_low_water_mark": 1,
+                "load_shedding_mode": LOAD_SHEDDING_MODE_PRIORITY_ONLY,
+            }
+        )
+
+        # Block the joins until we're done sending invites.
+        joins: List["defer.Deferred[None]"] = []
+
+        async def update_room_membership(**kwargs: Any) -> MockEvent:
+            d: "defer.Deferred[None]" = defer.Deferred()
+            joins.append(d)
+            await d
+            return MockEvent(
+                sender=kwargs["target"],
+                state_key=kwargs["target"],
+                type="m.room.member",
+                content={"membership": "join"},
+            )
+
+        update_room_membership_mock = cast(Mock, module._api.update_room_membership)
+        update_room_membership_mock.side_effect = update_room_membership
+
+        for i, (inviter, is_direct) in enumerate(
+            [
+                ("@a:remote", False),
+                ("@b:remote", False),
+                ("@c:remote", False),
+                ("@d:remote", True),
+                ("@e:test", False),
+            ]
+        ):
+            invite = MockEvent(
+                sender=inviter,
+                state_key="@lesley:test",
+                type="m.room.member",
+                content={"membership": "invite", "is_direct": is_direct},
+                room_id=f"!room{i}:remote",
+            )
+            # Stop mypy from complaining that we give on_new_event a MockEvent rather
+            # than an EventBase.
+            await module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+        self.assertEqual(
+            [call[1]["room_id"] for call in update_room_membership_mock.call_args_list],
+            ["!room0:remote", "!room1:remote", "!room3:remote", "!room4:remote"],
+        )
+        self.assertTrue(module._load_shedder.shedding)
+
+        for d in joins:
+            d.callback(None)
+        self.assertFalse(module._load_shedder.shedding)
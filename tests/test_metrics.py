@@ -0,0 +1,96 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Dict, Optional, cast
+from unittest.mock import Mock
+
+import aiounittest
+from prometheus_client import REGISTRY
+
+from tests import MockEvent, create_module, make_awaitable
+
+
+def get_sample(name: str, labels: Optional[Dict[str, str]] = None) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class MetricsTestCase(aiounittest.AsyncTestCase):
+    async def test_pipeline_metrics(self) -> None:
+        """Tests that invites going through the module are reflected in its metrics."""
+        module = create_module(
+            config_override={"accept_invites_only_for_direct_messages": True}
+        )
+        update_room_membership = cast(Mock, module._api.update_room_membership)
+        update_room_membership.side_effect = [
+            Exception(),
+            MockEvent(
+                sender="@lesley:test",
+                state_key="@lesley:test",
+                type="m.room.member",
+                content={"membership": "join"},
+            ),
+        ]
+        account_data_manager = module._api.account_data_manager
+        cast(
+            Mock, account_data_manager.get_global
+        ).side_effect = lambda *args: make_awaitable(None)
+        cast(
+            Mock, account_data_manager.put_global
+        ).side_effect = lambda *args: make_awaitable(None)
+
+        names = {
+            "received": ("synapse_auto_accept_invite_invites_received_total", None),
+            "filtered": (
+                "synapse_auto_accept_invite_invites_filtered_total",
+                {"reason": "not_direct_message"},
+            ),
+            "accepted": ("synapse_auto_accept_invite_invites_accepted_total", None),
+            "failures": (
+                "synapse_auto_accept_invite_join_attempts_total",
+                {"outcome": "failure"},
+            ),
+            "successes": (
+                "synapse_auto_accept_invite_join_attempts_total",
+                {"outcome": "success"},
+            ),
+            "retries": (
+                "synapse_auto_accept_invite_join_retries_total",
+                {"origin": "remote"},
+            ),
+            "joined": ("synapse_auto_accept_invite_invite_to_join_seconds_count", None),
+        }
+        before = {key: get_sample(*name) for key, name in names.items()}
+
+        for is_direct in (False, True):
+            invite = MockEvent(
+                sender="@inviter:remote",
+                state_key="@lesley:test",
+                type="m.room.member",
+                content={"membership": "invite", "is_direct": is_direct},
+            )
+            # Stop mypy from complaining that we give on_new_event a MockEvent rather
+            # than an EventBase.
+            await module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+        self.assertEqual(
+            {key: get_sample(*name) - before[key] for key, name in names.items()},
+            {
+                "received": 2,
+                "filtered": 1,
+                "accepted": 1,
+                "failures": 1,
+                "successes": 1,
+                "retries": 1,
+                "joined": 1,
+            },
+        )
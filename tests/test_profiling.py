@@ -0,0 +1,140 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import pstats
+import tempfile
+from typing import Any, Dict, cast
+from unittest.mock import Mock
+
+import aiounittest
+
+from synapse_auto_accept_invite import InviteAutoAccepter
+from synapse_auto_accept_invite.profiling import DISABLED_INVOCATION, Profiler
+from tests import MockEvent, create_module, make_awaitable
+
+
+def create_module_with_invite(config: Dict[str, Any]) -> InviteAutoAccepter:
+    module = create_module(config_override=config)
+    cast(Mock, module._api.update_room_membership).return_value = MockEvent(
+        sender="@lesley:test",
+        state_key="@lesley:test",
+        type="m.room.member",
+        content={"membership": "join"},
+    )
+    account_data_manager = module._api.account_data_manager
+    cast(
+        Mock, account_data_manager.get_global
+    ).side_effect = lambda *args: make_awaitable(None)
+    cast(
+        Mock, account_data_manager.put_global
+    ).side_effect = lambda *args: make_awaitable(None)
+    return module
+
+
+INVITE = MockEvent(
+    sender="@inviter:remote",
+    state_key="@lesley:test",
+    room_id="!room:remote",
+    type="m.room.member",
+    content={"membership": "invite", "is_direct": True},
+)
+
+
+class ProfilingTestCase(aiounittest.AsyncTestCase):
+    def test_disabled(self) -> None:
+        """Tests that nothing is recorded when profiling is disabled."""
+        profiler = Profiler(0, 0, None)
+
+        with profiler.invocation("on_new_event", "@lesley:test") as invocation:
+            invocation.lap("filters")
+
+        self.assertIs(invocation, DISABLED_INVOCATION)
+        self.assertEqual(invocation.stages, {})
+
+    def test_only_captures_synchronous_sections(self) -> None:
+        """Tests that invocations which wait on I/O are timed but not captured, while
+        the synchronous sections within them are.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(0, 1, directory)
+
+            with profiler.invocation(
+                "mark_direct_messages", "@lesley:test", capture=False
+            ) as invocation:
+                invocation.lap("read")
+                with profiler.capture("mark_direct_messages_merge"):
+                    invocation.lap("merge")
+
+            self.assertEqual(set(invocation.stages), {"read", "merge"})
+            files = os.listdir(directory)
+            self.assertEqual(len(files), 1, files)
+            self.assertTrue(files[0].startswith("mark_direct_messages_merge-"), files)
+
+    async def test_logs_slow_invocations(self) -> None:
+        """Tests that invocations over the threshold are logged with the time spent
+        in each of their stages.
+        """
+        module = create_module_with_invite({"profiling_slow_threshold": 0.000001})
+
+        with self.assertLogs("synapse_auto_accept_invite.profiling") as logs:
+            # Stop mypy from complaining that we give on_new_event a MockEvent rather
+            # than an EventBase.
+            await module.on_new_event(event=INVITE)  # type: ignore[arg-type]
+
+        self.assertTrue(
+            any(
+                "Slow on_new_event for @lesley:test in !room:remote" in message
+                and "filters" in message
+                and "schedule" in message
+                for message in logs.output
+            ),
+            logs.output,
+        )
+        self.assertTrue(
+            any(
+                "Slow join for @lesley:test in !room:remote" in message
+                and "join_attempt" in message
+                for message in logs.output
+            ),
+            logs.output,
+        )
+        self.assertTrue(
+            any(
+                "Slow mark_direct_messages for @lesley:test:" in message
+                and "write" in message
+                for message in logs.output
+            ),
+            logs.output,
+        )
+
+    async def test_captures_samples(self) -> None:
+        """Tests that sampled invocations are captured with cProfile into the
+        configured directory, except for the parts that wait on I/O.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            module = create_module_with_invite(
+                {"profiling_sample_rate": 1, "profiling_directory": directory}
+            )
+
+            await module.on_new_event(event=INVITE)  # type: ignore[arg-type]
+
+            files = os.listdir(directory)
+            self.assertTrue(
+                any(name.startswith("on_new_event-") for name in files), files
+            )
+            # Joins wait on I/O, so they aren't captured.
+            self.assertFalse(any(name.startswith("join-") for name in files), files)
+            for name in files:
+                # Check that the profile can be loaded.
+                pstats.Stats(os.path.join(directory, name))
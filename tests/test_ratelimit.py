@@ -0,0 +1,80 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import cast
+from unittest.mock import Mock
+
+import aiounittest
+
+from synapse_auto_accept_invite.ratelimit import RateLimit, TokenBucketLimiter
+from tests import MockEvent, create_module
+
+
+class TokenBucketLimiterTestCase(aiounittest.AsyncTestCase):
+    def test_limit(self) -> None:
+        """Tests that actions are allowed in bursts, then at the configured rate."""
+        limiter = TokenBucketLimiter(RateLimit(per_second=1, burst_count=2), 100)
+
+        for _ in range(2):
+            self.assertTrue(limiter.can_perform("@spammer:remote", 0))
+            limiter.record_action("@spammer:remote", 0)
+        self.assertFalse(limiter.can_perform("@spammer:remote", 0))
+        self.assertTrue(limiter.can_perform("@someone:remote", 0))
+
+        self.assertFalse(limiter.can_perform("@spammer:remote", 999))
+        self.assertTrue(limiter.can_perform("@spammer:remote", 1000))
+
+    def test_bounded_state(self) -> None:
+        """Tests that the limiter drops buckets that have refilled, and never holds more
+        than the maximum number of buckets.
+        """
+        limiter = TokenBucketLimiter(RateLimit(per_second=1, burst_count=2), 100)
+
+        for i in range(1000):
+            limiter.record_action(f"@user{i}:remote", i)
+        self.assertEqual(len(limiter), 100)
+
+        # All of the buckets have refilled by now.
+        limiter.record_action("@late:remote", 10000)
+        self.assertEqual(len(limiter), 1)
+
+    async def test_rate_limit_invites(self) -> None:
+        """Tests that the module doesn't accept invites over the rate limits."""
+        module = create_module(
+            config_override={
+                "invite_rate_limit_per_inviter_server": {
+                    "per_second": 0.001,
+                    "burst_count": 2,
+                },
+            }
+        )
+        update_room_membership = cast(Mock, module._api.update_room_membership)
+
+        for inviter in ("@a:remote", "@b:remote", "@c:remote", "@d:test"):
+            invite = MockEvent(
+                sender=inviter,
+                state_key="@lesley:test",
+                type="m.room.member",
+                content={"membership": "invite"},
+                room_id=f"!room-{inviter}",
+            )
+            # Stop mypy from complaining that we give on_new_event a MockEvent rather
+            # than an EventBase.
+            await module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+        # The third invite from remote was over the limit, but invites from local users
+        # aren't limited per server.
+        self.assertEqual(
+            [call[1]["room_id"] for call in update_room_membership.call_args_list],
+            ["!room-@a:remote", "!room-@b:remote", "!room-@d:test"],
+        )
@@ -0,0 +1,75 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import json
+
+import aiounittest
+
+from tests.replay import read_events, replay
+
+
+class ReplayTestCase(aiounittest.AsyncTestCase):
+    def test_replay(self) -> None:
+        """Tests that replaying a log of events reports the decisions made by the
+        module, the latency of the joins and the account data writes.
+        """
+        entries = [
+            {
+                "type": "m.room.member",
+                "sender": "@inviter:remote",
+                "state_key": "@lesley:test",
+                "room_id": "!dm:remote",
+                "content": {"membership": "invite", "is_direct": True},
+                "timestamp": 1000,
+            },
+            {
+                "type": "m.room.message",
+                "sender": "@inviter:remote",
+                "room_id": "!dm:remote",
+                "content": {"body": "hello"},
+                "timestamp": 1500,
+            },
+            {
+                "type": "m.room.member",
+                "sender": "@inviter:remote",
+                "state_key": "@lesley:test",
+                "room_id": "!group:remote",
+                "content": {"membership": "invite"},
+                "timestamp": 3000,
+            },
+        ]
+        log = io.StringIO("\n".join(json.dumps(entry) for entry in entries))
+
+        report = replay(
+            read_events(log),
+            {"accept_invites_only_for_direct_messages": True},
+            join_latency=1.0,
+            account_data_latency=0.1,
+        )
+
+        self.assertEqual(report["events"], 3)
+        self.assertEqual(
+            report["decisions"],
+            {"received": 2, "accepted": 1, "filtered.not_direct_message": 1},
+        )
+        self.assertEqual(report["joins"], 1)
+        self.assertEqual(report["join_latency"]["p50"], 1.0)
+        self.assertEqual(report["account_data_writes"], 1)
+
+    def test_invalid_event(self) -> None:
+        """Tests that a log with a missing field is rejected with its line number."""
+        log = io.StringIO('{"type": "m.room.message", "timestamp": 0}\n')
+
+        with self.assertRaisesRegex(ValueError, "line 1"):
+            list(read_events(log))
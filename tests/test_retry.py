@@ -0,0 +1,152 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Any, List, cast
+from unittest.mock import Mock
+
+import aiounittest
+from synapse.module_api.errors import SynapseError
+
+from synapse_auto_accept_invite.retry import RetryPolicy
+from tests import MockEvent, create_module
+
+
+class RetryPolicyTestCase(aiounittest.AsyncTestCase):
+    def test_delays(self) -> None:
+        """Tests that delays grow exponentially up to the maximum, are jittered, and
+        stop once the maximum number of attempts or the deadline is reached.
+        """
+        policy = RetryPolicy(
+            initial_delay=1, max_delay=10, max_attempts=6, deadline=100
+        )
+
+        self.assertEqual(
+            [policy.get_next_delay(n, 0, rand=lambda: 1.0) for n in range(1, 7)],
+            [1, 2, 4, 8, 10, None],
+        )
+        self.assertEqual(policy.get_next_delay(3, 0, rand=lambda: 0.5), 2)
+
+        # The next attempt would happen past the deadline.
+        self.assertIsNone(policy.get_next_delay(3, 97, rand=lambda: 1.0))
+        self.assertEqual(
+            RetryPolicy(deadline=0).get_next_delay(1, 10**6, rand=lambda: 1.0), 1
+        )
+
+    def test_permanent_failures(self) -> None:
+        """Tests that only errors with a permanent error code are permanent failures,
+        unless the invite came over federation recently.
+        """
+        policy = RetryPolicy(federation_race_window=15)
+
+        self.assertTrue(policy.is_permanent_failure(SynapseError(403, "x"), 0, False))
+        self.assertFalse(policy.is_permanent_failure(SynapseError(502, "x"), 0, False))
+        self.assertFalse(policy.is_permanent_failure(Exception(), 0, False))
+
+        self.assertFalse(policy.is_permanent_failure(SynapseError(404, "x"), 5, True))
+        self.assertTrue(policy.is_permanent_failure(SynapseError(404, "x"), 20, True))
+
+    def test_federation_race_window(self) -> None:
+        """Tests that joins rejected within the federation race window are retried
+        until the window has passed, regardless of the maximum number of attempts.
+        """
+        policy = RetryPolicy(max_attempts=2, federation_race_window=15)
+
+        self.assertTrue(policy.is_federation_race(SynapseError(404, "x"), 5, True))
+        self.assertFalse(policy.is_federation_race(SynapseError(404, "x"), 15, True))
+        self.assertFalse(policy.is_federation_race(SynapseError(404, "x"), 5, False))
+        self.assertFalse(policy.is_federation_race(SynapseError(502, "x"), 5, True))
+
+        self.assertIsNone(policy.get_next_delay(2, 5, rand=lambda: 1.0))
+        self.assertEqual(
+            policy.get_next_delay(2, 5, rand=lambda: 1.0, in_race_window=True), 2
+        )
+        # The last attempt is made as the window closes.
+        self.assertEqual(
+            policy.get_next_delay(5, 14, rand=lambda: 1.0, in_race_window=True), 1
+        )
+
+    async def test_retry_through_federation_race(self) -> None:
+        """Tests that, with the default settings, a join rejected by the inviter's
+        server for 10 seconds after the invite was received still goes through.
+        """
+        module = create_module()
+        api = cast(Mock, module._api)
+        received_at = api.get_current_time_msec()
+        joined_at: List[int] = []
+
+        async def update_room_membership(**kwargs: Any) -> MockEvent:
+            now = api.get_current_time_msec()
+            if now - received_at < 10000:
+                raise SynapseError(404, "Unknown room")
+            joined_at.append(now)
+            return MockEvent(
+                sender="@lesley:test",
+                state_key="@lesley:test",
+                type="m.room.member",
+                content={"membership": "join"},
+            )
+
+        api.update_room_membership.side_effect = update_room_membership
+
+        invite = MockEvent(
+            sender="@inviter:remote",
+            state_key="@lesley:test",
+            type="m.room.member",
+            content={"membership": "invite"},
+        )
+        # Stop mypy from complaining that we give on_new_event a MockEvent rather than
+        # an EventBase.
+        await module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+        self.assertEqual(len(joined_at), 1)
+        self.assertLessEqual(joined_at[0] - received_at, 15000)
+        self.assertEqual(module._join_scheduler.delayed_count, 0)
+
+    async def test_stop_on_permanent_failure(self) -> None:
+        """Tests that the module doesn't retry joins that failed permanently."""
+        module = create_module()
+        update_room_membership = cast(Mock, module._api.update_room_membership)
+        update_room_membership.side_effect = SynapseError(403, "Forbidden")
+
+        invite = MockEvent(
+            sender="@inviter:test",
+            state_key="@lesley:test",
+            type="m.room.member",
+            content={"membership": "invite"},
+        )
+        # Stop mypy from complaining that we give on_new_event a MockEvent rather than
+        # an EventBase.
+        await module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+        self.assertEqual(update_room_membership.call_count, 1)
+        cast(Mock, module._api.sleep).assert_not_called()
+
+    async def test_give_up_if_no_event_returned(self) -> None:
+        """Tests that attempts that don't return a membership event count as failed,
+        rather than being retried forever.
+        """
+        module = create_module()
+        update_room_membership = cast(Mock, module._api.update_room_membership)
+        update_room_membership.return_value = None
+
+        invite = MockEvent(
+            sender="@inviter:remote",
+            state_key="@lesley:test",
+            type="m.room.member",
+            content={"membership": "invite"},
+        )
+        # Stop mypy from complaining that we give on_new_event a MockEvent rather than
+        # an EventBase.
+        await module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+        self.assertEqual(update_room_membership.call_count, 5)
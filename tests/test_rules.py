@@ -0,0 +1,106 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import cast
+from unittest.mock import Mock
+
+import aiounittest
+from synapse.api.room_versions import RoomVersions
+from synapse.module_api.errors import ConfigError
+
+from synapse_auto_accept_invite import InviteAutoAccepter
+from synapse_auto_accept_invite.rules import InviteRules, Matcher
+from tests import MockEvent, create_module
+
+
+class InviteRulesTestCase(aiounittest.AsyncTestCase):
+    def test_matcher(self) -> None:
+        """Tests that matchers match exact values and glob patterns, and only the
+        whole value.
+        """
+        matcher = Matcher.compile(["@bot:example.com", "@*:corp.example", "@user?:x"])
+
+        self.assertTrue(matcher.matches("@bot:example.com"))
+        self.assertTrue(matcher.matches("@anyone:corp.example"))
+        self.assertTrue(matcher.matches("@user1:x"))
+
+        self.assertFalse(matcher.matches("@bot:example.com.evil"))
+        self.assertFalse(matcher.matches("@anyone:corp.example.evil"))
+        self.assertFalse(matcher.matches("@user12:x"))
+        self.assertFalse(Matcher.compile([]).matches(""))
+
+    def test_check(self) -> None:
+        """Tests that invites are rejected if they match a deny list or don't match an
+        allow list, with the reason why.
+        """
+        rules = InviteRules(
+            allow={"inviter_servers": ["*.example.com"], "room_versions": ["10"]},
+            deny={"inviter_servers": ["evil.example.com"], "invitees": ["@admin:*"]},
+        )
+
+        self.assertIsNone(rules.check("@a:hs.example.com", "@b:test", "10"))
+        self.assertEqual(
+            rules.check("@a:evil.example.com", "@b:test", "10"), "denied_inviter_server"
+        )
+        self.assertEqual(
+            rules.check("@a:other.org", "@b:test", "10"), "not_allowed_inviter_server"
+        )
+        self.assertEqual(
+            rules.check("@a:hs.example.com", "@admin:test", "10"), "denied_invitee"
+        )
+        self.assertEqual(
+            rules.check("@a:hs.example.com", "@b:test", "9"), "not_allowed_room_version"
+        )
+
+        self.assertFalse(InviteRules())
+
+    def test_parse_config(self) -> None:
+        """Tests that invalid rules are rejected when parsing the configuration."""
+        for rules in (
+            ["deny"],
+            {"block": {}},
+            {"deny": {"servers": ["example.com"]}},
+            {"deny": {"inviters": "@a:example.com"}},
+        ):
+            with self.assertRaises(ConfigError):
+                InviteAutoAccepter.parse_config({"invite_rules": rules})
+
+    async def test_filter_invites(self) -> None:
+        """Tests that the module only accepts invites allowed by its rules."""
+        module = create_module(
+            config_override={
+                "invite_rules": {
+                    "allow": {"room_versions": [9, 10]},
+                    "deny": {"inviters": ["@spammer:*"]},
+                }
+            }
+        )
+        update_room_membership = cast(Mock, module._api.update_room_membership)
+
+        for inviter, room_version in (
+            ("@spammer:remote", RoomVersions.V10),
+            ("@friend:remote", RoomVersions.V6),
+            ("@friend:remote", RoomVersions.V10),
+        ):
+            invite = MockEvent(
+                sender=inviter,
+                state_key="@lesley:test",
+                type="m.room.member",
+                content={"membership": "invite"},
+                room_version=room_version,
+            )
+            # Stop mypy from complaining that we give on_new_event a MockEvent rather
+            # than an EventBase.
+            await module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+        self.assertEqual(update_room_membership.call_count, 1)
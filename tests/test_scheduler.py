@@ -0,0 +1,221 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Dict, List, Optional, cast
+from unittest.mock import Mock
+
+import aiounittest
+from twisted.internet import defer
+
+from synapse_auto_accept_invite.circuit_breaker import CircuitBreaker
+from synapse_auto_accept_invite.scheduler import (
+    LANE_DIRECT_MESSAGE,
+    LANE_FEDERATED,
+    LANE_LARGE_ROOM,
+    LANE_LOCAL,
+    JoinJob,
+    JoinScheduler,
+    RetryLaterError,
+)
+from tests import create_module
+
+
+def make_job(
+    user_id: str, destination: Optional[str], lane: int = LANE_FEDERATED
+) -> JoinJob:
+    return JoinJob(
+        user_id=user_id,
+        inviter=f"@inviter:{destination or 'test'}",
+        room_id=f"!room:{destination or 'test'}",
+        is_direct_message=False,
+        destination=destination,
+        lane=lane,
+    )
+
+
+class JoinSchedulerTestCase(aiounittest.AsyncTestCase):
+    def setUp(self) -> None:
+        # The jobs that have been started, and the deferreds to resolve to complete
+        # them.
+        self.started: List[str] = []
+        self.running: Dict[str, "defer.Deferred[None]"] = {}
+
+        async def process(job: JoinJob) -> None:
+            self.started.append(job.user_id)
+            d: "defer.Deferred[None]" = defer.Deferred()
+            self.running[job.user_id] = d
+            await d
+
+        self.scheduler = JoinScheduler(
+            create_module()._api,
+            process,
+            max_concurrent_joins=3,
+            max_concurrent_joins_per_server=2,
+            circuit_breaker=CircuitBreaker(0, 0),
+        )
+
+    def complete(self, user_id: str) -> None:
+        self.running.pop(user_id).callback(None)
+
+    def test_limits_concurrency(self) -> None:
+        """Tests that the scheduler doesn't run more joins than allowed, in total and
+        per server, and starts queued joins when slots free up.
+        """
+        for i in range(3):
+            self.scheduler.schedule(make_job(f"@a{i}:test", "a.example"))
+        for i in range(2):
+            self.scheduler.schedule(make_job(f"@b{i}:test", "b.example"))
+
+        # Only two joins can go through a.example at once, and only three can run in
+        # total.
+        self.assertEqual(self.started, ["@a0:test", "@a1:test", "@b0:test"])
+        self.assertEqual(self.scheduler.in_flight_count, 3)
+        self.assertEqual(self.scheduler.queued_count, 2)
+
+        # Freeing up a slot for b.example only lets a join to b.example through, since
+        # a.example is still at its limit.
+        self.complete("@b0:test")
+        self.assertEqual(self.started[3:], ["@b1:test"])
+
+        self.complete("@a0:test")
+        self.assertEqual(self.started[4:], ["@a2:test"])
+        self.assertEqual(self.scheduler.queued_count, 0)
+
+        for user_id in list(self.running):
+            self.complete(user_id)
+        self.assertEqual(self.scheduler.in_flight_count, 0)
+
+    def test_local_joins_not_limited_per_server(self) -> None:
+        """Tests that joins for invites from local users are only subject to the global
+        limit.
+        """
+        for i in range(4):
+            self.scheduler.schedule(make_job(f"@local{i}:test", None))
+
+        self.assertEqual(self.started, ["@local0:test", "@local1:test", "@local2:test"])
+        self.assertEqual(self.scheduler.queued_count, 1)
+
+    def test_deduplicates_jobs(self) -> None:
+        """Tests that scheduling a job for a user and room that already have one queued
+        or running merges it into the existing one.
+        """
+        first_job = make_job("@a0:test", "a.example")
+        self.assertIs(self.scheduler.schedule(first_job), first_job)
+
+        direct_message_job = make_job("@a0:test", "a.example")
+        direct_message_job.is_direct_message = True
+        direct_message_job.inviter = "@someone:a.example"
+        self.assertIs(self.scheduler.schedule(direct_message_job), first_job)
+
+        # The existing job now takes care of marking the room as a direct message.
+        self.assertEqual(self.started, ["@a0:test"])
+        self.assertTrue(first_job.is_direct_message)
+        self.assertEqual(first_job.inviter, "@someone:a.example")
+
+        # Once the job has completed, a new one can be scheduled.
+        self.complete("@a0:test")
+        second_job = make_job("@a0:test", "a.example")
+        self.assertIs(self.scheduler.schedule(second_job), second_job)
+        self.assertEqual(self.started, ["@a0:test", "@a0:test"])
+
+    def test_priority_lanes(self) -> None:
+        """Tests that queued jobs are started from the highest priority lane first, and
+        that low priority jobs can't use the reserved slots.
+        """
+        scheduler = JoinScheduler(
+            create_module()._api,
+            self.scheduler._process,
+            max_concurrent_joins=2,
+            max_concurrent_joins_per_server=2,
+            circuit_breaker=CircuitBreaker(0, 0),
+            reserved_priority_slots=1,
+        )
+
+        scheduler.schedule(make_job("@large0:test", "a.example", LANE_LARGE_ROOM))
+        scheduler.schedule(make_job("@large1:test", "a.example", LANE_LARGE_ROOM))
+        scheduler.schedule(make_job("@federated:test", "b.example", LANE_FEDERATED))
+
+        # Only one slot is available to joins in the low priority lanes.
+        self.assertEqual(self.started, ["@large0:test"])
+
+        scheduler.schedule(make_job("@local:test", None, LANE_LOCAL))
+        scheduler.schedule(make_job("@dm:test", "c.example", LANE_DIRECT_MESSAGE))
+        self.assertEqual(self.started, ["@large0:test", "@local:test"])
+
+        # Freeing up slots starts the direct message first, then the federated join
+        # ahead of the large room that was queued before it.
+        self.complete("@local:test")
+        self.assertEqual(self.started[2:], ["@dm:test"])
+        self.complete("@large0:test")
+        self.assertEqual(self.started[3:], ["@federated:test"])
+        self.complete("@federated:test")
+        self.assertEqual(self.started[4:], ["@large1:test"])
+
+    def test_synchronous_completion(self) -> None:
+        """Tests that a large backlog of joins completing synchronously doesn't make
+        the scheduler recurse.
+        """
+        completed: List[str] = []
+
+        async def process(job: JoinJob) -> None:
+            completed.append(job.user_id)
+
+        scheduler = JoinScheduler(
+            create_module()._api, process, 1, 1, CircuitBreaker(0, 0)
+        )
+        for i in range(5000):
+            scheduler.schedule(make_job(f"@user{i}:test", "a.example"))
+
+        self.assertEqual(len(completed), 5000)
+        self.assertEqual(scheduler.in_flight_count, 0)
+
+    def test_retries_dont_hold_slots(self) -> None:
+        """Tests that jobs waiting to retry a failed join give up their slot, and are
+        only started again once their next attempt is due.
+        """
+        api = create_module()._api
+        now = [1000]
+        cast(Mock, api.get_current_time_msec).side_effect = lambda: now[0]
+
+        wake_ups: List["defer.Deferred[None]"] = []
+
+        async def sleep(seconds: float) -> None:
+            d: "defer.Deferred[None]" = defer.Deferred()
+            wake_ups.append(d)
+            await d
+
+        cast(Mock, api.sleep).side_effect = sleep
+
+        attempts: List[str] = []
+
+        async def process(job: JoinJob) -> None:
+            attempts.append(job.user_id)
+            if job.lane == LANE_FEDERATED and not job.attempts:
+                job.attempts += 1
+                job.next_attempt_at = now[0] + 10000
+                raise RetryLaterError()
+
+        scheduler = JoinScheduler(api, process, 1, 1, CircuitBreaker(0, 0))
+        scheduler.schedule(make_job("@a:test", "a.example"))
+        scheduler.schedule(make_job("@b:test", "b.example"))
+        scheduler.schedule(make_job("@dm:test", None, LANE_DIRECT_MESSAGE))
+
+        # The direct message doesn't wait for the failed joins to be retried.
+        self.assertEqual(attempts, ["@a:test", "@b:test", "@dm:test"])
+        self.assertEqual(scheduler.in_flight_count, 0)
+        self.assertEqual(scheduler.delayed_count, 2)
+
+        now[0] += 10000
+        wake_ups[-1].callback(None)
+        self.assertEqual(attempts[3:], ["@a:test", "@b:test"])
+        self.assertEqual(scheduler.delayed_count, 0)
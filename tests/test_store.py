@@ -0,0 +1,253 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import sqlite3
+from typing import Any, Awaitable, Callable, Iterable, List, cast
+from unittest.mock import Mock
+
+import aiounittest
+from prometheus_client import REGISTRY
+
+from synapse_auto_accept_invite import InviteAutoAccepter
+from synapse_auto_accept_invite.store import PendingJoin, PendingJoinStore
+from tests import MockEvent, create_module, make_awaitable
+
+
+class SQLiteTransaction:
+    """Exposes the parts of Synapse's LoggingTransaction that the module uses, on top
+    of an SQLite connection.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._cursor = conn.cursor()
+
+    def execute(self, sql: str, args: Iterable[Any] = ()) -> None:
+        self._cursor.execute(sql, tuple(args))
+
+    def execute_batch(self, sql: str, args: Iterable[Iterable[Any]]) -> None:
+        self._cursor.executemany(sql, [tuple(a) for a in args])
+
+    def fetchall(self) -> List[Any]:
+        return self._cursor.fetchall()
+
+
+def use_sqlite(module: InviteAutoAccepter, conn: sqlite3.Connection) -> None:
+    """Makes the module's database interactions run against the given SQLite
+    connection.
+    """
+
+    def run_db_interaction(
+        desc: str, func: Callable[..., Any], *args: Any
+    ) -> Awaitable[Any]:
+        return make_awaitable(func(SQLiteTransaction(conn), *args))
+
+    cast(Mock, module._api.run_db_interaction).side_effect = run_db_interaction
+
+
+def get_skipped_joins() -> float:
+    return (
+        REGISTRY.get_sample_value("synapse_auto_accept_invite_skipped_joins_total")
+        or 0.0
+    )
+
+
+def make_pending_join(
+    user_id: str, room_id: str, attempts: int = 0, queued_at: int = 1000
+) -> PendingJoin:
+    return PendingJoin(
+        user_id=user_id,
+        room_id=room_id,
+        inviter="@inviter:remote",
+        is_direct_message=False,
+        attempts=attempts,
+        next_attempt_at=0,
+        queued_at=queued_at,
+    )
+
+
+class PendingJoinStoreTestCase(aiounittest.AsyncTestCase):
+    def setUp(self) -> None:
+        self.conn = sqlite3.connect(":memory:")
+        self.module = create_module()
+        use_sqlite(self.module, self.conn)
+        self.store = PendingJoinStore(self.module._api)
+
+    async def test_save_and_remove(self) -> None:
+        """Tests that saved pending joins can be retrieved in batches, and that removed
+        ones can't.
+        """
+        for i in range(5):
+            self.store.save(make_pending_join(f"@user{i}:test", "!room:remote"))
+
+        # Saving a join again replaces its previous version.
+        self.store.save(make_pending_join("@user0:test", "!room:remote", attempts=2))
+        self.store.remove("@user1:test", "!room:remote")
+
+        first_batch = await self.store.get_pending_joins(None, 2)
+        self.assertEqual(
+            first_batch,
+            [
+                make_pending_join("@user0:test", "!room:remote", attempts=2),
+                make_pending_join("@user2:test", "!room:remote"),
+            ],
+        )
+
+        second_batch = await self.store.get_pending_joins(
+            ("@user2:test", "!room:remote"), 2
+        )
+        self.assertEqual(
+            [pending_join.user_id for pending_join in second_batch],
+            ["@user3:test", "@user4:test"],
+        )
+
+    async def test_resume_pending_joins(self) -> None:
+        """Tests that the module resumes the joins left pending in the database when it
+        starts, and removes them once they've completed.
+        """
+        self.store.save(make_pending_join("@lesley:test", "!room:remote", attempts=2))
+
+        api = self.module._api
+        update_room_membership = cast(Mock, api.update_room_membership)
+        update_room_membership.return_value = MockEvent(
+            sender="@lesley:test",
+            state_key="@lesley:test",
+            type="m.room.member",
+            content={"membership": "join"},
+        )
+
+        # The module resumes the pending joins in the background when it's created.
+        InviteAutoAccepter(
+            InviteAutoAccepter.parse_config({"persist_pending_joins": True}), api
+        )
+
+        update_room_membership.assert_called_once_with(
+            sender="@lesley:test",
+            target="@lesley:test",
+            room_id="!room:remote",
+            new_membership="join",
+        )
+        self.assertEqual(await self.store.get_pending_joins(None, 10), [])
+
+    async def test_resumed_joins_keep_their_deadline(self) -> None:
+        """Tests that the retry deadline of a resumed join counts from when its invite
+        was received, rather than from when it was resumed.
+        """
+        api = self.module._api
+        invited_at = api.get_current_time_msec() - 1000 * 1000
+        self.store.save(
+            make_pending_join("@lesley:test", "!room:remote", queued_at=invited_at)
+        )
+        update_room_membership = cast(Mock, api.update_room_membership)
+        update_room_membership.side_effect = Exception("Timed out")
+
+        InviteAutoAccepter(
+            InviteAutoAccepter.parse_config({"persist_pending_joins": True}), api
+        )
+
+        # The deadline has long passed, so the join isn't retried.
+        update_room_membership.assert_called_once()
+        self.assertEqual(await self.store.get_pending_joins(None, 10), [])
+
+    async def test_skipped_join_not_left_pending(self) -> None:
+        """Tests that a join that completes while it's being scheduled, e.g. because
+        the invitee is already in the room, doesn't stay in the database.
+        """
+        api = self.module._api
+        member_event = MockEvent(
+            sender="@lesley:test",
+            state_key="@lesley:test",
+            type="m.room.member",
+            content={"membership": "join"},
+        )
+        cast(Mock, api.get_room_state).return_value = {
+            ("m.room.member", "@lesley:test"): member_event
+        }
+        skipped_before = get_skipped_joins()
+
+        module = InviteAutoAccepter(
+            InviteAutoAccepter.parse_config({"persist_pending_joins": True}), api
+        )
+        # Stop mypy from complaining that we give on_new_event a MockEvent rather than
+        # an EventBase.
+        await module.on_new_event(
+            MockEvent(
+                sender="@inviter:test",
+                state_key="@lesley:test",
+                type="m.room.member",
+                content={"membership": "invite"},
+            )  # type: ignore[arg-type]
+        )
+
+        cast(Mock, api.update_room_membership).assert_not_called()
+        self.assertEqual(get_skipped_joins(), skipped_before + 1)
+        self.assertEqual(await self.store.get_pending_joins(None, 10), [])
+
+    async def test_sweep_missed_invites(self) -> None:
+        """Tests that the module goes through the outstanding invites in batches when it
+        starts, and only accepts the ones allowed by its configuration.
+        """
+        self.conn.executescript(
+            """
+            CREATE TABLE local_current_membership (
+                room_id TEXT, user_id TEXT, event_id TEXT, membership TEXT
+            );
+            CREATE TABLE events (event_id TEXT, sender TEXT);
+            CREATE TABLE event_json (event_id TEXT, json TEXT);
+            CREATE TABLE rooms (room_id TEXT, room_version TEXT);
+            """
+        )
+        for i, (membership, is_direct) in enumerate(
+            [("invite", True), ("invite", False), ("join", True), ("invite", True)]
+        ):
+            content = {"membership": membership, "is_direct": is_direct}
+            self.conn.execute(
+                "INSERT INTO local_current_membership VALUES (?, ?, ?, ?)",
+                (f"!room{i}:remote", f"@user{i}:test", f"$event{i}", membership),
+            )
+            self.conn.execute(
+                "INSERT INTO events VALUES (?, ?)", (f"$event{i}", "@inviter:remote")
+            )
+            self.conn.execute(
+                "INSERT INTO event_json VALUES (?, ?)",
+                (f"$event{i}", json.dumps({"content": content})),
+            )
+
+        api = self.module._api
+        update_room_membership = cast(Mock, api.update_room_membership)
+        update_room_membership.return_value = MockEvent(
+            sender="@someone:test",
+            state_key="@someone:test",
+            type="m.room.member",
+            content={"membership": "join"},
+        )
+        account_data_get = cast(Mock, api.account_data_manager.get_global)
+        account_data_get.side_effect = lambda *args: make_awaitable({})
+        account_data_put = cast(Mock, api.account_data_manager.put_global)
+        account_data_put.side_effect = lambda *args: make_awaitable(None)
+
+        InviteAutoAccepter(
+            InviteAutoAccepter.parse_config(
+                {
+                    "accept_invites_only_for_direct_messages": True,
+                    "sweep_missed_invites": True,
+                    "sweep_batch_size": 1,
+                }
+            ),
+            api,
+        )
+
+        self.assertEqual(
+            [call[1]["target"] for call in update_room_membership.call_args_list],
+            ["@user0:test", "@user3:test"],
+        )
@@ -0,0 +1,111 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+from typing import cast
+from unittest.mock import Mock, patch
+
+import aiounittest
+
+from tests import MockEvent, create_module, make_awaitable
+
+
+class TracingTestCase(aiounittest.AsyncTestCase):
+    async def test_spans(self) -> None:
+        """Tests that each stage of accepting an invite gets its own span when tracing
+        is enabled, and that no span is started when it isn't.
+        """
+        for enable_tracing in (False, True):
+            module = create_module(config_override={"enable_tracing": enable_tracing})
+            update_room_membership = cast(Mock, module._api.update_room_membership)
+            update_room_membership.side_effect = [
+                Exception(),
+                MockEvent(
+                    sender="@lesley:test",
+                    state_key="@lesley:test",
+                    type="m.room.member",
+                    content={"membership": "join"},
+                ),
+            ]
+            account_data_manager = module._api.account_data_manager
+            cast(
+                Mock, account_data_manager.get_global
+            ).side_effect = lambda *args: make_awaitable(None)
+            cast(
+                Mock, account_data_manager.put_global
+            ).side_effect = lambda *args: make_awaitable(None)
+
+            invite = MockEvent(
+                sender="@inviter:remote",
+                state_key="@lesley:test",
+                room_id="!room:remote",
+                type="m.room.member",
+                content={"membership": "invite", "is_direct": True},
+            )
+
+            with patch(
+                "synapse_auto_accept_invite.tracing.start_active_span",
+                side_effect=lambda *args, **kwargs: contextlib.nullcontext(),
+            ) as start_active_span, patch(
+                "synapse_auto_accept_invite.tracing.set_tag"
+            ) as set_tag:
+                # Stop mypy from complaining that we give on_new_event a MockEvent
+                # rather than an EventBase.
+                await module.on_new_event(event=invite)  # type: ignore[arg-type]
+
+            if not enable_tracing:
+                start_active_span.assert_not_called()
+                set_tag.assert_not_called()
+                continue
+
+            # The delay before the second attempt was recorded on the first one.
+            self.assertEqual(
+                [call[0][0] for call in set_tag.call_args_list], ["retry_delay"]
+            )
+
+            self.assertEqual(
+                [
+                    (call[0][0], call[1]["tags"])
+                    for call in start_active_span.call_args_list
+                ],
+                [
+                    (
+                        "auto_accept_invite.classify",
+                        {"invitee_server": "test", "room_id": "!room:remote"},
+                    ),
+                    (
+                        "auto_accept_invite.join_attempt",
+                        {
+                            "invitee_server": "test",
+                            "room_id": "!room:remote",
+                            "attempt": "1",
+                        },
+                    ),
+                    (
+                        "auto_accept_invite.join_attempt",
+                        {
+                            "invitee_server": "test",
+                            "room_id": "!room:remote",
+                            "attempt": "2",
+                        },
+                    ),
+                    (
+                        "auto_accept_invite.read_direct_messages",
+                        {"invitee_server": "test"},
+                    ),
+                    (
+                        "auto_accept_invite.write_direct_messages",
+                        {"invitee_server": "test"},
+                    ),
+                ],
+            )